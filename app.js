@@ -28,6 +28,7 @@ let state = {
     warehouses: [],
     postingPeriods: [],
     purchaseRequests: [],
+    purchaseRequestsHasMore: false,
 //    purchaseOrders: [],
 //    approvedPRs: [],
 //    vendors: [],
@@ -58,11 +59,7 @@ document.addEventListener('DOMContentLoaded', function() {
 initializeSubmenus();
 loadDashboardData();
 loadEmployees();
-loadDepartments();
-loadDesignations();
-loadShifts();
-loadDivisions();
-loadBanks();
+loadReferenceData();
 loadBusRoutes();
 loadBusRouteStops();
 loadGatePasses();
@@ -71,15 +68,8 @@ loadLeaves();
 loadMissedPunches();
 loadInterviewJoining();
 loadResignations();
-loadBPTypes(); 
-loadBPGroups();
 loadBusinessPartners();
 loadItemMaster();
-loadItemGroups();
-loadItemUOMs();
-loadItemCategories();
-loadItemTypes();
-loadWarehouses(); 
 loadPostingPeriods();
 loadPurchaseRequests();
 loadPOData();
@@ -96,10 +86,7 @@ async function loadPOData() {
         await Promise.all([
             loadPurchaseOrders(),
             loadApprovedPRs(),
-            loadVendors(),
-            loadTaxCodes(),
-            loadWarehouses(),
-            loadUOMs()
+            loadVendors()
         ]);
     } catch (error) {
         console.error('Failed to load PO data:', error);
@@ -165,6 +152,35 @@ throw error;
 
 // Load functions
 
+// All lookup tables in one request; the browser revalidates it with the ETag
+async function loadReferenceData() {
+    try {
+        const ref = await apiRequest('/api/reference-data');
+        state.bpTypes = ref.bp_types;
+        state.bpGroups = ref.bp_groups;
+        state.itemGroups = ref.item_groups;
+        state.itemUOMs = ref.uoms;
+        state.itemCategories = ref.item_categories;
+        state.itemTypes = ref.item_types;
+        state.warehouses = ref.warehouses;
+        state.departments = ref.departments;
+        state.designations = ref.designations;
+        state.shifts = ref.shifts;
+        state.divisions = ref.divisions;
+        state.banks = ref.banks;
+        poState.taxCodes = ref.tax_codes;
+        poState.warehouses = ref.warehouses;
+        poState.uoms = ref.uoms;
+        renderDepartments();
+        renderDesignations();
+        renderShifts();
+        renderDivisions();
+        renderBanks();
+    } catch (error) {
+        console.error('Failed to load reference data:', error);
+    }
+}
+
 async function loadBPTypes() {
     try {
         state.bpTypes = await apiRequest('/api/bp-types');
@@ -3796,15 +3812,28 @@ async function deletePostingPeriod(period_id) {
 
 // ===================== Purchase Request =====================
 
-async function loadPurchaseRequests() {
+const PR_PAGE_SIZE = 50;
+
+async function loadPurchaseRequests(append = false) {
     try {
-        state.purchaseRequests = await apiRequest('/api/purchase-requests');
+        const params = new URLSearchParams({ limit: PR_PAGE_SIZE, include_rows: false });
+        const last = state.purchaseRequests[state.purchaseRequests.length - 1];
+        if (append && last) {
+            params.append('cursor', last.req_no);
+        }
+        const page = await apiRequest(`/api/purchase-requests?${params}`);
+        state.purchaseRequests = append ? state.purchaseRequests.concat(page) : page;
+        state.purchaseRequestsHasMore = page.length === PR_PAGE_SIZE;
         renderPurchaseRequests();
     } catch (error) {
         console.error('Failed to load purchase requests:', error);
     }
 }
 
+function loadMorePurchaseRequests() {
+    loadPurchaseRequests(true);
+}
+
 function renderPurchaseRequests() {
     const tbody = document.getElementById('purchase-request-table-body');
     if (!tbody) return;
@@ -3814,8 +3843,7 @@ function renderPurchaseRequests() {
     state.purchaseRequests.forEach(req => {
         const row = document.createElement('tr');
         
-        // Calculate total quantity from all rows
-        const totalQty = req.rows ? req.rows.reduce((sum, row) => sum + (row.req_qty || 0), 0) : 0;
+        const totalQty = req.total_qty || 0;
         
         row.innerHTML = `
             <td>${req.req_no}</td>
@@ -3823,7 +3851,7 @@ function renderPurchaseRequests() {
             <td>${req.emp_dept || ''}</td>
             <td>${req.emp_name || ''}</td>
             <td>${totalQty.toLocaleString('en-IN')}</td>
-            <td>${req.rows ? req.rows.length : 0} items</td>
+            <td>${req.item_count || 0} items</td>
             <td>
                 <span class="badge ${getPRStatusBadge(req.req_status)}">
                     ${req.req_status}
@@ -3851,6 +3879,11 @@ function renderPurchaseRequests() {
         `;
         tbody.appendChild(row);
     });
+
+    const loadMoreBtn = document.getElementById('purchase-request-load-more');
+    if (loadMoreBtn) {
+        loadMoreBtn.style.display = state.purchaseRequestsHasMore ? '' : 'none';
+    }
 }
 
 function getPRStatusBadge(status) {
@@ -4350,10 +4383,13 @@ async function savePurchaseRequest() {
     }
 }
 
-function editPurchaseRequest(req_id) {
-    const req = state.purchaseRequests.find(r => r.req_id === req_id);
-    if (req) {
+async function editPurchaseRequest(req_id) {
+    try {
+        // The list is loaded without rows, so fetch the full request for editing
+        const req = await apiRequest(`/api/purchase-requests/${req_id}`);
         showPurchaseRequestModal(req);
+    } catch (error) {
+        console.error('Failed to load purchase request:', error);
     }
 }
 
@@ -1,9 +1,10 @@
 # main.py
-from fastapi import FastAPI, HTTPException, status, Depends, APIRouter, BackgroundTasks, Request, Form
+from fastapi import FastAPI, HTTPException, status, Depends, APIRouter, BackgroundTasks, Request, Form, Response
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, validator, EmailStr
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, FileResponse
 from email.mime.text import MIMEText
 import asyncpg
 import smtplib
@@ -14,6 +15,25 @@ from asyncpg.pool import Pool
 from asyncpg import Pool
 from fastapi.staticfiles import StaticFiles
 import re
+import csv
+import codecs
+import uuid
+import io
+import json
+import bisect
+import asyncio
+import hashlib
+import glob
+import tempfile
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+try:
+    from PIL import Image  # Optional: only needed for attachment thumbnails
+except ImportError:
+    Image = None
 
 
 # Load environment variables from .env file
@@ -484,6 +504,11 @@ class ItemMasterCreate(ItemMasterBase):
 class ItemMasterCreate(ItemMasterBase):
     category_ids: List[int] = [] 
 
+class ItemWarehouseStock(BaseModel):
+    warehouse_id: int
+    whs_name: Optional[str] = None
+    balance_qty: float
+
 class ItemMasterResponse(ItemMasterBase):
     it_id: int
     it_code: str
@@ -493,11 +518,46 @@ class ItemMasterResponse(ItemMasterBase):
     type_name: Optional[str] = None
     whs_name: Optional[str] = None
     current_stock: Optional[float] = None
+    warehouse_stock: List[ItemWarehouseStock] = []
     category_ids: List[int] = []
     
     class Config:
         from_attributes = True
 
+# Pydantic models for item attachments
+class AttachmentUploadCreate(BaseModel):
+    file_name: str
+    content_type: Optional[str] = None
+    total_bytes: Optional[int] = None
+    uploaded_by: Optional[str] = None
+
+class AttachmentUploadResponse(BaseModel):
+    upload_id: str
+    item_id: int
+    file_name: str
+    content_type: Optional[str] = None
+    total_bytes: Optional[int] = None
+    received_bytes: int
+    uploaded_by: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class ItemAttachmentResponse(BaseModel):
+    attachment_id: int
+    item_id: int
+    file_name: str
+    content_type: Optional[str] = None
+    size_bytes: int
+    sha256: str
+    uploaded_by: Optional[str] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
 # Pydantic model for stock transactions
 class StockTransactionBase(BaseModel):
     item_id: int
@@ -511,7 +571,7 @@ class StockTransactionBase(BaseModel):
     created_by: Optional[str] = None
 
 class StockTransactionCreate(StockTransactionBase):
-    pass
+    trans_date: Optional[datetime] = None  # Back-dated posting; defaults to now
 
 class StockTransactionResponse(StockTransactionBase):
     trans_id: int
@@ -524,6 +584,11 @@ class StockTransactionResponse(StockTransactionBase):
     class Config:
         from_attributes = True
 
+class StockRecomputeRequest(BaseModel):
+    item_id: int
+    warehouse_id: Optional[int] = None
+    from_date: datetime
+
 # Pydantic models for Posting Periods
 class PostingPeriodBase(BaseModel):
     period_code: str
@@ -598,6 +663,7 @@ class PurReqHeaderResponse(PurReqHeaderBase):
     req_no: str
     valid_dt: date
     total_qty: float = 0  # Sum of all row quantities for UI
+    item_count: int = 0  # Number of rows, available even when rows are not expanded
     created_at: datetime
     updated_at: datetime
     rows: List[PurReqRowResponse] = []
@@ -651,6 +717,7 @@ class PurOrdRowCreate(PurOrdRowBase):
 class PurOrdRowResponse(PurOrdRowBase):
     po_row_id: int
     po_id: int
+    received_qty: float = 0
     created_at: datetime
     
     class Config:
@@ -689,6 +756,66 @@ class PurOrdHeaderResponse(PurOrdHeaderBase):
 class PurOrdStatusUpdate(BaseModel):
     po_status: str
 
+# Pydantic models for Goods Receipt against Purchase Order
+class GoodsReceiptRowCreate(BaseModel):
+    po_row_id: int
+    recv_qty: float
+    whs_id: Optional[int] = None  # Defaults to the PO line's warehouse
+    unit_cost: Optional[float] = None  # Defaults to the PO line's unit price
+
+class GoodsReceiptCreate(BaseModel):
+    po_id: int
+    post_dt: date
+    doc_dt: date
+    remarks: Optional[str] = None
+    created_by: Optional[str] = None
+    rows: List[GoodsReceiptRowCreate] = []
+
+class GoodsReceiptRowResponse(BaseModel):
+    grpo_row_id: int
+    grpo_id: int
+    line_no: int
+    po_row_id: int
+    po_line_no: Optional[int] = None
+    it_id: int
+    it_code: Optional[str] = None
+    it_name: Optional[str] = None
+    whs_id: Optional[int] = None
+    recv_qty: float
+    unit_cost: float
+    trans_id: Optional[int] = None
+    
+    class Config:
+        from_attributes = True
+
+class GoodsReceiptResponse(BaseModel):
+    grpo_id: int
+    grpo_no: str
+    po_id: int
+    po_no: Optional[str] = None
+    post_per: int
+    post_dt: date
+    doc_dt: date
+    bpcode: str
+    bpname: Optional[str] = None
+    remarks: Optional[str] = None
+    created_by: Optional[str] = None
+    created_at: datetime
+    rows: List[GoodsReceiptRowResponse] = []
+    
+    class Config:
+        from_attributes = True
+
+# Model for drafting purchase requests from replenishment suggestions
+class ReplenishmentDraftRequest(BaseModel):
+    emp_code: str
+    post_dt: date
+    doc_dt: date
+    item_ids: Optional[List[int]] = None  # Limit the draft to these items; defaults to all suggestions
+    priority: str = "Medium"
+    remarks: Optional[str] = None
+    created_by: Optional[str] = None
+
 # Model for converting PR to PO
 class PRToPOConversion(BaseModel):
     req_ids: List[int]  # List of PR IDs to convert
@@ -709,20 +836,393 @@ async def get_db_connection():
 async def get_db_pool() -> asyncpg.pool.Pool:
     return await get_db_connection()
 
+# Supporting tables maintained by the API itself
+SCHEMA_DDL = """
+    -- Current balance per item x warehouse, kept in step with stock_transactions.
+    -- warehouse_id 0 holds movements posted without a warehouse.
+    CREATE TABLE IF NOT EXISTS stock_balance (
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL DEFAULT 0,
+        balance_qty NUMERIC NOT NULL DEFAULT 0,
+        last_trans_id INTEGER,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (item_id, warehouse_id)
+    );
+
+    -- Inventory valuation: moving-average cost on the balance row, FIFO cost layers.
+    -- ADD COLUMN IF NOT EXISTS still locks the table exclusively when the column is
+    -- there, so the catalog is checked first, as for the triggers below.
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = 'stock_balance'::regclass AND attname = 'avg_cost' AND NOT attisdropped
+        ) THEN
+            ALTER TABLE stock_balance ADD COLUMN avg_cost NUMERIC NOT NULL DEFAULT 0;
+        END IF;
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = 'stock_balance'::regclass AND attname = 'stock_value' AND NOT attisdropped
+        ) THEN
+            ALTER TABLE stock_balance ADD COLUMN stock_value NUMERIC NOT NULL DEFAULT 0;
+        END IF;
+    END;
+    $$;
+    CREATE TABLE IF NOT EXISTS stock_fifo_layer (
+        layer_id SERIAL PRIMARY KEY,
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL DEFAULT 0,
+        trans_id INTEGER,
+        layer_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        unit_cost NUMERIC NOT NULL,
+        original_qty NUMERIC NOT NULL,
+        remaining_qty NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_stock_fifo_layer_open
+        ON stock_fifo_layer (item_id, warehouse_id, layer_id) WHERE remaining_qty > 0;
+
+    -- FIFO layers still open at an archive cutoff, carried by that cutoff's OPENING row
+    CREATE TABLE IF NOT EXISTS stock_opening_layer (
+        opening_trans_id INTEGER NOT NULL,
+        layer_no INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL DEFAULT 0,
+        trans_id INTEGER,
+        unit_cost NUMERIC NOT NULL,
+        remaining_qty NUMERIC NOT NULL,
+        PRIMARY KEY (opening_trans_id, layer_no)
+    );
+
+    -- Daily movement totals per item x warehouse x transaction type
+    CREATE TABLE IF NOT EXISTS stock_movement_daily (
+        movement_date DATE NOT NULL,
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL DEFAULT 0,
+        trans_type VARCHAR(20) NOT NULL,
+        qty_in NUMERIC NOT NULL DEFAULT 0,
+        qty_out NUMERIC NOT NULL DEFAULT 0,
+        value_in NUMERIC NOT NULL DEFAULT 0,
+        value_out NUMERIC NOT NULL DEFAULT 0,
+        trans_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (movement_date, item_id, warehouse_id, trans_type)
+    );
+
+    -- Progress of running and recent bulk stock imports, shared by all workers
+    CREATE TABLE IF NOT EXISTS stock_import_progress (
+        import_id VARCHAR(64) PRIMARY KEY,
+        status VARCHAR(20) NOT NULL,
+        lines_read INTEGER NOT NULL DEFAULT 0,
+        imported INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Item x warehouse balances as they stood at the end of snapshot_date
+    CREATE TABLE IF NOT EXISTS stock_snapshot (
+        snapshot_date DATE PRIMARY KEY,
+        row_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS stock_snapshot_balance (
+        snapshot_date DATE NOT NULL REFERENCES stock_snapshot (snapshot_date) ON DELETE CASCADE,
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL DEFAULT 0,
+        balance_qty NUMERIC NOT NULL,
+        PRIMARY KEY (snapshot_date, item_id, warehouse_id)
+    );
+
+    -- Goods receipts against purchase orders; received_qty on the PO line is the
+    -- running total of its receipts
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = 'pur_ord_row'::regclass AND attname = 'received_qty' AND NOT attisdropped
+        ) THEN
+            ALTER TABLE pur_ord_row ADD COLUMN received_qty NUMERIC NOT NULL DEFAULT 0;
+        END IF;
+    END;
+    $$;
+    CREATE SEQUENCE IF NOT EXISTS grpo_no_seq;
+    CREATE TABLE IF NOT EXISTS grpo_header (
+        grpo_id SERIAL PRIMARY KEY,
+        grpo_no VARCHAR(20) NOT NULL UNIQUE DEFAULT ('GR' || LPAD(nextval('grpo_no_seq')::text, 6, '0')),
+        po_id INTEGER NOT NULL REFERENCES pur_ord_header (po_id),
+        post_per INTEGER NOT NULL,
+        post_dt DATE NOT NULL,
+        doc_dt DATE NOT NULL,
+        bpcode VARCHAR(50) NOT NULL,
+        bpname VARCHAR(255),
+        remarks TEXT,
+        created_by VARCHAR(100),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_grpo_header_po ON grpo_header (po_id);
+    CREATE TABLE IF NOT EXISTS grpo_row (
+        grpo_row_id SERIAL PRIMARY KEY,
+        grpo_id INTEGER NOT NULL REFERENCES grpo_header (grpo_id) ON DELETE CASCADE,
+        line_no INTEGER NOT NULL,
+        po_row_id INTEGER NOT NULL,
+        it_id INTEGER NOT NULL,
+        whs_id INTEGER,
+        recv_qty NUMERIC NOT NULL,
+        unit_cost NUMERIC NOT NULL DEFAULT 0,
+        trans_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_grpo_row_grpo ON grpo_row (grpo_id, line_no);
+
+    -- Item list: keyset order, filters and the per-item category lookup
+    CREATE INDEX IF NOT EXISTS idx_item_master_code_id ON item_master (it_code, it_id);
+    CREATE INDEX IF NOT EXISTS idx_item_master_group_code ON item_master (it_group, it_code, it_id);
+    CREATE INDEX IF NOT EXISTS idx_item_master_status_code ON item_master (it_status, it_code, it_id);
+    CREATE INDEX IF NOT EXISTS idx_item_category_mapping_item ON item_category_mapping (item_id, category_id);
+    CREATE INDEX IF NOT EXISTS idx_item_category_mapping_category ON item_category_mapping (category_id, item_id);
+
+    -- Item attachments. Content lives on disk under its SHA-256, so identical files
+    -- are stored once; attachment_upload tracks resumable uploads in progress.
+    CREATE TABLE IF NOT EXISTS item_attachment (
+        attachment_id SERIAL PRIMARY KEY,
+        item_id INTEGER NOT NULL REFERENCES item_master (it_id) ON DELETE CASCADE,
+        file_name VARCHAR(255) NOT NULL,
+        content_type VARCHAR(255),
+        size_bytes BIGINT NOT NULL,
+        sha256 CHAR(64) NOT NULL,
+        uploaded_by VARCHAR(100),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_item_attachment_item ON item_attachment (item_id);
+    CREATE INDEX IF NOT EXISTS idx_item_attachment_sha256 ON item_attachment (sha256);
+    -- The upload an attachment came from, so completing it again returns the same row
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = 'item_attachment'::regclass AND attname = 'upload_id' AND NOT attisdropped
+        ) THEN
+            ALTER TABLE item_attachment ADD COLUMN upload_id VARCHAR(32);
+        END IF;
+    END;
+    $$;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_item_attachment_upload ON item_attachment (upload_id);
+    CREATE TABLE IF NOT EXISTS attachment_upload (
+        upload_id VARCHAR(32) PRIMARY KEY,
+        item_id INTEGER NOT NULL REFERENCES item_master (it_id) ON DELETE CASCADE,
+        file_name VARCHAR(255) NOT NULL,
+        content_type VARCHAR(255),
+        total_bytes BIGINT,
+        received_bytes BIGINT NOT NULL DEFAULT 0,
+        uploaded_by VARCHAR(100),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Item cache invalidation: every change to an item or its category mappings is
+    -- announced on the item_changes channel with the item id as payload
+    CREATE OR REPLACE FUNCTION notify_item_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'item_master' THEN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('item_changes', OLD.it_id::text);
+            ELSE
+                PERFORM pg_notify('item_changes', NEW.it_id::text);
+            END IF;
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('item_changes', OLD.item_id::text);
+        ELSE
+            PERFORM pg_notify('item_changes', NEW.item_id::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    -- Triggers are only created when missing: (re)creating one locks its table
+    -- exclusively, which would stall live traffic on every worker start
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgrelid = 'item_master'::regclass AND tgname = 'trg_item_master_notify'
+        ) THEN
+            CREATE TRIGGER trg_item_master_notify AFTER INSERT OR UPDATE OR DELETE ON item_master
+                FOR EACH ROW EXECUTE FUNCTION notify_item_change();
+        END IF;
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgrelid = 'item_category_mapping'::regclass AND tgname = 'trg_item_category_mapping_notify'
+        ) THEN
+            CREATE TRIGGER trg_item_category_mapping_notify AFTER INSERT OR UPDATE OR DELETE ON item_category_mapping
+                FOR EACH ROW EXECUTE FUNCTION notify_item_change();
+        END IF;
+    END;
+    $$;
+
+    -- Reference data bundle invalidation: any write to a lookup table is announced
+    -- on the reference_changes channel with the table name as payload
+    CREATE OR REPLACE FUNCTION notify_reference_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('reference_changes', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    DO $$
+    DECLARE
+        ref_table TEXT;
+    BEGIN
+        FOREACH ref_table IN ARRAY ARRAY[
+            'bp_type_ref', 'bp_group_ref', 'item_group', 'uom', 'item_cat', 'item_type', 'whs',
+            'tax_master', 'shift_master', 'division_master', 'bank_master',
+            'department_master', 'designation_master', 'bus_route'
+        ] LOOP
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_trigger
+                WHERE tgrelid = ref_table::regclass AND tgname = format('trg_%s_reference_notify', ref_table)
+            ) THEN
+                EXECUTE format(
+                    'CREATE TRIGGER trg_%s_reference_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+                    'FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change()',
+                    ref_table, ref_table
+                );
+            END IF;
+        END LOOP;
+    END;
+    $$;
+
+    -- One row per archived posting period; cutoff is the first instant still held
+    -- in the live ledger partitions
+    CREATE TABLE IF NOT EXISTS stock_ledger_archive (
+        period_id INTEGER PRIMARY KEY,
+        cutoff TIMESTAMP NOT NULL,
+        partitions TEXT[] NOT NULL DEFAULT '{}',
+        opening_rows INTEGER NOT NULL DEFAULT 0,
+        archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Trigram indexes for substring search on item code/name. Kept apart from SCHEMA_DDL
+# because pg_trgm may not be installable; search still works without them, just slower.
+# Ledger indexes matching the (trans_date, trans_id) keyset order of the list endpoints,
+# with and without the item/warehouse equality filters. idx_stock_trans_item_key_date_id
+# keys rows the way balances are (no warehouse = 0), for the per-key running balance
+# lookups that filter on COALESCE(warehouse_id, 0). The ledger is large, so these are
+# built with CREATE INDEX CONCURRENTLY by build_stock_ledger_indexes, not in SCHEMA_DDL.
+STOCK_LEDGER_INDEXES = {
+    'idx_stock_trans_date_id': "trans_date DESC, trans_id DESC",
+    'idx_stock_trans_item_whs_date_id': "item_id, warehouse_id, trans_date DESC, trans_id DESC",
+    'idx_stock_trans_item_key_date_id': "item_id, (COALESCE(warehouse_id, 0)), trans_date DESC, trans_id DESC",
+    'idx_stock_trans_whs_date_id': "warehouse_id, trans_date DESC, trans_id DESC",
+}
+
+stock_index_task = None
+
+async def create_index_concurrently(connection, name: str, table: str, columns: str):
+    # A concurrent build that failed leaves an invalid index behind; drop it and rebuild
+    valid = await connection.fetchval(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1);", name
+    )
+    if valid:
+        return
+    if valid is not None:
+        await connection.execute(f"DROP INDEX CONCURRENTLY {name};")
+    await connection.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} ({columns});")
+
+async def build_stock_ledger_indexes():
+    # Runs after startup on its own connection, outside any transaction. Writes carry on
+    # during the builds; one worker builds while the others skip.
+    try:
+        async with pool.acquire() as connection:
+            if not await connection.fetchval("SELECT pg_try_advisory_lock(hashtext('stock_ledger_indexes'));"):
+                return
+            try:
+                partitions = []
+                if await stock_ledger_is_partitioned(connection):
+                    partitions = [r['relname'] for r in await connection.fetch("""
+                        SELECT c.relname FROM pg_inherits i
+                        JOIN pg_class c ON i.inhrelid = c.oid
+                        WHERE i.inhparent = 'stock_transactions'::regclass
+                        ORDER BY c.relname;
+                    """)]
+                for name, columns in STOCK_LEDGER_INDEXES.items():
+                    if not partitions:
+                        await create_index_concurrently(connection, name, 'stock_transactions', columns)
+                        continue
+                    # Partitioned indexes cannot be built concurrently: create the parent
+                    # index on the parent alone, build each partition's concurrently and
+                    # attach it; the parent index turns valid once all are attached
+                    await connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY stock_transactions ({columns});")
+                    for partition in partitions:
+                        child = f"{partition}_{name[len('idx_'):]}"
+                        await create_index_concurrently(connection, child, partition, columns)
+                        await connection.execute(f"ALTER INDEX {name} ATTACH PARTITION {child};")
+            finally:
+                await connection.execute("SELECT pg_advisory_unlock(hashtext('stock_ledger_indexes'));")
+    except Exception as e:
+        print(f"Error building stock ledger indexes: {e}")
+
+ITEM_SEARCH_DDL = """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS idx_item_master_code_trgm ON item_master USING gin (it_code gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS idx_item_master_name_trgm ON item_master USING gin (it_name gin_trgm_ops);
+"""
+
 # Event handler for when the application starts up
 @api_router.on_event("startup")
 async def startup_event():
-    global pool
+    global pool, attachment_cleanup_task, stock_partition_task, stock_valuation_task, stock_index_task
     try:
         pool = await asyncpg.create_pool(os.getenv('DATABASE_URL'))
         print("Successfully connected to the database.")
     except Exception as e:
         print(f"Error connecting to database: {e}")
+        return
+    
+    # Each step is isolated so that one failing does not skip the ones after it
+    async with pool.acquire() as connection:
+        try:
+            async with connection.transaction():
+                # Workers starting together apply the schema one at a time
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext('schema_ddl'));")
+                await connection.execute(SCHEMA_DDL)
+        except Exception as e:
+            print(f"Error creating supporting tables: {e}")
+        try:
+            seeded = await seed_stock_balance(connection)
+            if seeded:
+                print(f"Seeded stock balances for {seeded} item/warehouse keys from the ledger.")
+                stock_valuation_task = asyncio.get_event_loop().create_task(rebuild_seeded_stock_valuations())
+        except Exception as e:
+            print(f"Error seeding stock balances: {e}")
+        try:
+            await connection.execute(ITEM_SEARCH_DDL)
+        except Exception as e:
+            print(f"Item search indexes not created: {e}")
+        try:
+            await build_item_suggest_index(connection)
+        except Exception as e:
+            print(f"Error building item search index: {e}")
+    if not await start_item_change_listener():
+        schedule_item_listener_reconnect()
+    attachment_cleanup_task = asyncio.get_event_loop().create_task(run_attachment_upload_cleanup())
+    stock_partition_task = asyncio.get_event_loop().create_task(run_stock_ledger_partition_maintenance())
+    stock_index_task = asyncio.get_event_loop().create_task(build_stock_ledger_indexes())
 
 # Event handler for when the application shuts down
 @api_router.on_event("shutdown")
 async def shutdown_event():
     global pool
+    if item_listener_reconnect:
+        item_listener_reconnect.cancel()
+    if attachment_cleanup_task:
+        attachment_cleanup_task.cancel()
+    if stock_partition_task:
+        stock_partition_task.cancel()
+    if stock_valuation_task:
+        stock_valuation_task.cancel()
+    if stock_index_task:
+        stock_index_task.cancel()
+    if item_change_listener and not item_change_listener.is_closed():
+        # Closing on purpose is not a disconnect to recover from
+        item_change_listener.remove_termination_listener(on_item_listener_closed)
+        await item_change_listener.close()
     if pool:
         await pool.close()
         print("Database connection closed.")
@@ -747,13 +1247,94 @@ async def get_bp_groups():
         records = await conn.fetch("SELECT * FROM bp_group_ref ORDER BY bpgroup_name;")
         return [dict(r) for r in records]
 
+# Master data cache
+# Shift, division, bank, department, designation, bus route and tax code lists are read
+# far more often than they change. The full list per table is cached in memory and
+# dropped by the matching create/update/delete handlers (and, through the
+# reference_changes listener, by writes from other workers); MASTER_CACHE_TTL bounds
+# staleness if a notification is missed. Concurrent misses share one query.
+MASTER_CACHE_TTL = timedelta(seconds=int(os.getenv('MASTER_CACHE_TTL', '300')))
+MASTER_CACHE_QUERIES = {
+    'shift_master': "SELECT * FROM shift_master ORDER BY shift_id;",
+    'division_master': "SELECT * FROM division_master ORDER BY divn_id;",
+    'bank_master': "SELECT * FROM bank_master ORDER BY bank_id;",
+    'department_master': "SELECT * FROM department_master ORDER BY dept_id;",
+    'designation_master': "SELECT * FROM designation_master ORDER BY des_id;",
+    'bus_route': "SELECT * FROM bus_route ORDER BY route_id;",
+    'tax_master': "SELECT tax_id, tax_code, tax_name, tax_rate FROM tax_master WHERE is_active = true ORDER BY tax_rate;",
+}
+
+master_cache = {}
+master_cache_loads = {}
+master_cache_stats = {
+    table: {'hits': 0, 'misses': 0, 'coalesced': 0, 'queries': 0, 'invalidations': 0, 'expirations': 0}
+    for table in MASTER_CACHE_QUERIES
+}
+
+def invalidate_master_data(table: str):
+    if table not in MASTER_CACHE_QUERIES:
+        return
+    # A load already in flight may have read the old rows; later callers start a new one
+    master_cache_loads.pop(table, None)
+    if master_cache.pop(table, None):
+        master_cache_stats[table]['invalidations'] += 1
+
+async def load_master_data(table: str):
+    try:
+        async with pool.acquire() as connection:
+            rows = [dict(r) for r in await connection.fetch(MASTER_CACHE_QUERIES[table])]
+        master_cache_stats[table]['queries'] += 1
+        # Only cache if no invalidation replaced this load while it was running
+        if master_cache_loads.get(table) is asyncio.current_task():
+            master_cache[table] = {'rows': rows, 'loaded_at': datetime.now()}
+        return rows
+    finally:
+        if master_cache_loads.get(table) is asyncio.current_task():
+            del master_cache_loads[table]
+
+async def get_master_data(table: str):
+    stats = master_cache_stats[table]
+    entry = master_cache.get(table)
+    if entry:
+        if datetime.now() - entry['loaded_at'] < MASTER_CACHE_TTL:
+            stats['hits'] += 1
+            return entry['rows']
+        master_cache.pop(table, None)
+        stats['expirations'] += 1
+    load = master_cache_loads.get(table)
+    if load:
+        stats['coalesced'] += 1
+    else:
+        stats['misses'] += 1
+        load = master_cache_loads[table] = asyncio.ensure_future(load_master_data(table))
+    # Shielded so one cancelled request does not cancel the query for the others waiting on it
+    return await asyncio.shield(load)
+
+@api_router.get("/master-cache/stats")
+async def get_master_cache_stats():
+    tables = {}
+    for table, stats in master_cache_stats.items():
+        entry = master_cache.get(table)
+        requests = stats['hits'] + stats['coalesced'] + stats['misses']
+        tables[table] = {
+            **stats,
+            "queries_saved": stats['hits'] + stats['coalesced'],
+            "hit_ratio": round((stats['hits'] + stats['coalesced']) / requests, 4) if requests else None,
+            "cached_rows": len(entry['rows']) if entry else None,
+            "age_seconds": round((datetime.now() - entry['loaded_at']).total_seconds(), 1) if entry else None
+        }
+    return {
+        "ttl_seconds": MASTER_CACHE_TTL.total_seconds(),
+        "queries_saved": sum(t['queries_saved'] for t in tables.values()),
+        "queries": sum(t['queries'] for t in tables.values()),
+        "tables": tables
+    }
+
 # SHIFT ENDPOINTS
 @api_router.get("/shifts", response_model=List[ShiftResponse])
 async def get_shifts():
     try:
-        async with pool.acquire() as connection:
-            shifts = await connection.fetch("SELECT * FROM shift_master ORDER BY shift_id;")
-            return [dict(shift) for shift in shifts]
+        return await get_master_data('shift_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching shifts: {str(e)}")
 
@@ -766,6 +1347,7 @@ async def create_shift(shift: ShiftCreate):
                 VALUES ($1, $2, $3) RETURNING *;
             """
             result = await connection.fetchrow(query, shift.shift_name, shift.shift_start, shift.shift_end)
+            invalidate_master_data('shift_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating shift: {str(e)}")
@@ -782,6 +1364,7 @@ async def update_shift(shift_id: int, shift: ShiftCreate):
             result = await connection.fetchrow(query, shift.shift_name, shift.shift_start, shift.shift_end, shift_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Shift not found")
+            invalidate_master_data('shift_master')
             return dict(result)
     except HTTPException:
         raise
@@ -795,6 +1378,7 @@ async def delete_shift(shift_id: int):
             result = await connection.execute("DELETE FROM shift_master WHERE shift_id = $1;", shift_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Shift not found")
+            invalidate_master_data('shift_master')
             return {"message": "Shift deleted successfully"}
     except HTTPException:
         raise
@@ -805,9 +1389,7 @@ async def delete_shift(shift_id: int):
 @api_router.get("/divisions", response_model=List[DivisionResponse])
 async def get_divisions():
     try:
-        async with pool.acquire() as connection:
-            divisions = await connection.fetch("SELECT * FROM division_master ORDER BY divn_id;")
-            return [dict(division) for division in divisions]
+        return await get_master_data('division_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching divisions: {str(e)}")
 
@@ -817,6 +1399,7 @@ async def create_division(division: DivisionCreate):
         async with pool.acquire() as connection:
             query = "INSERT INTO division_master (divn_name) VALUES ($1) RETURNING *;"
             result = await connection.fetchrow(query, division.divn_name)
+            invalidate_master_data('division_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating division: {str(e)}")
@@ -829,6 +1412,7 @@ async def update_division(divn_id: int, division: DivisionCreate):
             result = await connection.fetchrow(query, division.divn_name, divn_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Division not found")
+            invalidate_master_data('division_master')
             return dict(result)
     except HTTPException:
         raise
@@ -842,6 +1426,7 @@ async def delete_division(divn_id: int):
             result = await connection.execute("DELETE FROM division_master WHERE divn_id = $1;", divn_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Division not found")
+            invalidate_master_data('division_master')
             return {"message": "Division deleted successfully"}
     except HTTPException:
         raise
@@ -852,9 +1437,7 @@ async def delete_division(divn_id: int):
 @api_router.get("/banks", response_model=List[BankResponse])
 async def get_banks():
     try:
-        async with pool.acquire() as connection:
-            banks = await connection.fetch("SELECT * FROM bank_master ORDER BY bank_id;")
-            return [dict(bank) for bank in banks]
+        return await get_master_data('bank_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching banks: {str(e)}")
 
@@ -867,6 +1450,7 @@ async def create_bank(bank: BankCreate):
                 VALUES ($1, $2, $3) RETURNING *;
             """
             result = await connection.fetchrow(query, bank.country_code, bank.bank_code, bank.bank_name)
+            invalidate_master_data('bank_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating bank: {str(e)}")
@@ -883,6 +1467,7 @@ async def update_bank(bank_id: int, bank: BankCreate):
             result = await connection.fetchrow(query, bank.country_code, bank.bank_code, bank.bank_name, bank_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Bank not found")
+            invalidate_master_data('bank_master')
             return dict(result)
     except HTTPException:
         raise
@@ -896,6 +1481,7 @@ async def delete_bank(bank_id: int):
             result = await connection.execute("DELETE FROM bank_master WHERE bank_id = $1;", bank_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Bank not found")
+            invalidate_master_data('bank_master')
             return {"message": "Bank deleted successfully"}
     except HTTPException:
         raise
@@ -906,9 +1492,7 @@ async def delete_bank(bank_id: int):
 @api_router.get("/departments", response_model=List[DepartmentResponse])
 async def get_departments():
     try:
-        async with pool.acquire() as connection:
-            departments = await connection.fetch("SELECT * FROM department_master ORDER BY dept_id;")
-            return [dict(dept) for dept in departments]
+        return await get_master_data('department_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching departments: {str(e)}")
 
@@ -918,6 +1502,7 @@ async def create_department(department: DepartmentCreate):
         async with pool.acquire() as connection:
             query = "INSERT INTO department_master (dept_name) VALUES ($1) RETURNING *;"
             result = await connection.fetchrow(query, department.dept_name)
+            invalidate_master_data('department_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating department: {str(e)}")
@@ -930,6 +1515,7 @@ async def update_department(dept_id: int, department: DepartmentCreate):
             result = await connection.fetchrow(query, department.dept_name, dept_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Department not found")
+            invalidate_master_data('department_master')
             return dict(result)
     except HTTPException:
         raise
@@ -943,6 +1529,7 @@ async def delete_department(dept_id: int):
             result = await connection.execute("DELETE FROM department_master WHERE dept_id = $1;", dept_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Department not found")
+            invalidate_master_data('department_master')
             return {"message": "Department deleted successfully"}
     except HTTPException:
         raise
@@ -953,9 +1540,7 @@ async def delete_department(dept_id: int):
 @api_router.get("/designations", response_model=List[DesignationResponse])
 async def get_designations():
     try:
-        async with pool.acquire() as connection:
-            designations = await connection.fetch("SELECT * FROM designation_master ORDER BY des_id;")
-            return [dict(des) for des in designations]
+        return await get_master_data('designation_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching designations: {str(e)}")
 
@@ -965,6 +1550,7 @@ async def create_designation(designation: DesignationCreate):
         async with pool.acquire() as connection:
             query = "INSERT INTO designation_master (des_name) VALUES ($1) RETURNING *;"
             result = await connection.fetchrow(query, designation.des_name)
+            invalidate_master_data('designation_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating designation: {str(e)}")
@@ -977,6 +1563,7 @@ async def update_designation(des_id: int, designation: DesignationCreate):
             result = await connection.fetchrow(query, designation.des_name, des_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Designation not found")
+            invalidate_master_data('designation_master')
             return dict(result)
     except HTTPException:
         raise
@@ -990,6 +1577,7 @@ async def delete_designation(des_id: int):
             result = await connection.execute("DELETE FROM designation_master WHERE des_id = $1;", des_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Designation not found")
+            invalidate_master_data('designation_master')
             return {"message": "Designation deleted successfully"}
     except HTTPException:
         raise
@@ -1185,9 +1773,7 @@ async def delete_employee(emp_id: int):
 @api_router.get("/divisions", response_model=List[DivisionResponse])
 async def get_divisions():
     try:
-        async with pool.acquire() as connection:
-            divisions = await connection.fetch("SELECT * FROM division_master ORDER BY divn_id;")
-            return [dict(division) for division in divisions]
+        return await get_master_data('division_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching divisions: {str(e)}")
 
@@ -1197,6 +1783,7 @@ async def create_division(division: DivisionCreate):
         async with pool.acquire() as connection:
             query = "INSERT INTO division_master (divn_name) VALUES ($1) RETURNING *;"
             result = await connection.fetchrow(query, division.divn_name)
+            invalidate_master_data('division_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating division: {str(e)}")
@@ -1209,6 +1796,7 @@ async def update_division(divn_id: int, division: DivisionCreate):
             result = await connection.fetchrow(query, division.divn_name, divn_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Division not found")
+            invalidate_master_data('division_master')
             return dict(result)
     except HTTPException:
         raise
@@ -1222,6 +1810,7 @@ async def delete_division(divn_id: int):
             result = await connection.execute("DELETE FROM division_master WHERE divn_id = $1;", divn_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Division not found")
+            invalidate_master_data('division_master')
             return {"message": "Division deleted successfully"}
     except HTTPException:
         raise
@@ -1232,9 +1821,7 @@ async def delete_division(divn_id: int):
 @api_router.get("/banks", response_model=List[BankResponse])
 async def get_banks():
     try:
-        async with pool.acquire() as connection:
-            banks = await connection.fetch("SELECT * FROM bank_master ORDER BY bank_id;")
-            return [dict(bank) for bank in banks]
+        return await get_master_data('bank_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching banks: {str(e)}")
 
@@ -1247,6 +1834,7 @@ async def create_bank(bank: BankCreate):
                 VALUES ($1, $2, $3) RETURNING *;
             """
             result = await connection.fetchrow(query, bank.country_code, bank.bank_code, bank.bank_name)
+            invalidate_master_data('bank_master')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating bank: {str(e)}")
@@ -1263,6 +1851,7 @@ async def update_bank(bank_id: int, bank: BankCreate):
             result = await connection.fetchrow(query, bank.country_code, bank.bank_code, bank.bank_name, bank_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Bank not found")
+            invalidate_master_data('bank_master')
             return dict(result)
     except HTTPException:
         raise
@@ -1276,6 +1865,7 @@ async def delete_bank(bank_id: int):
             result = await connection.execute("DELETE FROM bank_master WHERE bank_id = $1;", bank_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Bank not found")
+            invalidate_master_data('bank_master')
             return {"message": "Bank deleted successfully"}
     except HTTPException:
         raise
@@ -1286,9 +1876,7 @@ async def delete_bank(bank_id: int):
 @api_router.get("/bus-routes", response_model=List[BusRouteResponse])
 async def get_bus_routes():
     try:
-        async with pool.acquire() as connection:
-            routes = await connection.fetch("SELECT * FROM bus_route ORDER BY route_id;")
-            return [dict(route) for route in routes]
+        return await get_master_data('bus_route')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching bus routes: {str(e)}")
 
@@ -1301,6 +1889,7 @@ async def create_bus_route(route: BusRouteCreate):
                 VALUES ($1, $2) RETURNING *;
             """
             result = await connection.fetchrow(query, route.route_name, route.route_number)
+            invalidate_master_data('bus_route')
             return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating bus route: {str(e)}")
@@ -1317,6 +1906,7 @@ async def update_bus_route(route_id: int, route: BusRouteCreate):
             result = await connection.fetchrow(query, route.route_name, route.route_number, route_id)
             if not result:
                 raise HTTPException(status_code=404, detail="Bus route not found")
+            invalidate_master_data('bus_route')
             return dict(result)
     except HTTPException:
         raise
@@ -1330,6 +1920,7 @@ async def delete_bus_route(route_id: int):
             result = await connection.execute("DELETE FROM bus_route WHERE route_id = $1;", route_id)
             if result == "DELETE 0":
                 raise HTTPException(status_code=404, detail="Bus route not found")
+            invalidate_master_data('bus_route')
             return {"message": "Bus route deleted successfully"}
     except HTTPException:
         raise
@@ -1413,6 +2004,137 @@ async def delete_bus_route_stop(stop_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting bus route stop: {str(e)}")
 
+# BULK UPSERT ENDPOINTS
+# POST /<master>/bulk takes an array of rows; rows carrying their id update that row,
+# the rest are inserted. The whole array is validated before anything is written, so
+# a single bad row rejects the request with every row's error. Ids for new rows are
+# taken from the sequence up front, which lets one INSERT ... ON CONFLICT (id) statement
+# apply the batch and the results be matched back to the request by id.
+MASTER_BULK_LIMIT = 5000
+MASTER_BULK_SPECS = {
+    'departments': ('department_master', 'dept_id', DepartmentCreate, ['dept_name']),
+    'designations': ('designation_master', 'des_id', DesignationCreate, ['des_name']),
+    'shifts': ('shift_master', 'shift_id', ShiftCreate, ['shift_name', 'shift_start', 'shift_end']),
+    'divisions': ('division_master', 'divn_id', DivisionCreate, ['divn_name']),
+    'banks': ('bank_master', 'bank_id', BankCreate, ['country_code', 'bank_code', 'bank_name']),
+    'bus-routes': ('bus_route', 'route_id', BusRouteCreate, ['route_name', 'route_number']),
+    'bus-route-stops': ('bus_route_stop', 'stop_id', BusRouteStopCreate, ['route_id', 'stop_name', 'display_order']),
+}
+
+async def bulk_upsert_master(master: str, rows: List[Dict[str, Any]]):
+    table, id_column, model, columns = MASTER_BULK_SPECS[master]
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows provided")
+    if len(rows) > MASTER_BULK_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {MASTER_BULK_LIMIT} rows per request")
+    
+    errors = []
+    parsed = []
+    seen_ids = set()
+    for index, row in enumerate(rows):
+        try:
+            record = model(**row)
+            row_id = row.get(id_column)
+            if row_id is not None:
+                row_id = int(row_id)
+                if row_id in seen_ids:
+                    raise ValueError(f"{id_column} {row_id} appears more than once")
+                seen_ids.add(row_id)
+            parsed.append((index, row_id, {column: getattr(record, column) for column in columns}))
+        except Exception as e:
+            errors.append({"index": index, "error": str(e)})
+    
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                if seen_ids:
+                    # Locked so a concurrent delete cannot turn an update into an insert
+                    existing = await connection.fetch(
+                        f"SELECT {id_column} FROM {table} WHERE {id_column} = ANY($1::int[]) FOR UPDATE;",
+                        list(seen_ids)
+                    )
+                    existing = {r[id_column] for r in existing}
+                    for index, row_id, _ in parsed:
+                        if row_id is not None and row_id not in existing:
+                            errors.append({"index": index, "error": f"{id_column} {row_id} does not exist"})
+                if master == 'bus-route-stops':
+                    route_ids = list({values['route_id'] for _, _, values in parsed})
+                    routes = await connection.fetch(
+                        "SELECT route_id FROM bus_route WHERE route_id = ANY($1::int[]) FOR SHARE;", route_ids
+                    )
+                    routes = {r['route_id'] for r in routes}
+                    for index, _, values in parsed:
+                        if values['route_id'] not in routes:
+                            errors.append({"index": index, "error": f"Bus route with ID {values['route_id']} does not exist"})
+                if errors:
+                    raise HTTPException(
+                        status_code=422,
+                        detail={"message": "No rows were saved", "errors": sorted(errors, key=lambda e: e['index'])}
+                    )
+                
+                new_ids = await connection.fetch(
+                    f"SELECT nextval(pg_get_serial_sequence('{table}', '{id_column}')) AS id FROM generate_series(1, $1);",
+                    sum(1 for _, row_id, _ in parsed if row_id is None)
+                )
+                new_ids = iter(r['id'] for r in new_ids)
+                batch = []
+                results = []
+                for index, row_id, values in parsed:
+                    action = "updated" if row_id is not None else "created"
+                    row_id = row_id if row_id is not None else next(new_ids)
+                    batch.append({id_column: row_id, **values})
+                    results.append({"index": index, "action": action, id_column: row_id})
+                
+                column_list = ", ".join([id_column] + columns)
+                updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+                records = await connection.fetch(f"""
+                    INSERT INTO {table} ({column_list})
+                    SELECT {column_list} FROM jsonb_populate_recordset(NULL::{table}, $1::jsonb)
+                    ON CONFLICT ({id_column}) DO UPDATE SET {updates}
+                    RETURNING *;
+                """, json.dumps(jsonable_encoder(batch)))
+        invalidate_master_data(table)
+        records = {r[id_column]: dict(r) for r in records}
+        for result in results:
+            result["record"] = records[result[id_column]]
+        return {
+            "created": sum(1 for r in results if r["action"] == "created"),
+            "updated": sum(1 for r in results if r["action"] == "updated"),
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error saving {master.replace('-', ' ')}: {str(e)}")
+
+@api_router.post("/departments/bulk")
+async def bulk_upsert_departments(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('departments', rows)
+
+@api_router.post("/designations/bulk")
+async def bulk_upsert_designations(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('designations', rows)
+
+@api_router.post("/shifts/bulk")
+async def bulk_upsert_shifts(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('shifts', rows)
+
+@api_router.post("/divisions/bulk")
+async def bulk_upsert_divisions(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('divisions', rows)
+
+@api_router.post("/banks/bulk")
+async def bulk_upsert_banks(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('banks', rows)
+
+@api_router.post("/bus-routes/bulk")
+async def bulk_upsert_bus_routes(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('bus-routes', rows)
+
+@api_router.post("/bus-route-stops/bulk")
+async def bulk_upsert_bus_route_stops(rows: List[Dict[str, Any]]):
+    return await bulk_upsert_master('bus-route-stops', rows)
+
 # GATE PASS ENDPOINTS
 @api_router.get("/gate-passes", response_model=List[GatePassResponse])
 async def get_gate_passes():
@@ -3169,102 +3891,545 @@ async def get_warehouses():
         records = await conn.fetch("SELECT * FROM whs ORDER BY whs_name;")
         return [dict(r) for r in records]
 
+# Reference data bundle
+# All lookup tables in one response, served from a JSON snapshot held in memory.
+# Triggers on the underlying tables notify reference_changes, which marks the snapshot
+# stale; it is rebuilt on the next request. Without the change listener the snapshot
+# is trusted for at most REFERENCE_SNAPSHOT_MAX_AGE. The ETag is the SHA-256 of the
+# payload, so clients revalidate with If-None-Match and get 304 while nothing changed.
+REFERENCE_QUERIES = {
+    'bp_types': "SELECT * FROM bp_type_ref ORDER BY bptype_name;",
+    'bp_groups': "SELECT * FROM bp_group_ref ORDER BY bpgroup_name;",
+    'item_groups': "SELECT * FROM item_group ORDER BY grp_name;",
+    'uoms': "SELECT * FROM uom ORDER BY uom_name;",
+    'item_categories': "SELECT * FROM item_cat ORDER BY cat_name;",
+    'item_types': "SELECT * FROM item_type ORDER BY type_name;",
+    'warehouses': "SELECT * FROM whs ORDER BY whs_name;",
+    'tax_codes': "SELECT tax_id, tax_code, tax_name, tax_rate FROM tax_master WHERE is_active = true ORDER BY tax_rate;",
+    'shifts': "SELECT * FROM shift_master ORDER BY shift_id;",
+    'divisions': "SELECT * FROM division_master ORDER BY divn_id;",
+    'banks': "SELECT * FROM bank_master ORDER BY bank_id;",
+    'departments': "SELECT * FROM department_master ORDER BY dept_id;",
+    'designations': "SELECT * FROM designation_master ORDER BY des_id;",
+}
+REFERENCE_SNAPSHOT_MAX_AGE = timedelta(seconds=30)
+
+reference_snapshot = {'payload': None, 'etag': None, 'built_at': None, 'stale': True}
+reference_snapshot_lock = asyncio.Lock()
+
+def on_reference_change(connection, pid, channel, payload):
+    reference_snapshot['stale'] = True
+    invalidate_master_data(payload)
+
+async def get_reference_snapshot():
+    def usable():
+        if reference_snapshot['payload'] is None or reference_snapshot['stale']:
+            return False
+        return item_cache_stats['listening'] or datetime.now() - reference_snapshot['built_at'] < REFERENCE_SNAPSHOT_MAX_AGE
+    
+    if not usable():
+        # Concurrent requests wait for a single rebuild
+        async with reference_snapshot_lock:
+            if not usable():
+                # Cleared first so a change notified during the rebuild triggers another one
+                reference_snapshot['stale'] = False
+                try:
+                    async with pool.acquire() as connection:
+                        data = {key: [dict(r) for r in await connection.fetch(query)] for key, query in REFERENCE_QUERIES.items()}
+                except Exception:
+                    # The old payload must not pass for fresh after a failed rebuild
+                    reference_snapshot['stale'] = True
+                    raise
+                payload = json.dumps(jsonable_encoder(data), separators=(',', ':')).encode()
+                reference_snapshot.update(
+                    payload=payload,
+                    etag=f'"{hashlib.sha256(payload).hexdigest()}"',
+                    built_at=datetime.now()
+                )
+    return reference_snapshot['payload'], reference_snapshot['etag']
+
+@api_router.get("/reference-data")
+async def get_reference_data(request: Request):
+    try:
+        payload, etag = await get_reference_snapshot()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get('if-none-match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            return Response(status_code=304, headers=headers)
+        return Response(content=payload, media_type="application/json", headers=headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching reference data: {str(e)}")
+
 # Item Master CRUD endpoints
+# Stock total and per-warehouse breakdown of one item
+ITEM_STOCK_SUMMARY = """
+    SELECT
+        SUM(s.balance_qty) as current_stock,
+        jsonb_agg(jsonb_build_object(
+            'warehouse_id', s.warehouse_id,
+            'whs_name', w.whs_name,
+            'balance_qty', s.balance_qty
+        ) ORDER BY s.warehouse_id) as warehouse_stock
+    FROM stock_balance s
+    LEFT JOIN whs w ON s.warehouse_id = w.whs_id
+    WHERE s.item_id = {item_id}
+"""
+
+# Item rows with lookup names, stock totals with a per-warehouse breakdown, and
+# categories. Stock and categories come from lateral subqueries on each item, so the
+# cost follows the number of items returned rather than the size of the catalogue.
+# {items} is the item_master relation to read from, e.g. one filtered page.
+ITEM_SELECT = """
+    SELECT 
+        im.it_id,
+        im.it_code,
+        im.it_name,
+        im.it_details,
+        im.it_group,
+        im.it_uom,
+        im.it_type,
+        im.it_mfg,
+        im.it_hsn,
+        im.it_whs,
+        im.it_moq,
+        im.it_min,
+        im.it_max,
+        im.it_lead,
+        im.it_status,
+        im.it_remark,
+        im.it_attach,
+        ig.grp_name as group_name,
+        uom.uom_name,
+        it.type_name,
+        wr.whs_name,
+        COALESCE(sb.current_stock, 0) as current_stock,
+        COALESCE(sb.warehouse_stock, '[]'::jsonb) as warehouse_stock,
+        cat.category_names,
+        cat.category_ids
+    FROM {items} im
+    LEFT JOIN item_group ig ON im.it_group = ig.grp_id
+    LEFT JOIN uom uom ON im.it_uom = uom.uom_id
+    LEFT JOIN item_type it ON im.it_type = it.type_id
+    LEFT JOIN whs wr ON im.it_whs = wr.whs_id
+    LEFT JOIN LATERAL (""" + ITEM_STOCK_SUMMARY.format(item_id="im.it_id") + """) sb ON true
+    CROSS JOIN LATERAL (
+        SELECT
+            COALESCE(ARRAY_AGG(ic.cat_name ORDER BY ic.cat_id), ARRAY[]::text[]) as category_names,
+            COALESCE(ARRAY_AGG(ic.cat_id ORDER BY ic.cat_id), ARRAY[]::int[]) as category_ids
+        FROM item_category_mapping icm
+        JOIN item_cat ic ON icm.category_id = ic.cat_id
+        WHERE icm.item_id = im.it_id
+    ) cat
+"""
+
+def item_record_to_dict(record):
+    item = dict(record)
+    item['warehouse_stock'] = json.loads(item['warehouse_stock'])
+    return item
+
+# Items ordered by it_code. Keyset pagination: pass the it_code and it_id of the last
+# item on a page as after_code/after_id for the next one. Without a limit the whole
+# filtered catalogue is returned, which the entry form dropdowns rely on.
 @api_router.get("/items", response_model=List[ItemMasterResponse])
-async def get_items():
+async def get_items(
+    search: Optional[str] = None,
+    it_group: Optional[int] = None,
+    it_type: Optional[int] = None,
+    it_status: Optional[str] = None,
+    category_id: Optional[int] = None,
+    it_whs: Optional[int] = None,
+    after_code: Optional[str] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None
+):
     try:
         async with pool.acquire() as connection:
-            query = """
-                SELECT 
-                    im.it_id,
-                    im.it_code,
-                    im.it_name,
-                    im.it_details,
-                    im.it_group,
-                    im.it_uom,
-                    im.it_type,
-                    im.it_mfg,
-                    im.it_hsn,
-                    im.it_whs,
-                    im.it_moq,
-                    im.it_min,
-                    im.it_max,
-                    im.it_lead,
-                    im.it_status,
-                    im.it_remark,
-                    im.it_attach,
-                    ig.grp_name as group_name,
-                    uom.uom_name,
-                    it.type_name,
-                    wr.whs_name,
-                    0 as current_stock,
-                    COALESCE(ARRAY_AGG(ic.cat_name) FILTER (WHERE ic.cat_name IS NOT NULL), ARRAY[]::text[]) as category_names,
-                    COALESCE(ARRAY_AGG(ic.cat_id) FILTER (WHERE ic.cat_id IS NOT NULL), ARRAY[]::int[]) as category_ids
-                FROM item_master im
-                LEFT JOIN item_group ig ON im.it_group = ig.grp_id
-                LEFT JOIN uom uom ON im.it_uom = uom.uom_id
-                LEFT JOIN item_category_mapping icm ON im.it_id = icm.item_id
-                LEFT JOIN item_cat ic ON icm.category_id = ic.cat_id
-                LEFT JOIN item_type it ON im.it_type = it.type_id
-                LEFT JOIN whs wr ON im.it_whs = wr.whs_id
-                GROUP BY im.it_id, im.it_code, im.it_name, im.it_details, im.it_group, im.it_uom, 
-                         im.it_type, im.it_mfg, im.it_hsn, im.it_whs, im.it_moq, im.it_min, 
-                         im.it_max, im.it_lead, im.it_status, im.it_remark, im.it_attach,
-                         ig.grp_name, uom.uom_name, it.type_name, wr.whs_name
-                ORDER BY im.it_code;
-            """
-            records = await connection.fetch(query)
-            return [dict(r) for r in records]
+            params = []
+            clauses = []
+            if search:
+                params.append(f"%{search.strip()}%")
+                clauses.append(f"(im.it_code ILIKE ${len(params)} OR im.it_name ILIKE ${len(params)})")
+            for column, value in (('it_group', it_group), ('it_type', it_type), ('it_status', it_status), ('it_whs', it_whs)):
+                if value is not None:
+                    params.append(value)
+                    clauses.append(f"im.{column} = ${len(params)}")
+            if category_id:
+                params.append(category_id)
+                clauses.append(f"""EXISTS (
+                    SELECT 1 FROM item_category_mapping f
+                    WHERE f.item_id = im.it_id AND f.category_id = ${len(params)}
+                )""")
+            if after_code is not None and after_id is not None:
+                params.extend([after_code, after_id])
+                clauses.append(f"(im.it_code, im.it_id) > (${len(params) - 1}, ${len(params)})")
+            
+            page = "SELECT * FROM item_master im"
+            if clauses:
+                page += " WHERE " + " AND ".join(clauses)
+            page += " ORDER BY im.it_code, im.it_id"
+            if limit:
+                params.append(limit)
+                page += f" LIMIT ${len(params)}"
+            
+            query = ITEM_SELECT.format(items=f"({page})") + " ORDER BY im.it_code, im.it_id;"
+            records = await connection.fetch(query, *params)
+            return [item_record_to_dict(r) for r in records]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching items: {str(e)}")
 
+# Item cache
+# Read-through LRU of item rows (without stock, which changes with every posting) keyed
+# by it_id, with an it_code lookup on top. Each worker keeps its own cache and LISTENs
+# on item_changes, which triggers on item_master and item_category_mapping notify, so
+# a change made through any worker evicts the item everywhere. If the listener
+# connection drops the cache is cleared and bypassed, since it can no longer be trusted,
+# and the listener reconnects with exponential backoff.
+ITEM_CACHE_SIZE = int(os.getenv('ITEM_CACHE_SIZE', '5000'))
+ITEM_SUGGEST_REBUILD_THRESHOLD = 500  # Changed items above which the typeahead index is rebuilt
+ITEM_LISTENER_MAX_BACKOFF = 60  # Seconds between reconnect attempts, at most
+
+item_cache = OrderedDict()
+item_cache_codes = {}
+item_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'listening': False}
+item_cache_epoch = 0
+item_change_listener = None
+item_listener_reconnect = None
+item_suggest_pending = set()
+
+def invalidate_cached_item(it_id: int):
+    global item_cache_epoch
+    item_cache_epoch += 1
+    item = item_cache.pop(it_id, None)
+    if item:
+        item_cache_codes.pop(item['it_code'], None)
+        item_cache_stats['invalidations'] += 1
+
+def store_cached_items(items):
+    for item in items:
+        item_cache[item['it_id']] = item
+        item_cache.move_to_end(item['it_id'])
+        item_cache_codes[item['it_code']] = item['it_id']
+    while len(item_cache) > ITEM_CACHE_SIZE:
+        _, evicted = item_cache.popitem(last=False)
+        item_cache_codes.pop(evicted['it_code'], None)
+        item_cache_stats['evictions'] += 1
+
+async def get_cached_items(connection, it_ids) -> dict:
+    # Returns {it_id: item} for the ids that exist; misses are loaded in one query
+    result = {}
+    missing = []
+    for it_id in dict.fromkeys(it_ids):
+        item = item_cache.get(it_id) if item_cache_stats['listening'] else None
+        if item is not None:
+            item_cache.move_to_end(it_id)
+            item_cache_stats['hits'] += 1
+            result[it_id] = item
+        else:
+            item_cache_stats['misses'] += 1
+            missing.append(it_id)
+    if missing:
+        epoch = item_cache_epoch
+        records = await connection.fetch(
+            ITEM_SELECT.format(items="item_master") + " WHERE im.it_id = ANY($1::int[]);", missing
+        )
+        loaded = []
+        for r in records:
+            item = dict(r)
+            item.pop('current_stock')
+            item.pop('warehouse_stock')
+            loaded.append(item)
+            result[item['it_id']] = item
+        # Skip caching if an invalidation arrived while the rows were being read
+        if item_cache_stats['listening'] and epoch == item_cache_epoch:
+            store_cached_items(loaded)
+    return result
+
+async def get_cached_item_id(connection, it_code: str) -> Optional[int]:
+    it_id = item_cache_codes.get(it_code) if item_cache_stats['listening'] else None
+    if it_id is None:
+        it_id = await connection.fetchval("SELECT it_id FROM item_master WHERE it_code = $1;", it_code)
+    return it_id
+
+def on_item_change(connection, pid, channel, payload):
+    it_id = int(payload)
+    invalidate_cached_item(it_id)
+    # Bursts (e.g. a bulk import) are collected and applied to the typeahead index together
+    if not item_suggest_pending:
+        asyncio.get_event_loop().create_task(flush_item_suggest_changes())
+    item_suggest_pending.add(it_id)
+
+def on_item_listener_closed(connection):
+    item_cache_stats['listening'] = False
+    reference_snapshot['stale'] = True
+    item_cache.clear()
+    item_cache_codes.clear()
+    print("Item change listener disconnected; item cache disabled until it reconnects.")
+    schedule_item_listener_reconnect()
+
+async def flush_item_suggest_changes():
+    await asyncio.sleep(0.2)
+    it_ids = list(item_suggest_pending)
+    item_suggest_pending.clear()
+    try:
+        async with pool.acquire() as connection:
+            if len(it_ids) > ITEM_SUGGEST_REBUILD_THRESHOLD:
+                await build_item_suggest_index(connection)
+            else:
+                await refresh_item_suggest_entries(connection, it_ids)
+    except Exception as e:
+        print(f"Error refreshing item search index: {e}")
+
+async def start_item_change_listener() -> bool:
+    global item_change_listener
+    try:
+        item_change_listener = await asyncpg.connect(os.getenv('DATABASE_URL'))
+        await item_change_listener.add_listener('item_changes', on_item_change)
+        await item_change_listener.add_listener('reference_changes', on_reference_change)
+        item_change_listener.add_termination_listener(on_item_listener_closed)
+        item_cache_stats['listening'] = True
+        return True
+    except Exception as e:
+        print(f"Item change listener not started; item cache disabled: {e}")
+        if item_change_listener and not item_change_listener.is_closed():
+            await item_change_listener.close()
+        return False
+
+def schedule_item_listener_reconnect():
+    global item_listener_reconnect
+    if item_listener_reconnect is None or item_listener_reconnect.done():
+        item_listener_reconnect = asyncio.get_event_loop().create_task(reconnect_item_change_listener())
+
+async def reconnect_item_change_listener():
+    delay = 1
+    while True:
+        await asyncio.sleep(delay)
+        if await start_item_change_listener():
+            break
+        delay = min(delay * 2, ITEM_LISTENER_MAX_BACKOFF)
+    print("Item change listener reconnected.")
+    # Notifications sent while disconnected were lost; drop what they would have invalidated
+    reference_snapshot['stale'] = True
+    for table in list(master_cache):
+        invalidate_master_data(table)
+    try:
+        async with pool.acquire() as connection:
+            await build_item_suggest_index(connection)
+    except Exception as e:
+        print(f"Error rebuilding item search index: {e}")
+
+@api_router.get("/item-cache/stats")
+async def get_item_cache_stats():
+    lookups = item_cache_stats['hits'] + item_cache_stats['misses']
+    return {
+        **item_cache_stats,
+        "size": len(item_cache),
+        "capacity": ITEM_CACHE_SIZE,
+        "hit_ratio": round(item_cache_stats['hits'] / lookups, 4) if lookups else None
+    }
+
+# Item typeahead index
+# Held in process memory and built at startup; item create/update/delete keep it
+# current. Prefix lookups bisect one sorted (token, it_id) list per field (code, name,
+# HSN) and stop once enough matches are collected. Queries with no prefix match fall
+# back to trigram similarity, which tolerates typos.
+ITEM_SUGGEST_FIELDS = ('it_id', 'it_code', 'it_name', 'it_details', 'it_hsn', 'it_uom', 'it_whs', 'it_status')
+ITEM_SUGGEST_SCAN_LIMIT = 20000  # Prefix entries examined per field before giving up
+ITEM_SUGGEST_MAX_POSTING = 2000  # Trigrams shared by more items than this are too common to help
+ITEM_SUGGEST_MIN_SIMILARITY = 0.4
+
+item_suggest_index = {'items': {}, 'prefixes': ([], [], []), 'trigrams': {}}
+
+def item_search_words(text):
+    return [w for w in re.split(r'[^0-9a-z]+', (text or '').lower()) if w]
+
+def item_search_tokens(item):
+    # (field, token) pairs: 0 = code (whole and its parts), 1 = name words, 2 = HSN
+    code = (item['it_code'] or '').lower()
+    tokens = {(0, code)} if code else set()
+    tokens.update((0, w) for w in item_search_words(code))
+    tokens.update((1, w) for w in item_search_words(item['it_name']))
+    hsn = ''.join(item_search_words(item['it_hsn']))
+    if hsn:
+        tokens.add((2, hsn))
+    return tokens
+
+def word_trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def item_trigrams(item):
+    trigrams = set()
+    for word in item_search_words(item['it_code']) + item_search_words(item['it_name']):
+        trigrams |= word_trigrams(word)
+    return trigrams
+
+def item_search_text(item):
+    return ' '.join(str(item[f] or '').lower() for f in ('it_code', 'it_name', 'it_hsn'))
+
+def remove_item_suggest_entry(it_id: int):
+    entry = item_suggest_index['items'].pop(it_id, None)
+    if not entry:
+        return
+    item, _ = entry
+    for field, token in item_search_tokens(item):
+        entries = item_suggest_index['prefixes'][field]
+        i = bisect.bisect_left(entries, (token, it_id))
+        if i < len(entries) and entries[i] == (token, it_id):
+            del entries[i]
+    for trigram in item_trigrams(item):
+        posting = item_suggest_index['trigrams'].get(trigram)
+        if posting is not None:
+            posting.discard(it_id)
+            if not posting:
+                del item_suggest_index['trigrams'][trigram]
+
+def add_item_suggest_entry(item: dict):
+    remove_item_suggest_entry(item['it_id'])
+    item_suggest_index['items'][item['it_id']] = (item, item_search_text(item))
+    for field, token in item_search_tokens(item):
+        bisect.insort(item_suggest_index['prefixes'][field], (token, item['it_id']))
+    for trigram in item_trigrams(item):
+        item_suggest_index['trigrams'].setdefault(trigram, set()).add(item['it_id'])
+
+async def build_item_suggest_index(connection):
+    records = await connection.fetch(f"SELECT {', '.join(ITEM_SUGGEST_FIELDS)} FROM item_master;")
+    items = {}
+    prefixes = ([], [], [])
+    trigrams = {}
+    for r in records:
+        item = dict(r)
+        items[item['it_id']] = (item, item_search_text(item))
+        for field, token in item_search_tokens(item):
+            prefixes[field].append((token, item['it_id']))
+        for trigram in item_trigrams(item):
+            trigrams.setdefault(trigram, set()).add(item['it_id'])
+    for entries in prefixes:
+        entries.sort()
+    item_suggest_index.update(items=items, prefixes=prefixes, trigrams=trigrams)
+
+async def refresh_item_suggest_entries(connection, it_ids):
+    records = await connection.fetch(
+        f"SELECT {', '.join(ITEM_SUGGEST_FIELDS)} FROM item_master WHERE it_id = ANY($1::int[]);", it_ids
+    )
+    for record in records:
+        add_item_suggest_entry(dict(record))
+    for it_id in set(it_ids) - {r['it_id'] for r in records}:
+        remove_item_suggest_entry(it_id)
+
+def search_item_suggest_index(q: str, limit: int, active_only: bool):
+    words = item_search_words(q)
+    if not words:
+        return []
+    lead = max(words, key=len)
+    items = item_suggest_index['items']
+    
+    def accepted(it_id):
+        item, text = items[it_id]
+        if active_only and item['it_status'] != 'Active':
+            return False
+        return all(w in text for w in words)
+    
+    results = []
+    seen = set()
+    # Code matches rank above name matches, which rank above HSN matches; within a
+    # field the sorted order puts exact and shorter tokens first
+    for entries in item_suggest_index['prefixes']:
+        i = bisect.bisect_left(entries, (lead,))
+        end = min(len(entries), i + ITEM_SUGGEST_SCAN_LIMIT)
+        while i < end and entries[i][0].startswith(lead):
+            it_id = entries[i][1]
+            i += 1
+            if it_id in seen:
+                continue
+            seen.add(it_id)
+            if accepted(it_id):
+                results.append(it_id)
+                if len(results) >= limit:
+                    return results
+    if results:
+        return results
+    
+    # Trigram fallback: score items by how many of the query's trigrams they share.
+    # Only selective trigrams are scanned, but the threshold is over all of them.
+    query_trigrams = set()
+    for word in words:
+        query_trigrams |= word_trigrams(word)
+    postings = sorted(
+        (item_suggest_index['trigrams'][t] for t in query_trigrams if t in item_suggest_index['trigrams']),
+        key=len
+    )
+    selective = [p for p in postings if len(p) <= ITEM_SUGGEST_MAX_POSTING]
+    hits = {}
+    for posting in selective:
+        for it_id in posting:
+            hits[it_id] = hits.get(it_id, 0) + 1
+    needed = ITEM_SUGGEST_MIN_SIMILARITY * len(query_trigrams)
+    ranked = sorted(
+        (it_id for it_id, count in hits.items() if count >= needed),
+        key=lambda it_id: (-hits[it_id], items[it_id][0]['it_code'] or '')
+    )
+    for it_id in ranked:
+        item = items[it_id][0]
+        if active_only and item['it_status'] != 'Active':
+            continue
+        results.append(it_id)
+        if len(results) >= limit:
+            break
+    return results
+
+@api_router.get("/items/suggest")
+async def suggest_items(q: str, limit: int = 10, active_only: bool = True, include_stock: bool = False):
+    try:
+        it_ids = search_item_suggest_index(q, min(limit, 100), active_only)
+        suggestions = [dict(item_suggest_index['items'][it_id][0]) for it_id in it_ids]
+        if include_stock and it_ids:
+            async with pool.acquire() as connection:
+                stock = await connection.fetch("""
+                    SELECT item_id, SUM(balance_qty) as current_stock
+                    FROM stock_balance WHERE item_id = ANY($1::int[])
+                    GROUP BY item_id;
+                """, it_ids)
+            stock_by_item = {r['item_id']: float(r['current_stock']) for r in stock}
+            for s in suggestions:
+                s['current_stock'] = stock_by_item.get(s['it_id'], 0)
+        return suggestions
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching items: {str(e)}")
+
+async def fetch_item_with_stock(connection, it_id: int):
+    # Cached item row plus live stock
+    item = (await get_cached_items(connection, [it_id])).get(it_id)
+    if not item:
+        return None
+    stock = await connection.fetchrow(ITEM_STOCK_SUMMARY.format(item_id="$1") + ";", it_id)
+    return item_record_to_dict({
+        **item,
+        'current_stock': stock['current_stock'] or 0,
+        'warehouse_stock': stock['warehouse_stock'] or '[]'
+    })
+
+@api_router.get("/items/by-code/{it_code}", response_model=ItemMasterResponse)
+async def get_item_by_code(it_code: str):
+    try:
+        async with pool.acquire() as connection:
+            it_id = await get_cached_item_id(connection, it_code)
+            item = await fetch_item_with_stock(connection, it_id) if it_id else None
+            if not item:
+                raise HTTPException(status_code=404, detail="Item not found")
+            return item
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching item: {str(e)}")
+
 @api_router.get("/items/{it_id}", response_model=ItemMasterResponse)
 async def get_item(it_id: int):
     try:
         async with pool.acquire() as connection:
-            query = """
-                SELECT 
-                    im.it_id,
-                    im.it_code,
-                    im.it_name,
-                    im.it_details,
-                    im.it_group,
-                    im.it_uom,
-                    im.it_type,
-                    im.it_mfg,
-                    im.it_hsn,
-                    im.it_whs,
-                    im.it_moq,
-                    im.it_min,
-                    im.it_max,
-                    im.it_lead,
-                    im.it_status,
-                    im.it_remark,
-                    im.it_attach,
-                    ig.grp_name as group_name,
-                    uom.uom_name,
-                    it.type_name,
-                    wr.whs_name,
-                    0 as current_stock,
-                    COALESCE(ARRAY_AGG(ic.cat_name) FILTER (WHERE ic.cat_name IS NOT NULL), ARRAY[]::text[]) as category_names,
-                    COALESCE(ARRAY_AGG(ic.cat_id) FILTER (WHERE ic.cat_id IS NOT NULL), ARRAY[]::int[]) as category_ids
-                FROM item_master im
-                LEFT JOIN item_group ig ON im.it_group = ig.grp_id
-                LEFT JOIN uom uom ON im.it_uom = uom.uom_id
-                LEFT JOIN item_category_mapping icm ON im.it_id = icm.item_id
-                LEFT JOIN item_cat ic ON icm.category_id = ic.cat_id
-                LEFT JOIN item_type it ON im.it_type = it.type_id
-                LEFT JOIN whs wr ON im.it_whs = wr.whs_id
-                WHERE im.it_id = $1
-                GROUP BY im.it_id, im.it_code, im.it_name, im.it_details, im.it_group, im.it_uom, 
-                         im.it_type, im.it_mfg, im.it_hsn, im.it_whs, im.it_moq, im.it_min, 
-                         im.it_max, im.it_lead, im.it_status, im.it_remark, im.it_attach,
-                         ig.grp_name, uom.uom_name, it.type_name, wr.whs_name
-            """
-            record = await connection.fetchrow(query, it_id)
-            if not record:
+            item = await fetch_item_with_stock(connection, it_id)
+            if not item:
                 raise HTTPException(status_code=404, detail="Item not found")
-            return dict(record)
+            return item
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching item: {str(e)}")
 
@@ -3341,6 +4506,9 @@ async def create_item(item: ItemMasterCreate):
                         it_id, cat_id
                     )
 
+            invalidate_cached_item(it_id)
+            await refresh_item_suggest_entries(connection, [it_id])
+
             # Fetch full record with display names
             return await get_item(it_id)
 
@@ -3388,6 +4556,9 @@ async def update_item(it_id: int, item: ItemMasterCreate):
                         it_id, cat_id
                     )
 
+            invalidate_cached_item(it_id)
+            await refresh_item_suggest_entries(connection, [it_id])
+
             # Fetch updated record
             return await get_item(it_id)
             
@@ -3398,153 +4569,1227 @@ async def update_item(it_id: int, item: ItemMasterCreate):
 async def delete_item(it_id: int):
     try:
         async with pool.acquire() as connection:
-            # Categories will be automatically deleted due to CASCADE
-            result = await connection.execute("DELETE FROM item_master WHERE it_id=$1;", it_id)
-            if result == "DELETE 0":
-                raise HTTPException(status_code=404, detail="Item not found")
+            async with connection.transaction():
+                blobs = await connection.fetch(
+                    "SELECT DISTINCT sha256 FROM item_attachment WHERE item_id = $1 ORDER BY sha256;", it_id
+                )
+                uploads = await connection.fetch(
+                    "SELECT upload_id FROM attachment_upload WHERE item_id = $1;", it_id
+                )
+                # Categories, attachments and upload sessions will be automatically deleted due to CASCADE
+                result = await connection.execute("DELETE FROM item_master WHERE it_id=$1;", it_id)
+                if result == "DELETE 0":
+                    raise HTTPException(status_code=404, detail="Item not found")
+                # Stored files other items still use stay; locks are taken in hash order
+                for r in blobs:
+                    await lock_attachment_blob(connection, r['sha256'])
+                    still_used = await connection.fetchval(
+                        "SELECT 1 FROM item_attachment WHERE sha256 = $1 LIMIT 1;", r['sha256']
+                    )
+                    if not still_used:
+                        await asyncio.to_thread(remove_attachment_blob, r['sha256'])
+            for r in uploads:
+                path = attachment_upload_path(r['upload_id'])
+                if os.path.exists(path):
+                    await asyncio.to_thread(os.remove, path)
+            invalidate_cached_item(it_id)
+            remove_item_suggest_entry(it_id)
             return {"message": "Item deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting item: {str(e)}")
 
+# Bulk item import
+# Body is CSV with a header row (format=csv) or one JSON object per line
+# (format=ndjson), using the ItemMasterCreate field names. In CSV, category_ids
+# holds ids separated by ';'. References are checked against sets loaded once,
+# item ids are allocated up front and items and category mappings go in with COPY.
+# Invalid rows are skipped and reported; valid rows are imported in one transaction.
+ITEM_IMPORT_COLUMNS = [
+    'it_id', 'it_name', 'it_details', 'it_group', 'it_uom', 'it_type', 'it_mfg', 'it_hsn',
+    'it_whs', 'it_moq', 'it_min', 'it_max', 'it_lead', 'it_status', 'it_remark', 'it_attach'
+]
+ITEM_IMPORT_BATCH_SIZE = 5000
+
+def parse_item_import_row(values, references):
+    # Returns the parsed item, or raises ValueError with a readable reason
+    values = {k: v for k, v in values.items() if k and v not in ('', None)}
+    category_ids = values.get('category_ids') or []
+    if isinstance(category_ids, str):
+        category_ids = [c.strip() for c in category_ids.split(';') if c.strip()]
+    values['category_ids'] = category_ids
+    item = ItemMasterCreate(**values)
+    
+    for field, key, label in (
+        ('it_group', 'groups', 'Item Group'),
+        ('it_uom', 'uoms', 'UOM'),
+        ('it_type', 'types', 'Type'),
+        ('it_whs', 'warehouses', 'Warehouse'),
+    ):
+        value = getattr(item, field)
+        if value and value not in references[key]:
+            raise ValueError(f"{label} with ID {value} does not exist")
+    for cat_id in item.category_ids:
+        if cat_id not in references['categories']:
+            raise ValueError(f"Category with ID {cat_id} does not exist")
+    return item
+
+async def load_item_import_batch(connection, batch):
+    it_ids = await connection.fetch(
+        "SELECT nextval(pg_get_serial_sequence('item_master', 'it_id')) as it_id FROM generate_series(1, $1);",
+        len(batch)
+    )
+    items = []
+    mappings = []
+    for item, row in zip(batch, it_ids):
+        it_id = row['it_id']
+        items.append((
+            it_id, item.it_name, item.it_details or None, item.it_group or None,
+            item.it_uom or None, item.it_type or None,
+            item.it_mfg or None, item.it_hsn or None, item.it_whs or None,
+            item.it_moq or 0, item.it_min or 0, item.it_max or 0, item.it_lead or 0,
+            item.it_status, item.it_remark or None, item.it_attach or None
+        ))
+        mappings.extend((it_id, cat_id) for cat_id in dict.fromkeys(item.category_ids))
+    await connection.copy_records_to_table('item_master', records=items, columns=ITEM_IMPORT_COLUMNS)
+    if mappings:
+        await connection.copy_records_to_table(
+            'item_category_mapping', records=mappings, columns=['item_id', 'category_id']
+        )
 
-# Stock Transaction API Endpoints
-
-@api_router.post("/stock-transactions", response_model=StockTransactionResponse, status_code=status.HTTP_201_CREATED)
-async def create_stock_transaction(transaction: StockTransactionCreate):
+@api_router.post("/items/import")
+async def import_items(request: Request, format: str = "csv"):
+    if format not in ('csv', 'ndjson'):
+        raise HTTPException(status_code=400, detail="Invalid format. Must be 'csv' or 'ndjson'")
+    errors = []
+    imported = 0
     try:
         async with pool.acquire() as connection:
-            # Validate item exists
-            item_exists = await connection.fetchrow(
-                "SELECT it_id FROM item_master WHERE it_id = $1;", transaction.item_id
-            )
-            if not item_exists:
-                raise HTTPException(status_code=400, detail=f"Item with ID {transaction.item_id} does not exist")
-            
-            # Validate warehouse if provided
-            if transaction.warehouse_id:
-                warehouse_exists = await connection.fetchrow(
-                    "SELECT whs_id FROM whs WHERE whs_id = $1;", transaction.warehouse_id
-                )
-                if not warehouse_exists:
-                    raise HTTPException(status_code=400, detail=f"Warehouse with ID {transaction.warehouse_id} does not exist")
-            
-            # Calculate running balance
-            last_balance_query = """
-                SELECT balance_qty FROM stock_transactions 
-                WHERE item_id = $1 AND warehouse_id = $2 
-                ORDER BY trans_date DESC, trans_id DESC 
-                LIMIT 1
-            """
-            last_balance = await connection.fetchrow(
-                last_balance_query, 
-                transaction.item_id, 
-                transaction.warehouse_id
-            )
-            
-            current_balance = last_balance['balance_qty'] if last_balance else 0
-            
-            if transaction.trans_type == 'IN':
-                new_balance = current_balance + transaction.stock_qty
-            elif transaction.trans_type == 'OUT':
-                new_balance = current_balance - transaction.stock_qty
-            else:  # ADJUSTMENT
-                new_balance = transaction.stock_qty
-            
-            # Insert transaction
-            insert_query = """
-                INSERT INTO stock_transactions (
-                    item_id, trans_type, reference_type, reference_id, warehouse_id,
-                    stock_qty, unit_cost, balance_qty, remarks, created_by
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                RETURNING trans_id;
-            """
-            
-            inserted = await connection.fetchrow(
-                insert_query,
-                transaction.item_id,
-                transaction.trans_type,
-                transaction.reference_type,
-                transaction.reference_id,
-                transaction.warehouse_id,
-                transaction.stock_qty,
-                transaction.unit_cost or 0,
-                new_balance,
-                transaction.remarks,
-                transaction.created_by
-            )
-            
-            # Fetch complete record with item details
-            full_query = """
-                SELECT st.*, im.it_code, im.it_name, wr.whs_name
-                FROM stock_transactions st
-                LEFT JOIN item_master im ON st.item_id = im.it_id
-                LEFT JOIN whs wr ON st.warehouse_id = wr.whs_id
-                WHERE st.trans_id = $1
-            """
-            full_record = await connection.fetchrow(full_query, inserted['trans_id'])
-            return dict(full_record)
+            references = {
+                'groups': {r['grp_id'] for r in await connection.fetch("SELECT grp_id FROM item_group;")},
+                'uoms': {r['uom_id'] for r in await connection.fetch("SELECT uom_id FROM uom;")},
+                'types': {r['type_id'] for r in await connection.fetch("SELECT type_id FROM item_type;")},
+                'warehouses': {r['whs_id'] for r in await connection.fetch("SELECT whs_id FROM whs;")},
+                'categories': {r['cat_id'] for r in await connection.fetch("SELECT cat_id FROM item_cat;")},
+            }
             
+            async with connection.transaction():
+                batch = []
+                header = None
+                records = iter_numbered_lines(request) if format == 'ndjson' else iter_csv_rows(request)
+                async for line_no, values, error in records:
+                    if error:
+                        if header is None:
+                            raise HTTPException(status_code=400, detail=f"Line {line_no}: {error}")
+                        errors.append({"line_no": line_no, "error": error})
+                        continue
+                    if not values:
+                        continue
+                    try:
+                        if format == 'ndjson':
+                            values = json.loads(values)
+                        else:
+                            if header is None:
+                                header = [h.strip().lower() for h in values]
+                                if 'it_name' not in header:
+                                    raise HTTPException(status_code=400, detail="Missing columns: it_name")
+                                continue
+                            values = dict(zip(header, values))
+                        batch.append(parse_item_import_row(values, references))
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        errors.append({"line_no": line_no, "error": str(e)})
+                        continue
+                    
+                    if len(batch) >= ITEM_IMPORT_BATCH_SIZE:
+                        await load_item_import_batch(connection, batch)
+                        imported += len(batch)
+                        batch = []
+                
+                if batch:
+                    await load_item_import_batch(connection, batch)
+                    imported += len(batch)
+            
+            # With the listener running, the insert notifications rebuild the index
+            if imported and not item_cache_stats['listening']:
+                await build_item_suggest_index(connection)
+        
+        return {"imported": imported, "failed": len(errors), "errors": errors}
+    
     except HTTPException:
         raise
     except Exception as e:
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error creating stock transaction: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error importing items: {str(e)}")
+
+# Item attachments
+# Uploads are streamed to a temporary file chunk by chunk, so memory use does not
+# depend on file size. A session can be resumed: PUT the remaining bytes with
+# ?offset= set to the session's received_bytes (or any earlier offset to resend).
+# On completion the file is hashed and moved to ATTACHMENT_DIR/<aa>/<bb>/<sha256>;
+# a file that is already stored is not written twice, and completing the same upload
+# again returns the attachment it created. Downloads honour single byte ranges.
+# Image thumbnails are rendered on first request in a small thread pool.
+# All disk I/O runs in threads so large files never block the event loop.
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', 'attachments')
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(500 * 1024 * 1024)))
+ATTACHMENT_IO_CHUNK = 1024 * 1024
+ATTACHMENT_UPLOAD_EXPIRY = timedelta(days=1)
+ATTACHMENT_CLEANUP_INTERVAL = 3600  # Seconds between sweeps for abandoned uploads
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=int(os.getenv('THUMBNAIL_WORKERS', '2')))
+thumbnail_jobs = {}
+attachment_cleanup_task = None
+
+def attachment_upload_path(upload_id: str) -> str:
+    return os.path.join(ATTACHMENT_DIR, 'uploads', upload_id)
+
+def attachment_blob_path(sha256: str) -> str:
+    return os.path.join(ATTACHMENT_DIR, sha256[:2], sha256[2:4], sha256)
+
+def attachment_thumbnail_path(sha256: str, size: int) -> str:
+    return os.path.join(ATTACHMENT_DIR, 'thumbnails', f"{sha256}_{size}.jpg")
+
+def write_upload_chunk(path: str, offset: int, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+
+def hash_attachment_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(ATTACHMENT_IO_CHUNK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def store_attachment_blob(upload_path: str, sha256: str):
+    # Move a finished upload into content-addressed storage, unless that content is
+    # already stored. Callers hold the content's advisory lock (see lock_attachment_blob).
+    blob_path = attachment_blob_path(sha256)
+    if os.path.exists(blob_path):
+        os.remove(upload_path)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(upload_path, blob_path)
+
+async def lock_attachment_blob(connection, sha256: str):
+    # Serializes storing and removing the file for one content hash until the
+    # transaction ends, so an upload never reuses a file that a delete is removing
+    await connection.execute("SELECT pg_advisory_xact_lock(hashtext($1));", sha256)
+
+def remove_attachment_blob(sha256: str):
+    for path in [attachment_blob_path(sha256)] + glob.glob(os.path.join(ATTACHMENT_DIR, 'thumbnails', f"{sha256}_*.jpg")):
+        if os.path.exists(path):
+            os.remove(path)
+
+def attachment_disposition(file_name: str) -> str:
+    # Headers are latin-1, so the name goes out twice: an ASCII fallback for old
+    # clients and the exact name percent-encoded as UTF-8 (RFC 5987)
+    fallback = re.sub(r'[^A-Za-z0-9 !#$&+.^_`{}~()-]', '_', file_name) or 'attachment'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(file_name, safe='')}"
+
+def render_thumbnail(source: str, target: str, size: int):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f"{target}.{uuid.uuid4().hex}.tmp"
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        image.convert('RGB').save(partial, 'JPEG', quality=85)
+    os.replace(partial, target)
+
+def parse_byte_range(header: str, size: int):
+    # Returns (start, end) inclusive for a single "bytes=" range, or None if unusable
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+async def stream_attachment(path: str, start: int, length: int):
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = length
+        while remaining > 0:
+            data = await asyncio.to_thread(f.read, min(ATTACHMENT_IO_CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        await asyncio.to_thread(f.close)
+
+async def receive_upload_chunks(request: Request, upload):
+    # Append the request body to the upload at ?offset=, flushing to disk once per
+    # ATTACHMENT_IO_CHUNK bytes; returns the new received_bytes
+    try:
+        offset = int(request.query_params.get('offset', upload['received_bytes']))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Upload offset must be an integer")
+    if offset < 0 or offset > upload['received_bytes']:
+        raise HTTPException(status_code=409, detail=f"Upload offset must not exceed {upload['received_bytes']}")
+    limit = min(upload['total_bytes'] or ATTACHMENT_MAX_BYTES, ATTACHMENT_MAX_BYTES)
+    path = attachment_upload_path(upload['upload_id'])
+    position = offset
+    buffer = bytearray()
+    await asyncio.to_thread(write_upload_chunk, path, position, b'')
+    try:
+        async for chunk in request.stream():
+            buffer += chunk
+            if position + len(buffer) > limit:
+                raise HTTPException(status_code=413, detail=f"Attachment exceeds {limit} bytes")
+            if len(buffer) >= ATTACHMENT_IO_CHUNK:
+                await asyncio.to_thread(write_upload_chunk, path, position, bytes(buffer))
+                position += len(buffer)
+                buffer.clear()
+        if buffer:
+            await asyncio.to_thread(write_upload_chunk, path, position, bytes(buffer))
+            position += len(buffer)
+    except Exception:
+        # Keep file and session in step: nothing past offset survives a failed request
+        await asyncio.to_thread(write_upload_chunk, path, offset, b'')
+        async with pool.acquire() as connection:
+            await connection.execute("""
+                UPDATE attachment_upload SET received_bytes = $2, updated_at = CURRENT_TIMESTAMP
+                WHERE upload_id = $1 AND received_bytes > $2;
+            """, upload['upload_id'], offset)
+        raise
+    return offset, position
 
-@api_router.get("/stock-transactions")
-async def get_stock_transactions(
-    item_id: Optional[int] = None,
-    warehouse_id: Optional[int] = None,
-    start_date: Optional[date] = None,
-    end_date: Optional[date] = None,
-    skip: int = 0,
-    limit: int = 100
-):
+async def discard_upload_session(upload_id: str):
+    async with pool.acquire() as connection:
+        await connection.execute("DELETE FROM attachment_upload WHERE upload_id = $1;", upload_id)
+    path = attachment_upload_path(upload_id)
+    if os.path.exists(path):
+        await asyncio.to_thread(os.remove, path)
+
+async def expire_attachment_uploads(connection):
+    expired = await connection.fetch(
+        "DELETE FROM attachment_upload WHERE updated_at < $1 RETURNING upload_id;",
+        datetime.now() - ATTACHMENT_UPLOAD_EXPIRY
+    )
+    for r in expired:
+        path = attachment_upload_path(r['upload_id'])
+        if os.path.exists(path):
+            await asyncio.to_thread(os.remove, path)
+    return len(expired)
+
+async def run_attachment_upload_cleanup():
+    # Abandoned sessions are swept periodically, not only when a new upload starts
+    while True:
+        try:
+            async with pool.acquire() as connection:
+                await expire_attachment_uploads(connection)
+        except Exception as e:
+            print(f"Error removing expired attachment uploads: {e}")
+        await asyncio.sleep(ATTACHMENT_CLEANUP_INTERVAL)
+
+async def create_upload_session(connection, it_id: int, upload: AttachmentUploadCreate):
+    item_exists = await connection.fetchval("SELECT it_id FROM item_master WHERE it_id = $1;", it_id)
+    if not item_exists:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if upload.total_bytes is not None and upload.total_bytes > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Attachment exceeds {ATTACHMENT_MAX_BYTES} bytes")
+    
+    # Abandoned sessions are also cleaned up whenever a new one starts
+    await expire_attachment_uploads(connection)
+    
+    return await connection.fetchrow("""
+        INSERT INTO attachment_upload (upload_id, item_id, file_name, content_type, total_bytes, uploaded_by)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING *;
+    """, uuid.uuid4().hex, it_id, upload.file_name, upload.content_type, upload.total_bytes, upload.uploaded_by)
+
+async def complete_upload_session(connection, upload_id: str):
+    # The session row is locked for the whole completion, so a repeated or concurrent
+    # request waits and then gets the attachment the first one created
+    async with connection.transaction():
+        upload = await connection.fetchrow(
+            "SELECT * FROM attachment_upload WHERE upload_id = $1 FOR UPDATE;", upload_id
+        )
+        if not upload:
+            completed = await connection.fetchrow(
+                "SELECT * FROM item_attachment WHERE upload_id = $1;", upload_id
+            )
+            if not completed:
+                raise HTTPException(status_code=404, detail="Upload not found")
+            return dict(completed)
+        if upload['total_bytes'] is not None and upload['received_bytes'] != upload['total_bytes']:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: received {upload['received_bytes']} of {upload['total_bytes']} bytes"
+            )
+        path = attachment_upload_path(upload_id)
+        if not os.path.exists(path):
+            await asyncio.to_thread(write_upload_chunk, path, 0, b'')
+        sha256 = await asyncio.to_thread(hash_attachment_file, path)
+        await lock_attachment_blob(connection, sha256)
+        await asyncio.to_thread(store_attachment_blob, path, sha256)
+        attachment = await connection.fetchrow("""
+            INSERT INTO item_attachment (item_id, file_name, content_type, size_bytes, sha256, uploaded_by, upload_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING *;
+        """, upload['item_id'], upload['file_name'], upload['content_type'],
+            upload['received_bytes'], sha256, upload['uploaded_by'], upload_id)
+        await connection.execute("DELETE FROM attachment_upload WHERE upload_id = $1;", upload_id)
+    return dict(attachment)
+
+@api_router.get("/items/{it_id}/attachments", response_model=List[ItemAttachmentResponse])
+async def get_item_attachments(it_id: int):
     try:
         async with pool.acquire() as connection:
-            query = """
-                SELECT st.*, im.it_code, im.it_name, wr.whs_name
-                FROM stock_transactions st
-                LEFT JOIN item_master im ON st.item_id = im.it_id
-                LEFT JOIN whs wr ON st.warehouse_id = wr.whs_id
-                WHERE 1=1
-            """
-            params = []
-            param_count = 0
-            
-            if item_id:
-                param_count += 1
-                query += f" AND st.item_id = ${param_count}"
-                params.append(item_id)
-            
-            if warehouse_id:
-                param_count += 1
-                query += f" AND st.warehouse_id = ${param_count}"
-                params.append(warehouse_id)
-            
-            if start_date:
-                param_count += 1
-                query += f" AND DATE(st.trans_date) >= ${param_count}"
-                params.append(start_date)
-            
-            if end_date:
-                param_count += 1
-                query += f" AND DATE(st.trans_date) <= ${param_count}"
-                params.append(end_date)
-            
-            query += " ORDER BY st.trans_date DESC, st.trans_id DESC"
-            query += f" LIMIT ${param_count + 1} OFFSET ${param_count + 2}"
-            params.extend([limit, skip])
-            
-            records = await connection.fetch(query, *params)
+            records = await connection.fetch(
+                "SELECT * FROM item_attachment WHERE item_id = $1 ORDER BY attachment_id;", it_id
+            )
             return [dict(r) for r in records]
-            
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching stock transactions: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching attachments: {str(e)}")
 
-@api_router.get("/current-stock/{item_id}")
+@api_router.post("/items/{it_id}/attachments/uploads", response_model=AttachmentUploadResponse, status_code=status.HTTP_201_CREATED)
+async def start_attachment_upload(it_id: int, upload: AttachmentUploadCreate):
+    try:
+        async with pool.acquire() as connection:
+            return dict(await create_upload_session(connection, it_id, upload))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error starting attachment upload: {str(e)}")
+
+@api_router.get("/attachment-uploads/{upload_id}", response_model=AttachmentUploadResponse)
+async def get_attachment_upload(upload_id: str):
+    try:
+        async with pool.acquire() as connection:
+            upload = await connection.fetchrow("SELECT * FROM attachment_upload WHERE upload_id = $1;", upload_id)
+            if not upload:
+                raise HTTPException(status_code=404, detail="Upload not found")
+            return dict(upload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching attachment upload: {str(e)}")
+
+@api_router.put("/attachment-uploads/{upload_id}", response_model=AttachmentUploadResponse)
+async def upload_attachment_chunk(upload_id: str, request: Request):
+    try:
+        async with pool.acquire() as connection:
+            upload = await connection.fetchrow("SELECT * FROM attachment_upload WHERE upload_id = $1;", upload_id)
+            if not upload:
+                raise HTTPException(status_code=404, detail="Upload not found")
+        
+        # No connection is held while the body streams in
+        offset, received = await receive_upload_chunks(request, upload)
+        
+        async with pool.acquire() as connection:
+            updated = await connection.fetchrow("""
+                UPDATE attachment_upload SET received_bytes = $2, updated_at = CURRENT_TIMESTAMP
+                WHERE upload_id = $1 AND received_bytes >= $3
+                RETURNING *;
+            """, upload_id, received, offset)
+            if not updated:
+                raise HTTPException(status_code=409, detail="Upload was changed concurrently; fetch its status and resume")
+            return dict(updated)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading attachment: {str(e)}")
+
+@api_router.post("/attachment-uploads/{upload_id}/complete", response_model=ItemAttachmentResponse, status_code=status.HTTP_201_CREATED)
+async def complete_attachment_upload(upload_id: str):
+    try:
+        async with pool.acquire() as connection:
+            return await complete_upload_session(connection, upload_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error completing attachment upload: {str(e)}")
+
+# Single-request upload: the body is the whole file
+@api_router.post("/items/{it_id}/attachments", response_model=ItemAttachmentResponse, status_code=status.HTTP_201_CREATED)
+async def upload_item_attachment(it_id: int, request: Request, file_name: str, uploaded_by: Optional[str] = None):
+    try:
+        async with pool.acquire() as connection:
+            upload = await create_upload_session(connection, it_id, AttachmentUploadCreate(
+                file_name=file_name,
+                content_type=request.headers.get('content-type'),
+                uploaded_by=uploaded_by
+            ))
+        try:
+            _, received = await receive_upload_chunks(request, upload)
+            async with pool.acquire() as connection:
+                await connection.execute("""
+                    UPDATE attachment_upload SET received_bytes = $2, updated_at = CURRENT_TIMESTAMP
+                    WHERE upload_id = $1;
+                """, upload['upload_id'], received)
+                return await complete_upload_session(connection, upload['upload_id'])
+        except Exception:
+            # Nobody can resume a one-shot upload, so a failed one leaves nothing behind
+            await discard_upload_session(upload['upload_id'])
+            raise
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading attachment: {str(e)}")
+
+@api_router.get("/attachments/{attachment_id}/content")
+async def download_attachment(attachment_id: int, request: Request):
+    try:
+        async with pool.acquire() as connection:
+            attachment = await connection.fetchrow(
+                "SELECT * FROM item_attachment WHERE attachment_id = $1;", attachment_id
+            )
+        if not attachment:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+        path = attachment_blob_path(attachment['sha256'])
+        size = attachment['size_bytes']
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{attachment["sha256"]}"',
+            "Content-Disposition": attachment_disposition(attachment["file_name"]),
+        }
+        media_type = attachment['content_type'] or 'application/octet-stream'
+        
+        # Multi-range requests are answered with the whole file
+        range_header = request.headers.get('range')
+        if range_header and ',' not in range_header:
+            byte_range = parse_byte_range(range_header, size)
+            if not byte_range:
+                raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                stream_attachment(path, start, end - start + 1),
+                status_code=206, media_type=media_type, headers=headers
+            )
+        
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(stream_attachment(path, 0, size), media_type=media_type, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error downloading attachment: {str(e)}")
+
+@api_router.get("/attachments/{attachment_id}/thumbnail")
+async def get_attachment_thumbnail(attachment_id: int, size: int = 256):
+    try:
+        if Image is None:
+            raise HTTPException(status_code=501, detail="Thumbnails are not available on this server")
+        if size not in THUMBNAIL_SIZES:
+            raise HTTPException(status_code=400, detail=f"Invalid size. Must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
+        async with pool.acquire() as connection:
+            attachment = await connection.fetchrow(
+                "SELECT sha256, content_type FROM item_attachment WHERE attachment_id = $1;", attachment_id
+            )
+        if not attachment:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+        if not (attachment['content_type'] or '').startswith('image/'):
+            raise HTTPException(status_code=400, detail="Thumbnails are only available for images")
+        
+        target = attachment_thumbnail_path(attachment['sha256'], size)
+        if not os.path.exists(target):
+            # Concurrent requests for the same thumbnail share one render
+            job = thumbnail_jobs.get(target)
+            if job is None:
+                job = asyncio.get_event_loop().run_in_executor(
+                    thumbnail_executor, render_thumbnail, attachment_blob_path(attachment['sha256']), target, size
+                )
+                thumbnail_jobs[target] = job
+                job.add_done_callback(lambda _: thumbnail_jobs.pop(target, None))
+            await job
+        return FileResponse(target, media_type='image/jpeg')
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating thumbnail: {str(e)}")
+
+@api_router.delete("/attachments/{attachment_id}")
+async def delete_attachment(attachment_id: int):
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                deleted = await connection.fetchrow(
+                    "DELETE FROM item_attachment WHERE attachment_id = $1 RETURNING sha256;", attachment_id
+                )
+                if not deleted:
+                    raise HTTPException(status_code=404, detail="Attachment not found")
+                # The stored file is shared by every attachment with the same content;
+                # usage is checked and the file removed under the content's lock
+                await lock_attachment_blob(connection, deleted['sha256'])
+                still_used = await connection.fetchval(
+                    "SELECT 1 FROM item_attachment WHERE sha256 = $1 LIMIT 1;", deleted['sha256']
+                )
+                if not still_used:
+                    await asyncio.to_thread(remove_attachment_blob, deleted['sha256'])
+            return {"message": "Attachment deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting attachment: {str(e)}")
+
+
+# Stock Transaction API Endpoints
+
+async def lock_stock_balances(connection, keys):
+    # Lock the stock_balance rows for the given (item_id, warehouse_id) keys until the
+    # surrounding transaction ends and return their balances. Postings for the same key
+    # are serialized on the row lock; other keys proceed in parallel. Rows are locked in
+    # key order so that batches touching overlapping keys cannot deadlock.
+    keys = sorted(set(keys))
+    item_ids = [k[0] for k in keys]
+    warehouse_ids = [k[1] for k in keys]
+    await connection.execute("""
+        INSERT INTO stock_balance (item_id, warehouse_id)
+        SELECT * FROM unnest($1::int[], $2::int[])
+        ON CONFLICT (item_id, warehouse_id) DO NOTHING;
+    """, item_ids, warehouse_ids)
+    rows = await connection.fetch("""
+        SELECT sb.item_id, sb.warehouse_id, sb.balance_qty
+        FROM stock_balance sb
+        JOIN unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+          ON sb.item_id = k.item_id AND sb.warehouse_id = k.warehouse_id
+        ORDER BY sb.item_id, sb.warehouse_id
+        FOR UPDATE OF sb;
+    """, item_ids, warehouse_ids)
+    return {(r['item_id'], r['warehouse_id']): float(r['balance_qty']) for r in rows}
+
+# Inventory valuation
+# Each (item, warehouse) carries a moving-average cost and a list of open FIFO layers.
+# State is loaded under the key's balance lock, movements are applied in memory and
+# the result is written back in a few set-based statements.
+async def load_stock_valuations(connection, keys):
+    keys = sorted(set(keys))
+    item_ids = [k[0] for k in keys]
+    warehouse_ids = [k[1] for k in keys]
+    valuations = {key: {'qty': 0.0, 'value': 0.0, 'avg_cost': 0.0, 'layers': []} for key in keys}
+    rows = await connection.fetch("""
+        SELECT sb.item_id, sb.warehouse_id, sb.balance_qty, sb.avg_cost, sb.stock_value
+        FROM stock_balance sb
+        JOIN unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+          ON sb.item_id = k.item_id AND sb.warehouse_id = k.warehouse_id;
+    """, item_ids, warehouse_ids)
+    for r in rows:
+        valuations[(r['item_id'], r['warehouse_id'])].update(
+            qty=float(r['balance_qty']), value=float(r['stock_value']), avg_cost=float(r['avg_cost'])
+        )
+    layers = await connection.fetch("""
+        SELECT l.layer_id, l.item_id, l.warehouse_id, l.unit_cost, l.remaining_qty
+        FROM stock_fifo_layer l
+        JOIN unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+          ON l.item_id = k.item_id AND l.warehouse_id = k.warehouse_id
+        WHERE l.remaining_qty > 0
+        ORDER BY l.item_id, l.warehouse_id, l.layer_id;
+    """, item_ids, warehouse_ids)
+    for l in layers:
+        valuations[(l['item_id'], l['warehouse_id'])]['layers'].append({
+            'layer_id': l['layer_id'], 'unit_cost': float(l['unit_cost']),
+            'remaining_qty': float(l['remaining_qty']), 'changed': False
+        })
+    return valuations
+
+def apply_stock_valuation(valuation, trans_type, stock_qty, unit_cost, trans_id=None):
+    # ADJUSTMENT sets an absolute quantity; value it as a receipt or issue of the difference
+    if trans_type == 'IN':
+        receipt, issue = stock_qty, 0
+    elif trans_type == 'OUT':
+        receipt, issue = 0, stock_qty
+    else:
+        delta = stock_qty - valuation['qty']
+        receipt, issue = max(delta, 0), max(-delta, 0)
+    
+    if receipt:
+        cost = unit_cost or valuation['avg_cost']
+        # A receipt into negative stock first covers the shortfall, which is settled
+        # at the receipt's cost; only what is left over opens a FIFO layer
+        shortfall = max(-valuation['qty'], 0)
+        if shortfall:
+            valuation['value'] = -shortfall * cost
+        valuation['qty'] += receipt
+        valuation['value'] += receipt * cost
+        valuation['layers'].append({
+            'layer_id': None, 'trans_id': trans_id, 'unit_cost': cost,
+            'original_qty': receipt, 'remaining_qty': max(receipt - shortfall, 0), 'changed': True
+        })
+    if issue:
+        valuation['qty'] -= issue
+        valuation['value'] -= issue * valuation['avg_cost']
+        remaining = issue
+        for layer in valuation['layers']:
+            if remaining <= 0:
+                break
+            if layer['remaining_qty'] <= 0:
+                continue
+            used = min(layer['remaining_qty'], remaining)
+            layer['remaining_qty'] -= used
+            layer['changed'] = True
+            remaining -= used
+    
+    # Negative stock keeps its last average cost, so its value stays qty * avg_cost
+    # and a later receipt settles it at the right price
+    if valuation['qty'] > 0:
+        valuation['avg_cost'] = valuation['value'] / valuation['qty']
+    else:
+        valuation['value'] = valuation['qty'] * valuation['avg_cost']
+
+def apply_stock_opening(valuation, stock_qty, unit_cost, trans_id, opening_layers):
+    # An OPENING row restores the carried-forward quantity at its average cost and,
+    # when the archive recorded them, the FIFO layers that were open at the cutoff
+    layers = opening_layers.get(trans_id)
+    if layers is None:
+        apply_stock_valuation(valuation, 'OPENING', stock_qty, unit_cost, trans_id)
+        return
+    for layer in valuation['layers']:
+        if layer['remaining_qty'] > 0:
+            layer['remaining_qty'] = 0
+            layer['changed'] = True
+    valuation['layers'].extend(
+        {
+            'layer_id': None, 'trans_id': l['trans_id'], 'unit_cost': float(l['unit_cost']),
+            'original_qty': float(l['remaining_qty']), 'remaining_qty': float(l['remaining_qty']), 'changed': True
+        }
+        for l in layers
+    )
+    valuation['qty'] = stock_qty
+    valuation['avg_cost'] = unit_cost
+    valuation['value'] = stock_qty * unit_cost
+
+async def load_stock_opening_layers(connection, keys=None):
+    # Carried-forward layers keyed by the trans_id of their OPENING row
+    if keys is None:
+        rows = await connection.fetch("""
+            SELECT opening_trans_id, trans_id, unit_cost, remaining_qty
+            FROM stock_opening_layer
+            ORDER BY opening_trans_id, layer_no;
+        """)
+    else:
+        keys = sorted(set(keys))
+        rows = await connection.fetch("""
+            SELECT l.opening_trans_id, l.trans_id, l.unit_cost, l.remaining_qty
+            FROM stock_opening_layer l
+            JOIN unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+              ON l.item_id = k.item_id AND l.warehouse_id = k.warehouse_id
+            ORDER BY l.opening_trans_id, l.layer_no;
+        """, [k[0] for k in keys], [k[1] for k in keys])
+    opening_layers = {}
+    for r in rows:
+        opening_layers.setdefault(r['opening_trans_id'], []).append(r)
+    return opening_layers
+
+async def save_stock_valuations(connection, valuations):
+    keys = list(valuations)
+    await connection.execute("""
+        UPDATE stock_balance sb
+        SET avg_cost = v.avg_cost, stock_value = v.stock_value
+        FROM unnest($1::int[], $2::int[], $3::numeric[], $4::numeric[]) AS v(item_id, warehouse_id, avg_cost, stock_value)
+        WHERE sb.item_id = v.item_id AND sb.warehouse_id = v.warehouse_id;
+    """, [k[0] for k in keys], [k[1] for k in keys],
+        [valuations[k]['avg_cost'] for k in keys], [valuations[k]['value'] for k in keys])
+    
+    consumed = [
+        (layer['layer_id'], layer['remaining_qty'])
+        for v in valuations.values() for layer in v['layers']
+        if layer['changed'] and layer['layer_id'] is not None
+    ]
+    if consumed:
+        await connection.execute("""
+            UPDATE stock_fifo_layer l SET remaining_qty = v.remaining_qty
+            FROM unnest($1::int[], $2::numeric[]) AS v(layer_id, remaining_qty)
+            WHERE l.layer_id = v.layer_id;
+        """, [c[0] for c in consumed], [c[1] for c in consumed])
+    
+    new_layers = [
+        (key[0], key[1], layer['trans_id'], layer['unit_cost'], layer['original_qty'], layer['remaining_qty'])
+        for key, v in valuations.items() for layer in v['layers']
+        if layer['layer_id'] is None
+    ]
+    if new_layers:
+        await connection.copy_records_to_table(
+            'stock_fifo_layer', records=new_layers,
+            columns=['item_id', 'warehouse_id', 'trans_id', 'unit_cost', 'original_qty', 'remaining_qty']
+        )
+
+async def rebuild_stock_valuations(connection, keys=None):
+    # Replay the ledger to rebuild valuation state, for the given keys or for all of them.
+    # Used after back-dated postings, whose cost effects cannot be applied incrementally.
+    params = []
+    key_filter = ""
+    if keys is not None:
+        keys = sorted(set(keys))
+        params = [[k[0] for k in keys], [k[1] for k in keys]]
+        key_filter = """
+            JOIN unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+              ON st.item_id = k.item_id AND COALESCE(st.warehouse_id, 0) = k.warehouse_id
+        """
+        await connection.execute("""
+            DELETE FROM stock_fifo_layer l
+            USING unnest($1::int[], $2::int[]) AS k(item_id, warehouse_id)
+            WHERE l.item_id = k.item_id AND l.warehouse_id = k.warehouse_id;
+        """, *params)
+    else:
+        await connection.execute("DELETE FROM stock_fifo_layer;")
+    opening_layers = await load_stock_opening_layers(connection, keys)
+    
+    valuations = {}
+    cursor = connection.cursor(f"""
+        SELECT st.trans_id, st.item_id, COALESCE(st.warehouse_id, 0) as warehouse_id,
+               st.trans_type, st.stock_qty, st.unit_cost
+        FROM stock_transactions st
+        {key_filter}
+        ORDER BY st.item_id, COALESCE(st.warehouse_id, 0), st.trans_date, st.trans_id
+    """, *params)
+    async for row in cursor:
+        key = (row['item_id'], row['warehouse_id'])
+        if key not in valuations:
+            if len(valuations) >= 1000:
+                await save_stock_valuations(connection, valuations)
+                valuations = {}
+            valuations[key] = {'qty': 0.0, 'value': 0.0, 'avg_cost': 0.0, 'layers': []}
+        if row['trans_type'] == 'OPENING':
+            apply_stock_opening(
+                valuations[key], float(row['stock_qty']), float(row['unit_cost'] or 0),
+                row['trans_id'], opening_layers
+            )
+        else:
+            apply_stock_valuation(
+                valuations[key], row['trans_type'], float(row['stock_qty']),
+                float(row['unit_cost'] or 0), row['trans_id']
+            )
+    if valuations:
+        await save_stock_valuations(connection, valuations)
+
+# Daily movement rollup
+# Postings accumulate (date, item, warehouse, type) totals in a dict which is then
+# added to stock_movement_daily in one upsert. qty_change is the signed effect on the
+# balance; for ADJUSTMENT it is the difference from the previous balance.
+def add_to_stock_rollup(rollup, movement_date, item_id, warehouse_id, trans_type, qty_change, unit_cost):
+    entry = rollup.setdefault((movement_date, item_id, warehouse_id, trans_type), [0.0, 0.0, 0.0, 0.0, 0])
+    if qty_change >= 0:
+        entry[0] += qty_change
+        entry[2] += qty_change * (unit_cost or 0)
+    else:
+        entry[1] -= qty_change
+        entry[3] -= qty_change * (unit_cost or 0)
+    entry[4] += 1
+
+async def save_stock_rollup(connection, rollup):
+    if not rollup:
+        return
+    keys = list(rollup)
+    await connection.execute("""
+        INSERT INTO stock_movement_daily (
+            movement_date, item_id, warehouse_id, trans_type,
+            qty_in, qty_out, value_in, value_out, trans_count
+        )
+        SELECT * FROM unnest(
+            $1::date[], $2::int[], $3::int[], $4::varchar[],
+            $5::numeric[], $6::numeric[], $7::numeric[], $8::numeric[], $9::int[]
+        )
+        ON CONFLICT (movement_date, item_id, warehouse_id, trans_type) DO UPDATE SET
+            qty_in = stock_movement_daily.qty_in + EXCLUDED.qty_in,
+            qty_out = stock_movement_daily.qty_out + EXCLUDED.qty_out,
+            value_in = stock_movement_daily.value_in + EXCLUDED.value_in,
+            value_out = stock_movement_daily.value_out + EXCLUDED.value_out,
+            trans_count = stock_movement_daily.trans_count + EXCLUDED.trans_count;
+    """,
+        [k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys], [k[3] for k in keys],
+        *[[rollup[k][i] for k in keys] for i in range(5)]
+    )
+
+def stock_rollup_from_ledger(source: str, key_filter: str = "") -> str:
+    # Rollup rows for ledger rows dated in [$1, $2), derived the way postings add them;
+    # an ADJUSTMENT counts as its difference from the balance before it
+    return f"""
+        INSERT INTO stock_movement_daily (
+            movement_date, item_id, warehouse_id, trans_type,
+            qty_in, qty_out, value_in, value_out, trans_count
+        )
+        SELECT st.trans_date::date, st.item_id, COALESCE(st.warehouse_id, 0), st.trans_type,
+               SUM(GREATEST(c.qty_change, 0)),
+               SUM(GREATEST(-c.qty_change, 0)),
+               SUM(GREATEST(c.qty_change, 0) * COALESCE(st.unit_cost, 0)),
+               SUM(GREATEST(-c.qty_change, 0) * COALESCE(st.unit_cost, 0)),
+               COUNT(*)
+        FROM {source} st
+        CROSS JOIN LATERAL (
+            SELECT CASE st.trans_type
+                WHEN 'IN' THEN st.stock_qty
+                WHEN 'OUT' THEN -st.stock_qty
+                ELSE st.stock_qty - COALESCE((
+                    SELECT p.balance_qty FROM {source} p
+                    WHERE p.item_id = st.item_id
+                      AND COALESCE(p.warehouse_id, 0) = COALESCE(st.warehouse_id, 0)
+                      AND (p.trans_date, p.trans_id) < (st.trans_date, st.trans_id)
+                    ORDER BY p.trans_date DESC, p.trans_id DESC
+                    LIMIT 1
+                ), 0)
+            END as qty_change
+        ) c
+        WHERE st.trans_date >= $1 AND st.trans_date < $2 AND st.trans_type <> 'OPENING' {key_filter}
+        GROUP BY 1, 2, 3, 4;
+    """
+
+# Running balance of a ledger row: IN adds, OUT subtracts and any other type
+# (ADJUSTMENT) resets the balance. Rows are split into segments at each reset,
+# so a windowed sum per segment reproduces the balance in one pass.
+STOCK_SIGNED_QTY = "CASE trans_type WHEN 'IN' THEN stock_qty WHEN 'OUT' THEN -stock_qty ELSE stock_qty END"
+STOCK_RESET_FLAG = "CASE WHEN trans_type IN ('IN', 'OUT') THEN 0 ELSE 1 END"
+
+async def recompute_stock_balances(connection, item_id: int, warehouse_id: int, from_date: datetime, from_trans_id: int = 0):
+    # Rewrite balance_qty for one (item, warehouse) from (from_date, from_trans_id)
+    # onwards, after a back-dated posting or an edit. The caller must hold the key's
+    # lock from lock_stock_balances.
+    key_filter = "item_id = $1 AND COALESCE(warehouse_id, 0) = $2"
+    result = await connection.execute(f"""
+        WITH anchor AS (
+            SELECT balance_qty FROM stock_transactions
+            WHERE {key_filter} AND (trans_date, trans_id) < ($3, $4)
+            ORDER BY trans_date DESC, trans_id DESC
+            LIMIT 1
+        ),
+        tail AS (
+            SELECT trans_id, trans_date, {STOCK_SIGNED_QTY} as signed_qty,
+                   SUM({STOCK_RESET_FLAG}) OVER (ORDER BY trans_date, trans_id) as seg
+            FROM stock_transactions
+            WHERE {key_filter} AND (trans_date, trans_id) >= ($3, $4)
+        ),
+        computed AS (
+            SELECT trans_id,
+                   CASE WHEN seg = 0 THEN COALESCE((SELECT balance_qty FROM anchor), 0) ELSE 0 END
+                   + SUM(signed_qty) OVER (PARTITION BY seg ORDER BY trans_date, trans_id) as new_balance
+            FROM tail
+        )
+        UPDATE stock_transactions st
+        SET balance_qty = c.new_balance
+        FROM computed c
+        WHERE st.trans_id = c.trans_id AND st.balance_qty IS DISTINCT FROM c.new_balance;
+    """, item_id, warehouse_id, from_date, from_trans_id)
+    
+    await connection.execute(f"""
+        UPDATE stock_balance sb
+        SET balance_qty = l.balance_qty, last_trans_id = l.trans_id, updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT trans_id, balance_qty FROM stock_transactions
+            WHERE {key_filter}
+            ORDER BY trans_date DESC, trans_id DESC
+            LIMIT 1
+        ) l
+        WHERE sb.item_id = $1 AND sb.warehouse_id = $2;
+    """, item_id, warehouse_id)
+    
+    # A changed balance changes the effective delta of every later ADJUSTMENT, so
+    # the key's rollup is re-derived from the change point's day onwards
+    from_day = datetime.combine(from_date.date(), time.min)
+    source = await stock_ledger_source(connection, from_day)
+    await connection.execute("""
+        DELETE FROM stock_movement_daily
+        WHERE item_id = $1 AND warehouse_id = $2 AND movement_date >= $3;
+    """, item_id, warehouse_id, from_day.date())
+    await connection.execute(
+        stock_rollup_from_ledger(source, "AND st.item_id = $3 AND COALESCE(st.warehouse_id, 0) = $4"),
+        from_day, datetime.max, item_id, warehouse_id
+    )
+    
+    await refresh_stock_snapshots(connection, item_id, warehouse_id, from_date)
+    await rebuild_stock_valuations(connection, [(item_id, warehouse_id)])
+    
+    return int(result.split()[-1])
+
+async def refresh_stock_snapshots(connection, item_id: int, warehouse_id: int, from_date: datetime):
+    # Snapshots taken after the change point no longer match the ledger for this key
+    await connection.execute("""
+        INSERT INTO stock_snapshot_balance (snapshot_date, item_id, warehouse_id, balance_qty)
+        SELECT s.snapshot_date, $1, $2, lb.balance_qty
+        FROM stock_snapshot s
+        CROSS JOIN LATERAL (
+            SELECT balance_qty FROM stock_transactions
+            WHERE item_id = $1 AND COALESCE(warehouse_id, 0) = $2 AND trans_date < s.snapshot_date + 1
+            ORDER BY trans_date DESC, trans_id DESC
+            LIMIT 1
+        ) lb
+        WHERE s.snapshot_date >= $3
+        ON CONFLICT (snapshot_date, item_id, warehouse_id) DO UPDATE SET balance_qty = EXCLUDED.balance_qty;
+    """, item_id, warehouse_id, from_date.date())
+
+@api_router.post("/stock-transactions", response_model=StockTransactionResponse, status_code=status.HTTP_201_CREATED)
+async def create_stock_transaction(transaction: StockTransactionCreate):
+    try:
+        async with pool.acquire() as connection:
+            # Validate item exists
+            item_exists = await connection.fetchrow(
+                "SELECT it_id FROM item_master WHERE it_id = $1;", transaction.item_id
+            )
+            if not item_exists:
+                raise HTTPException(status_code=400, detail=f"Item with ID {transaction.item_id} does not exist")
+            
+            # Validate warehouse if provided
+            if transaction.warehouse_id:
+                warehouse_exists = await connection.fetchrow(
+                    "SELECT whs_id FROM whs WHERE whs_id = $1;", transaction.warehouse_id
+                )
+                if not warehouse_exists:
+                    raise HTTPException(status_code=400, detail=f"Warehouse with ID {transaction.warehouse_id} does not exist")
+            
+            if transaction.trans_date:
+                if transaction.trans_date.tzinfo is not None:
+                    # Ledger dates are local timestamps; convert with the session time zone
+                    transaction.trans_date = await connection.fetchval(
+                        "SELECT $1::timestamptz::timestamp;", transaction.trans_date
+                    )
+                # A future-dated row would sit ahead of postings made before its date,
+                # which are dated by the clock and built on a balance that includes it
+                if transaction.trans_date > await connection.fetchval("SELECT clock_timestamp()::timestamp;"):
+                    raise HTTPException(status_code=400, detail="Transaction date cannot be in the future")
+                cutoff = await stock_archive_cutoff(connection)
+                if cutoff and transaction.trans_date < cutoff:
+                    raise HTTPException(status_code=400, detail=f"Transaction date falls in an archived period; postings must be on or after {cutoff.date()}")
+            
+            async with connection.transaction():
+                # Calculate running balance; the balance row stays locked until commit so
+                # concurrent postings for the same item and warehouse cannot both build on it
+                balance_key = (transaction.item_id, transaction.warehouse_id or 0)
+                balances = await lock_stock_balances(connection, [balance_key])
+                current_balance = balances[balance_key]
+                valuations = await load_stock_valuations(connection, [balance_key])
+                
+                if transaction.trans_type == 'IN':
+                    new_balance = current_balance + transaction.stock_qty
+                elif transaction.trans_type == 'OUT':
+                    new_balance = current_balance - transaction.stock_qty
+                else:  # ADJUSTMENT
+                    new_balance = transaction.stock_qty
+                
+                # Insert transaction. The default date is read from the clock now that the
+                # lock is held (not the transaction start, which may precede a wait on it),
+                # so ledger order always agrees with the order balances were built in.
+                insert_query = """
+                    INSERT INTO stock_transactions (
+                        item_id, trans_type, reference_type, reference_id, warehouse_id,
+                        stock_qty, unit_cost, balance_qty, remarks, created_by, trans_date
+                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, COALESCE($11, clock_timestamp()::timestamp))
+                    RETURNING trans_id, trans_date;
+                """
+                
+                inserted = await connection.fetchrow(
+                    insert_query,
+                    transaction.item_id,
+                    transaction.trans_type,
+                    transaction.reference_type,
+                    transaction.reference_id,
+                    transaction.warehouse_id,
+                    transaction.stock_qty,
+                    transaction.unit_cost or 0,
+                    new_balance,
+                    transaction.remarks,
+                    transaction.created_by,
+                    transaction.trans_date
+                )
+                
+                later_movement = transaction.trans_date and await connection.fetchval("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM stock_transactions
+                        WHERE item_id = $1 AND COALESCE(warehouse_id, 0) = $2 AND (trans_date, trans_id) > ($3, $4)
+                    );
+                """, transaction.item_id, transaction.warehouse_id or 0, inserted['trans_date'], inserted['trans_id'])
+                if later_movement:
+                    # A back-dated row shifts every later balance for this key; the
+                    # recompute also re-derives the key's rollup, this row included
+                    await recompute_stock_balances(
+                        connection, transaction.item_id, transaction.warehouse_id or 0,
+                        inserted['trans_date'], inserted['trans_id']
+                    )
+                else:
+                    # The row is the key's latest, so its balance already builds on the
+                    # current one; keep the balance table and valuation in step with it
+                    await connection.execute("""
+                        UPDATE stock_balance
+                        SET balance_qty = $3, last_trans_id = $4, updated_at = CURRENT_TIMESTAMP
+                        WHERE item_id = $1 AND warehouse_id = $2;
+                    """, transaction.item_id, transaction.warehouse_id or 0, new_balance, inserted['trans_id'])
+                    apply_stock_valuation(
+                        valuations[balance_key], transaction.trans_type, transaction.stock_qty,
+                        transaction.unit_cost or 0, inserted['trans_id']
+                    )
+                    await save_stock_valuations(connection, valuations)
+                    if transaction.trans_date:
+                        await refresh_stock_snapshots(
+                            connection, transaction.item_id, transaction.warehouse_id or 0, inserted['trans_date']
+                        )
+                    
+                    rollup = {}
+                    add_to_stock_rollup(
+                        rollup, inserted['trans_date'].date(), transaction.item_id, transaction.warehouse_id or 0,
+                        transaction.trans_type, new_balance - current_balance, transaction.unit_cost or 0
+                    )
+                    await save_stock_rollup(connection, rollup)
+            
+            # Fetch complete record with item details
+            full_query = """
+                SELECT st.*, im.it_code, im.it_name, wr.whs_name
+                FROM stock_transactions st
+                LEFT JOIN item_master im ON st.item_id = im.it_id
+                LEFT JOIN whs wr ON st.warehouse_id = wr.whs_id
+                WHERE st.trans_id = $1
+            """
+            full_record = await connection.fetchrow(full_query, inserted['trans_id'])
+            return dict(full_record)
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error creating stock transaction: {str(e)}")
+
+def stock_transaction_filters(item_id, warehouse_id, start_date, end_date, params):
+    # Build WHERE clauses for the ledger list/export endpoints. Dates become a
+    # half-open timestamp range so the trans_date indexes can be used.
+    clauses = []
+    if item_id:
+        params.append(item_id)
+        clauses.append(f"st.item_id = ${len(params)}")
+    if warehouse_id:
+        params.append(warehouse_id)
+        clauses.append(f"st.warehouse_id = ${len(params)}")
+    if start_date:
+        params.append(datetime.combine(start_date, time.min))
+        clauses.append(f"st.trans_date >= ${len(params)}")
+    if end_date:
+        params.append(datetime.combine(end_date + timedelta(days=1), time.min))
+        clauses.append(f"st.trans_date < ${len(params)}")
+    return clauses
+
+# Keyset pagination: pass the trans_date and trans_id of the last row on a page as
+# after_date/after_id to get the next page. skip is still honoured but deep offsets are slow.
+@api_router.get("/stock-transactions")
+async def get_stock_transactions(
+    item_id: Optional[int] = None,
+    warehouse_id: Optional[int] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    after_date: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    include_archived: bool = False,
+    skip: int = 0,
+    limit: int = 100
+):
+    try:
+        async with pool.acquire() as connection:
+            source = "stock_transactions"
+            if include_archived:
+                since = datetime.combine(start_date, time.min) if start_date else None
+                source = await stock_ledger_source(connection, since)
+            query = f"""
+                SELECT st.*, im.it_code, im.it_name, wr.whs_name
+                FROM {source} st
+                LEFT JOIN item_master im ON st.item_id = im.it_id
+                LEFT JOIN whs wr ON st.warehouse_id = wr.whs_id
+                WHERE 1=1
+            """
+            params = []
+            for clause in stock_transaction_filters(item_id, warehouse_id, start_date, end_date, params):
+                query += f" AND {clause}"
+            
+            if after_date and after_id:
+                params.extend([after_date, after_id])
+                query += f" AND (st.trans_date, st.trans_id) < (${len(params) - 1}, ${len(params)})"
+            
+            query += " ORDER BY st.trans_date DESC, st.trans_id DESC"
+            query += f" LIMIT ${len(params) + 1} OFFSET ${len(params) + 2}"
+            params.extend([limit, skip])
+            
+            records = await connection.fetch(query, *params)
+            return [dict(r) for r in records]
+            
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock transactions: {str(e)}")
+
+# Streaming ledger export
+STOCK_EXPORT_COLUMNS = [
+    'trans_id', 'trans_date', 'item_id', 'it_code', 'it_name', 'trans_type',
+    'reference_type', 'reference_id', 'warehouse_id', 'whs_name',
+    'stock_qty', 'unit_cost', 'balance_qty', 'remarks', 'created_by'
+]
+STOCK_EXPORT_CHUNK_SIZE = 2000
+
+def export_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+async def stream_stock_export(query, params, export_format):
+    # Rows come from a server-side cursor and leave as fixed-size text chunks, so
+    # memory use does not depend on the size of the ledger
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                csv.writer(buffer).writerow(STOCK_EXPORT_COLUMNS)
+                yield buffer.getvalue()
+            
+            cursor = await connection.cursor(query, *params)
+            while True:
+                rows = await cursor.fetch(STOCK_EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                buffer = io.StringIO()
+                if export_format == 'csv':
+                    writer = csv.writer(buffer)
+                    for row in rows:
+                        writer.writerow([export_value(row[c]) for c in STOCK_EXPORT_COLUMNS])
+                else:
+                    for row in rows:
+                        buffer.write(json.dumps({c: export_value(row[c]) for c in STOCK_EXPORT_COLUMNS}))
+                        buffer.write('\n')
+                yield buffer.getvalue()
+
+@api_router.get("/stock-transactions/export")
+async def export_stock_transactions(
+    item_id: Optional[int] = None,
+    warehouse_id: Optional[int] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_archived: bool = False,
+    format: str = "csv"
+):
+    if format not in ('csv', 'ndjson'):
+        raise HTTPException(status_code=400, detail="Invalid format. Must be 'csv' or 'ndjson'")
+    
+    source = "stock_transactions"
+    if include_archived:
+        since = datetime.combine(start_date, time.min) if start_date else None
+        async with pool.acquire() as connection:
+            source = await stock_ledger_source(connection, since)
+    query = f"""
+        SELECT st.*, im.it_code, im.it_name, wr.whs_name
+        FROM {source} st
+        LEFT JOIN item_master im ON st.item_id = im.it_id
+        LEFT JOIN whs wr ON st.warehouse_id = wr.whs_id
+        WHERE 1=1
+    """
+    params = []
+    for clause in stock_transaction_filters(item_id, warehouse_id, start_date, end_date, params):
+        query += f" AND {clause}"
+    query += " ORDER BY st.trans_date, st.trans_id"
+    
+    media_type = "text/csv" if format == 'csv' else "application/x-ndjson"
+    filename = f"stock_transactions.{format}"
+    return StreamingResponse(
+        stream_stock_export(query, params, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@api_router.get("/current-stock/{item_id}")
 async def get_current_stock(item_id: int, warehouse_id: Optional[int] = None):
     try:
         async with pool.acquire() as connection:
@@ -3555,8 +5800,9 @@ async def get_current_stock(item_id: int, warehouse_id: Optional[int] = None):
             if not item_exists:
                 raise HTTPException(status_code=404, detail="Item not found")
             
+            # Without a warehouse, report the total across all warehouses
             query = """
-                SELECT balance_qty FROM stock_transactions 
+                SELECT COALESCE(SUM(balance_qty), 0) as balance_qty FROM stock_balance 
                 WHERE item_id = $1
             """
             params = [item_id]
@@ -3565,19 +5811,1033 @@ async def get_current_stock(item_id: int, warehouse_id: Optional[int] = None):
                 query += " AND warehouse_id = $2"
                 params.append(warehouse_id)
             
-            query += " ORDER BY trans_date DESC, trans_id DESC LIMIT 1"
-            
             record = await connection.fetchrow(query, *params)
-            current_stock = record['balance_qty'] if record else 0
+            current_stock = float(record['balance_qty'])
+            
+            return {
+                "item_id": item_id,
+                "warehouse_id": warehouse_id,
+                "current_stock": current_stock
+            }
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching current stock: {str(e)}")
+
+# Latest ledger balance of every item x warehouse
+# Each key's balance is the windowed sum of its last segment (see STOCK_RESET_FLAG),
+# taken at its latest row, so the ledger is read once in one statement
+STOCK_BALANCE_FROM_LEDGER = f"""
+    INSERT INTO stock_balance (item_id, warehouse_id, balance_qty, last_trans_id, updated_at)
+    SELECT item_id, warehouse_id, balance_qty, trans_id, CURRENT_TIMESTAMP
+    FROM (
+        SELECT item_id, warehouse_id, trans_id, from_end,
+               SUM(signed_qty) OVER (
+                   PARTITION BY item_id, warehouse_id, seg ORDER BY trans_date, trans_id
+               ) as balance_qty
+        FROM (
+            SELECT item_id, COALESCE(warehouse_id, 0) as warehouse_id, trans_id, trans_date,
+                   {STOCK_SIGNED_QTY} as signed_qty,
+                   SUM({STOCK_RESET_FLAG}) OVER (
+                       PARTITION BY item_id, COALESCE(warehouse_id, 0) ORDER BY trans_date, trans_id
+                   ) as seg,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY item_id, COALESCE(warehouse_id, 0) ORDER BY trans_date DESC, trans_id DESC
+                   ) as from_end
+            FROM stock_transactions
+        ) segmented
+    ) balances
+    WHERE from_end = 1;
+"""
+STOCK_VALUATION_REBUILD_CHUNK = 500
+
+stock_valuation_task = None
+
+async def seed_stock_balance(connection):
+    # stock_balance is created empty; over an existing ledger it has to be filled before
+    # the first posting, which would otherwise build its balance on 0. Workers starting
+    # together serialize on the advisory lock and only the first one seeds. Valuations
+    # are left to rebuild_seeded_stock_valuations, which runs in the background.
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock(hashtext('stock_balance_seed'));")
+        if await connection.fetchval("SELECT EXISTS (SELECT 1 FROM stock_balance);"):
+            return 0
+        result = await connection.execute(STOCK_BALANCE_FROM_LEDGER)
+        return int(result.split()[-1])
+
+async def rebuild_seeded_stock_valuations():
+    # Replay the ledger for valuations a chunk of keys at a time, each chunk under its
+    # balance locks, so postings carry on in between. A posting made before its key's
+    # chunk is replayed is simply replayed with it.
+    try:
+        async with pool.acquire() as connection:
+            keys = [
+                (r['item_id'], r['warehouse_id'])
+                for r in await connection.fetch("SELECT item_id, warehouse_id FROM stock_balance ORDER BY item_id, warehouse_id;")
+            ]
+            for i in range(0, len(keys), STOCK_VALUATION_REBUILD_CHUNK):
+                chunk = keys[i:i + STOCK_VALUATION_REBUILD_CHUNK]
+                async with connection.transaction():
+                    await lock_stock_balances(connection, chunk)
+                    await rebuild_stock_valuations(connection, chunk)
+        print(f"Rebuilt stock valuations for {len(keys)} item/warehouse keys.")
+    except Exception as e:
+        print(f"Error rebuilding stock valuations: {e}; POST /api/stock-balance/rebuild to retry")
+
+@api_router.post("/stock-balance/rebuild")
+async def rebuild_stock_balance():
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                # Block postings while the balances are recomputed from the ledger
+                await connection.execute("LOCK TABLE stock_balance IN EXCLUSIVE MODE;")
+                await connection.execute("DELETE FROM stock_balance;")
+                result = await connection.execute(STOCK_BALANCE_FROM_LEDGER)
+                await rebuild_stock_valuations(connection)
+            return {"message": "Stock balance rebuilt successfully", "balances": int(result.split()[-1])}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding stock balance: {str(e)}")
+
+@api_router.post("/stock-balance/recompute")
+async def recompute_stock_balance(request: StockRecomputeRequest):
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                key = (request.item_id, request.warehouse_id or 0)
+                await lock_stock_balances(connection, [key])
+                updated = await recompute_stock_balances(connection, key[0], key[1], request.from_date)
+            return {"item_id": key[0], "warehouse_id": key[1], "updated_rows": updated}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error recomputing stock balance: {str(e)}")
+
+@api_router.get("/stock-balance/verify")
+async def verify_stock_balance(limit: int = 100):
+    # Recompute every running balance in one pass over the ledger and report the keys
+    # whose stored balances have drifted, with the first drifted row as the point to
+    # recompute from
+    try:
+        async with pool.acquire() as connection:
+            drift_query = f"""
+                WITH segmented AS (
+                    SELECT trans_id, trans_date, item_id, COALESCE(warehouse_id, 0) as warehouse_id,
+                           balance_qty, {STOCK_SIGNED_QTY} as signed_qty,
+                           SUM({STOCK_RESET_FLAG}) OVER (
+                               PARTITION BY item_id, COALESCE(warehouse_id, 0) ORDER BY trans_date, trans_id
+                           ) as seg
+                    FROM stock_transactions
+                ),
+                computed AS (
+                    SELECT *, SUM(signed_qty) OVER (
+                               PARTITION BY item_id, warehouse_id, seg ORDER BY trans_date, trans_id
+                           ) as expected_balance
+                    FROM segmented
+                )
+                SELECT item_id, warehouse_id,
+                       COUNT(*) as drifted_rows,
+                       MIN(trans_date) as first_drift_date
+                FROM computed
+                WHERE balance_qty IS DISTINCT FROM expected_balance
+                GROUP BY item_id, warehouse_id
+                ORDER BY item_id, warehouse_id
+                LIMIT $1;
+            """
+            drifted = await connection.fetch(drift_query, limit)
+            
+            # The balance table must match the last ledger row of every key
+            balance_query = """
+                SELECT COALESCE(sb.item_id, l.item_id) as item_id,
+                       COALESCE(sb.warehouse_id, l.warehouse_id) as warehouse_id,
+                       sb.balance_qty as stored_balance,
+                       l.balance_qty as ledger_balance
+                FROM stock_balance sb
+                FULL JOIN (
+                    SELECT DISTINCT ON (item_id, COALESCE(warehouse_id, 0))
+                        item_id, COALESCE(warehouse_id, 0) as warehouse_id, balance_qty
+                    FROM stock_transactions
+                    ORDER BY item_id, COALESCE(warehouse_id, 0), trans_date DESC, trans_id DESC
+                ) l ON sb.item_id = l.item_id AND sb.warehouse_id = l.warehouse_id
+                WHERE COALESCE(sb.balance_qty, 0) IS DISTINCT FROM COALESCE(l.balance_qty, 0)
+                ORDER BY 1, 2
+                LIMIT $1;
+            """
+            mismatched = await connection.fetch(balance_query, limit)
+            
+            return {
+                "ok": not drifted and not mismatched,
+                "ledger_drift": [dict(r) for r in drifted],
+                "balance_mismatch": [dict(r) for r in mismatched]
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error verifying stock balance: {str(e)}")
+
+@api_router.get("/stock-valuation")
+async def get_stock_valuation(
+    item_id: Optional[int] = None,
+    warehouse_id: Optional[int] = None,
+    item_group: Optional[int] = None
+):
+    try:
+        async with pool.acquire() as connection:
+            query = """
+                SELECT sb.item_id, im.it_code, im.it_name, sb.warehouse_id, wr.whs_name,
+                       sb.balance_qty, sb.avg_cost,
+                       sb.stock_value as moving_average_value,
+                       COALESCE(f.fifo_value, 0) as fifo_value
+                FROM stock_balance sb
+                JOIN item_master im ON sb.item_id = im.it_id
+                LEFT JOIN whs wr ON sb.warehouse_id = wr.whs_id
+                LEFT JOIN LATERAL (
+                    SELECT SUM(l.remaining_qty * l.unit_cost) as fifo_value
+                    FROM stock_fifo_layer l
+                    WHERE l.item_id = sb.item_id AND l.warehouse_id = sb.warehouse_id AND l.remaining_qty > 0
+                ) f ON true
+                WHERE sb.balance_qty <> 0
+            """
+            params = []
+            if item_id:
+                params.append(item_id)
+                query += f" AND sb.item_id = ${len(params)}"
+            if warehouse_id:
+                params.append(warehouse_id)
+                query += f" AND sb.warehouse_id = ${len(params)}"
+            if item_group:
+                params.append(item_group)
+                query += f" AND im.it_group = ${len(params)}"
+            query += " ORDER BY im.it_code, sb.warehouse_id"
+            
+            records = await connection.fetch(query, *params)
+            lines = [dict(r) for r in records]
+            return {
+                "total_moving_average_value": float(sum(r['moving_average_value'] for r in lines)),
+                "total_fifo_value": float(sum(r['fifo_value'] for r in lines)),
+                "lines": lines
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock valuation: {str(e)}")
+
+@api_router.post("/stock-rollup/backfill")
+async def backfill_stock_rollup(start_date: date, end_date: date):
+    # Rebuild the daily rollup for a date range from the ledger
+    try:
+        if start_date > end_date:
+            raise HTTPException(status_code=400, detail="End date must not be before start date")
+        async with pool.acquire() as connection:
+            # Days before the archive cutoff are rebuilt from the archived partitions
+            source = await stock_ledger_source(connection, datetime.combine(start_date, time.min))
+            async with connection.transaction():
+                await connection.execute(
+                    "DELETE FROM stock_movement_daily WHERE movement_date BETWEEN $1 AND $2;",
+                    start_date, end_date
+                )
+                result = await connection.execute(
+                    stock_rollup_from_ledger(source),
+                    datetime.combine(start_date, time.min), datetime.combine(end_date + timedelta(days=1), time.min)
+                )
+            return {"message": "Stock rollup backfilled successfully", "rows": int(result.split()[-1])}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error backfilling stock rollup: {str(e)}")
+
+@api_router.get("/stock-rollup")
+async def get_stock_rollup(
+    start_date: date,
+    end_date: date,
+    item_id: Optional[int] = None,
+    warehouse_id: Optional[int] = None,
+    trans_type: Optional[str] = None,
+    group_by: str = "month",
+    per_item: bool = False
+):
+    try:
+        if group_by not in ('day', 'week', 'month'):
+            raise HTTPException(status_code=400, detail="Invalid group_by. Must be 'day', 'week' or 'month'")
+        async with pool.acquire() as connection:
+            item_column = "item_id, " if per_item else ""
+            query = f"""
+                SELECT date_trunc('{group_by}', movement_date)::date as period, {item_column}trans_type,
+                       SUM(qty_in) as qty_in, SUM(qty_out) as qty_out,
+                       SUM(value_in) as value_in, SUM(value_out) as value_out,
+                       SUM(trans_count) as trans_count
+                FROM stock_movement_daily
+                WHERE movement_date BETWEEN $1 AND $2
+            """
+            params = [start_date, end_date]
+            if item_id:
+                params.append(item_id)
+                query += f" AND item_id = ${len(params)}"
+            if warehouse_id:
+                params.append(warehouse_id)
+                query += f" AND warehouse_id = ${len(params)}"
+            if trans_type:
+                params.append(trans_type)
+                query += f" AND trans_type = ${len(params)}"
+            query += f" GROUP BY 1, {item_column}trans_type ORDER BY 1, {item_column}trans_type"
+            
+            records = await connection.fetch(query, *params)
+            return [dict(r) for r in records]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock rollup: {str(e)}")
+
+# Point-in-time stock
+async def fetch_stock_as_of(connection, as_of: date, item_id: Optional[int] = None, warehouse_id: Optional[int] = None):
+    # Balances at the end of as_of: start from the nearest snapshot on or before that
+    # date and overlay the last ledger balance of every key that moved after it
+    snapshot = await connection.fetchrow(
+        "SELECT snapshot_date FROM stock_snapshot WHERE snapshot_date <= $1 ORDER BY snapshot_date DESC LIMIT 1;",
+        as_of
+    )
+    snapshot_date = snapshot['snapshot_date'] if snapshot else None
+    
+    params = [snapshot_date, datetime.combine(as_of + timedelta(days=1), time.min)]
+    snap_filter = ""
+    move_filter = "st.trans_date < $2"
+    since = None
+    if snapshot_date:
+        since = datetime.combine(snapshot_date + timedelta(days=1), time.min)
+        params.append(since)
+        move_filter += f" AND st.trans_date >= ${len(params)}"
+    source = await stock_ledger_source(connection, since)
+    if item_id:
+        params.append(item_id)
+        snap_filter += f" AND s.item_id = ${len(params)}"
+        move_filter += f" AND st.item_id = ${len(params)}"
+    if warehouse_id:
+        params.append(warehouse_id)
+        snap_filter += f" AND s.warehouse_id = ${len(params)}"
+        move_filter += f" AND st.warehouse_id = ${len(params)}"
+    
+    query = f"""
+        WITH snap AS (
+            SELECT s.item_id, s.warehouse_id, s.balance_qty
+            FROM stock_snapshot_balance s
+            WHERE s.snapshot_date = $1 {snap_filter}
+        ),
+        moves AS (
+            SELECT DISTINCT ON (st.item_id, COALESCE(st.warehouse_id, 0))
+                st.item_id, COALESCE(st.warehouse_id, 0) as warehouse_id, st.balance_qty
+            FROM {source} st
+            WHERE {move_filter}
+            ORDER BY st.item_id, COALESCE(st.warehouse_id, 0), st.trans_date DESC, st.trans_id DESC
+        )
+        SELECT
+            COALESCE(m.item_id, s.item_id) as item_id,
+            COALESCE(m.warehouse_id, s.warehouse_id) as warehouse_id,
+            COALESCE(m.balance_qty, s.balance_qty) as balance_qty
+        FROM snap s
+        FULL JOIN moves m ON s.item_id = m.item_id AND s.warehouse_id = m.warehouse_id
+        ORDER BY 1, 2;
+    """
+    records = await connection.fetch(query, *params)
+    return snapshot_date, records
+
+async def build_stock_snapshot(connection, snapshot_date: date):
+    # Built incrementally from the previous snapshot plus the movements since then;
+    # an existing snapshot for the same date is replaced
+    async with connection.transaction():
+        await connection.execute("DELETE FROM stock_snapshot WHERE snapshot_date = $1;", snapshot_date)
+        _, records = await fetch_stock_as_of(connection, snapshot_date)
+        await connection.execute(
+            "INSERT INTO stock_snapshot (snapshot_date, row_count) VALUES ($1, $2);",
+            snapshot_date, len(records)
+        )
+        await connection.copy_records_to_table(
+            'stock_snapshot_balance',
+            records=[(snapshot_date, r['item_id'], r['warehouse_id'], r['balance_qty']) for r in records],
+            columns=['snapshot_date', 'item_id', 'warehouse_id', 'balance_qty']
+        )
+    return len(records)
+
+@api_router.post("/stock-snapshots", status_code=status.HTTP_201_CREATED)
+async def create_stock_snapshot(snapshot_date: date):
+    try:
+        async with pool.acquire() as connection:
+            # A day still in progress would be frozen without its later postings, and
+            # as-of queries only apply movements from the day after a snapshot
+            if snapshot_date >= await connection.fetchval("SELECT CURRENT_DATE;"):
+                raise HTTPException(status_code=400, detail="Snapshots can only be taken for days that have ended")
+            row_count = await build_stock_snapshot(connection, snapshot_date)
+            return {"snapshot_date": snapshot_date, "row_count": row_count}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating stock snapshot: {str(e)}")
+
+@api_router.get("/stock-snapshots")
+async def get_stock_snapshots():
+    try:
+        async with pool.acquire() as connection:
+            records = await connection.fetch("SELECT * FROM stock_snapshot ORDER BY snapshot_date DESC;")
+            return [dict(r) for r in records]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock snapshots: {str(e)}")
+
+@api_router.get("/stock-as-of")
+async def get_stock_as_of(as_of: date, item_id: Optional[int] = None, warehouse_id: Optional[int] = None):
+    try:
+        async with pool.acquire() as connection:
+            snapshot_date, records = await fetch_stock_as_of(connection, as_of, item_id, warehouse_id)
+            return {
+                "as_of": as_of,
+                "snapshot_date": snapshot_date,
+                "balances": [
+                    {
+                        "item_id": r['item_id'],
+                        "warehouse_id": r['warehouse_id'],
+                        "balance_qty": float(r['balance_qty'])
+                    }
+                    for r in records
+                ]
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock as of date: {str(e)}")
+
+# Ledger partitioning and archival
+# POST /stock-ledger/partition converts stock_transactions into a table range-partitioned
+# by trans_date with one partition per month (stock_transactions_pYYYYMM) and a default
+# partition. Archiving a closed period detaches its whole months into
+# stock_transactions_archive. Periods need not end on a month end, so any earlier rows
+# left in a month that is still live are moved into the archive's default partition.
+# Every balance is carried forward as an OPENING row dated just before the cutoff, in a
+# stock_transactions_oYYYYMMDD partition of its own when that month was detached.
+# OPENING resets the running balance like ADJUSTMENT, so balances, recomputes and
+# valuation rebuilds never need the archived rows. The FIFO layers open at the cutoff
+# are kept in stock_opening_layer against their OPENING row, so a rebuild restores
+# them instead of a single layer at the average cost.
+STOCK_ARCHIVE_TABLESPACE = os.getenv('STOCK_ARCHIVE_TABLESPACE')
+STOCK_PARTITION_CHECK_INTERVAL = 6 * 3600  # Seconds between checks for upcoming month partitions
+
+stock_partition_task = None
+
+def next_month(value: date) -> date:
+    return (value.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+async def stock_ledger_is_partitioned(connection) -> bool:
+    return await connection.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = 'stock_transactions'::regclass;")
+
+async def stock_archive_cutoff(connection) -> Optional[datetime]:
+    return await connection.fetchval("SELECT MAX(cutoff) FROM stock_ledger_archive;")
+
+async def stock_ledger_source(connection, since: Optional[datetime]) -> str:
+    # Reads reaching back before the archive cutoff also scan the archived partitions
+    cutoff = await stock_archive_cutoff(connection)
+    if cutoff and (since is None or since < cutoff):
+        return "(SELECT * FROM stock_transactions UNION ALL SELECT * FROM stock_transactions_archive)"
+    return "stock_transactions"
+
+async def ensure_stock_ledger_partitions(connection, first: date, last: date):
+    # Create any missing month partitions from first to last, inclusive. Rows that
+    # already landed in the default partition for a month are moved into it.
+    if not await stock_ledger_is_partitioned(connection):
+        return []
+    created = []
+    month = first.replace(day=1)
+    while month <= last:
+        following = next_month(month)
+        name = f"stock_transactions_p{month:%Y%m}"
+        # Archived months keep their partition name, so they are never recreated
+        if not await connection.fetchval("SELECT to_regclass($1) IS NOT NULL;", name):
+            async with connection.transaction():
+                # Workers starting together would race between the check and the create,
+                # so check again once the other worker's partition would be visible
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext('stock_ledger_partitions'));")
+                exists = await connection.fetchval("SELECT to_regclass($1) IS NOT NULL;", name)
+                if not exists:
+                    await connection.execute(
+                        f"CREATE TABLE {name} (LIKE stock_transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+                    )
+                    await connection.execute(f"""
+                        WITH moved AS (
+                            DELETE FROM stock_transactions_default
+                            WHERE trans_date >= $1 AND trans_date < $2
+                            RETURNING *
+                        )
+                        INSERT INTO {name} SELECT * FROM moved;
+                    """, datetime.combine(month, time.min), datetime.combine(following, time.min))
+                    await connection.execute(
+                        f"ALTER TABLE stock_transactions ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{following}');"
+                    )
+            if not exists:
+                created.append(name)
+        month = following
+    return created
+
+async def run_stock_ledger_partition_maintenance():
+    # Keep monthly partitions created ahead of the postings that need them for as long
+    # as the server runs, so new rows never fall through to the default partition
+    while True:
+        try:
+            async with pool.acquire() as connection:
+                today = date.today()
+                await ensure_stock_ledger_partitions(connection, today, next_month(next_month(today)))
+        except Exception as e:
+            print(f"Error creating stock ledger partitions: {e}")
+        await asyncio.sleep(STOCK_PARTITION_CHECK_INTERVAL)
+
+@api_router.post("/stock-ledger/partition")
+async def partition_stock_ledger():
+    # One-off conversion of the ledger into monthly partitions
+    try:
+        async with pool.acquire() as connection:
+            if await stock_ledger_is_partitioned(connection):
+                raise HTTPException(status_code=400, detail="Stock ledger is already partitioned")
+            
+            async with connection.transaction():
+                await connection.execute("LOCK TABLE stock_transactions IN ACCESS EXCLUSIVE MODE;")
+                await connection.execute("ALTER TABLE stock_transactions RENAME TO stock_transactions_unpartitioned;")
+                sequence = await connection.fetchval(
+                    "SELECT pg_get_serial_sequence('stock_transactions_unpartitioned', 'trans_id');"
+                )
+                if not sequence:
+                    raise HTTPException(status_code=400, detail="stock_transactions.trans_id is not backed by a sequence")
+                
+                await connection.execute("""
+                    CREATE TABLE stock_transactions (
+                        LIKE stock_transactions_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                    ) PARTITION BY RANGE (trans_date);
+                    CREATE TABLE stock_transactions_default PARTITION OF stock_transactions DEFAULT;
+                    CREATE TABLE IF NOT EXISTS stock_transactions_archive (
+                        LIKE stock_transactions_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                    ) PARTITION BY RANGE (trans_date);
+                """)
+                
+                bounds = await connection.fetchrow(
+                    "SELECT MIN(trans_date) as first_date, MAX(trans_date) as last_date FROM stock_transactions_unpartitioned;"
+                )
+                today = date.today()
+                first = bounds['first_date'].date() if bounds['first_date'] else today
+                last = max(bounds['last_date'].date() if bounds['last_date'] else today, today)
+                partitions = await ensure_stock_ledger_partitions(connection, first, next_month(next_month(last)))
+                
+                result = await connection.execute(
+                    "INSERT INTO stock_transactions SELECT * FROM stock_transactions_unpartitioned;"
+                )
+                await connection.execute(f"ALTER SEQUENCE {sequence} OWNED BY stock_transactions.trans_id;")
+                await connection.execute("DROP TABLE stock_transactions_unpartitioned;")
+                # The partition key has to be part of the primary key
+                await connection.execute("ALTER TABLE stock_transactions ADD PRIMARY KEY (trans_id, trans_date);")
+                # Recreates the ledger indexes on the partitioned table; the table is
+                # locked for the conversion anyway, so they are built in place
+                for name, columns in STOCK_LEDGER_INDEXES.items():
+                    await connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON stock_transactions ({columns});")
+            
+            return {
+                "message": "Stock ledger partitioned successfully",
+                "partitions": partitions,
+                "rows": int(result.split()[-1])
+            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error partitioning stock ledger: {str(e)}")
+
+@api_router.get("/stock-ledger/partitions")
+async def get_stock_ledger_partitions():
+    try:
+        async with pool.acquire() as connection:
+            records = await connection.fetch("""
+                SELECT c.relname as partition_name, p.relname as parent,
+                       pg_get_expr(c.relpartbound, c.oid) as bounds,
+                       c.reltuples::bigint as approx_rows,
+                       t.spcname as tablespace
+                FROM pg_inherits i
+                JOIN pg_class c ON i.inhrelid = c.oid
+                JOIN pg_class p ON i.inhparent = p.oid
+                LEFT JOIN pg_tablespace t ON c.reltablespace = t.oid
+                WHERE p.relname IN ('stock_transactions', 'stock_transactions_archive')
+                ORDER BY p.relname DESC, c.relname;
+            """)
+            archived = await connection.fetch("SELECT * FROM stock_ledger_archive ORDER BY cutoff;")
+            return {
+                "partitioned": await stock_ledger_is_partitioned(connection),
+                "partitions": [dict(r) for r in records],
+                "archived_periods": [dict(r) for r in archived]
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching stock ledger partitions: {str(e)}")
+
+@api_router.post("/stock-ledger/archive")
+async def archive_stock_ledger(period_id: int):
+    try:
+        async with pool.acquire() as connection:
+            if not await stock_ledger_is_partitioned(connection):
+                raise HTTPException(status_code=400, detail="Partition the stock ledger before archiving")
+            
+            period = await connection.fetchrow(
+                "SELECT period_id, period_code, end_date, period_status FROM posting_periods WHERE period_id = $1;",
+                period_id
+            )
+            if not period:
+                raise HTTPException(status_code=404, detail="Posting period not found")
+            if period['period_status'] != 'Closed':
+                raise HTTPException(status_code=400, detail="Only closed posting periods can be archived")
+            
+            # Archiving is cumulative, so every earlier period has to be closed as well
+            still_open = await connection.fetchval("""
+                SELECT period_code FROM posting_periods
+                WHERE start_date <= $1 AND period_status <> 'Closed'
+                ORDER BY start_date
+                LIMIT 1;
+            """, period['end_date'])
+            if still_open:
+                raise HTTPException(status_code=400, detail=f"Posting period {still_open} is not closed")
+            
+            cutoff = datetime.combine(period['end_date'] + timedelta(days=1), time.min)
+            previous_cutoff = await stock_archive_cutoff(connection)
+            if previous_cutoff and cutoff <= previous_cutoff:
+                raise HTTPException(status_code=400, detail=f"Stock ledger is already archived up to {previous_cutoff.date()}")
+            
+            async with connection.transaction():
+                # Hold writes off while the pre-cutoff ledger is replayed; reads carry on
+                await connection.execute("LOCK TABLE stock_transactions IN SHARE ROW EXCLUSIVE MODE;")
+                
+                # Replay everything before the cutoff for the carried-forward quantity, cost
+                # and open FIFO layers
+                opening_layers = await load_stock_opening_layers(connection)
+                valuations = {}
+                balances = {}
+                cursor = connection.cursor("""
+                    SELECT trans_id, item_id, COALESCE(warehouse_id, 0) as warehouse_id, trans_type,
+                           stock_qty, unit_cost, balance_qty
+                    FROM stock_transactions
+                    WHERE trans_date < $1
+                    ORDER BY item_id, COALESCE(warehouse_id, 0), trans_date, trans_id
+                """, cutoff)
+                async for row in cursor:
+                    key = (row['item_id'], row['warehouse_id'])
+                    valuation = valuations.setdefault(key, {'qty': 0.0, 'value': 0.0, 'avg_cost': 0.0, 'layers': []})
+                    if row['trans_type'] == 'OPENING':
+                        apply_stock_opening(
+                            valuation, float(row['stock_qty']), float(row['unit_cost'] or 0),
+                            row['trans_id'], opening_layers
+                        )
+                    else:
+                        apply_stock_valuation(
+                            valuation, row['trans_type'], float(row['stock_qty']),
+                            float(row['unit_cost'] or 0), row['trans_id']
+                        )
+                    balances[key] = float(row['balance_qty'])
+                
+                # Earlier carried-forward rows and their layers are superseded by the new ones
+                await connection.execute("""
+                    DELETE FROM stock_opening_layer
+                    WHERE opening_trans_id IN (
+                        SELECT trans_id FROM stock_transactions WHERE trans_type = 'OPENING' AND trans_date < $1
+                    );
+                """, cutoff)
+                await connection.execute(
+                    "DELETE FROM stock_transactions WHERE trans_type = 'OPENING' AND trans_date < $1;", cutoff
+                )
+                
+                # Detaching needs the exclusive lock; it is only held for the detach and insert
+                await connection.execute("LOCK TABLE stock_transactions IN ACCESS EXCLUSIVE MODE;")
+                # Holds archived rows whose month is still live, when a period ends mid-month
+                await connection.execute(
+                    "CREATE TABLE IF NOT EXISTS stock_transactions_archive_default PARTITION OF stock_transactions_archive DEFAULT"
+                    + (f" TABLESPACE {STOCK_ARCHIVE_TABLESPACE};" if STOCK_ARCHIVE_TABLESPACE else ";")
+                )
+                partitions = []
+                months = await connection.fetch("""
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON i.inhrelid = c.oid
+                    WHERE i.inhparent = 'stock_transactions'::regclass
+                      AND c.relname ~ '^stock_transactions_p[0-9]{6}$'
+                    ORDER BY c.relname;
+                """)
+                for m in months:
+                    name = m['relname']
+                    month = datetime.strptime(name[-6:], '%Y%m').date()
+                    following = next_month(month)
+                    if datetime.combine(following, time.min) > cutoff:
+                        continue
+                    await connection.execute(f"ALTER TABLE stock_transactions DETACH PARTITION {name};")
+                    # Rows of this month moved at an earlier mid-month cutoff join it
+                    await connection.execute(f"""
+                        WITH moved AS (
+                            DELETE FROM stock_transactions_archive_default
+                            WHERE trans_date >= $1 AND trans_date < $2
+                            RETURNING *
+                        )
+                        INSERT INTO {name} SELECT * FROM moved;
+                    """, datetime.combine(month, time.min), datetime.combine(following, time.min))
+                    await connection.execute(
+                        f"ALTER TABLE stock_transactions_archive ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{following}');"
+                    )
+                    if STOCK_ARCHIVE_TABLESPACE:
+                        await connection.execute(f"ALTER TABLE {name} SET TABLESPACE {STOCK_ARCHIVE_TABLESPACE};")
+                    partitions.append(name)
+                
+                # Periods need not end on a month end: the pre-cutoff rows left in a live
+                # month (or in the default partition) are moved to the archive as well, so
+                # the live ledger starts exactly at the cutoff
+                moved = await connection.execute("""
+                    WITH moved AS (
+                        DELETE FROM stock_transactions WHERE trans_date < $1 RETURNING *
+                    )
+                    INSERT INTO stock_transactions_archive SELECT * FROM moved;
+                """, cutoff)
+                moved_rows = int(moved.split()[-1])
+                
+                # The carried-forward rows get a partition of their own when their month has
+                # just been detached, rather than falling into the default partition. The
+                # previous cutoff's one is empty now that its OPENING rows are superseded.
+                opening_date = cutoff - timedelta(microseconds=1)
+                old_openings = await connection.fetch("""
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON i.inhrelid = c.oid
+                    WHERE i.inhparent = 'stock_transactions'::regclass
+                      AND c.relname ~ '^stock_transactions_o[0-9]{8}$';
+                """)
+                for o in old_openings:
+                    await connection.execute(f"DROP TABLE {o['relname']};")
+                live_months = {m['relname'] for m in months} - set(partitions)
+                if f"stock_transactions_p{opening_date:%Y%m}" not in live_months:
+                    await connection.execute(
+                        f"CREATE TABLE stock_transactions_o{cutoff:%Y%m%d} PARTITION OF stock_transactions "
+                        f"FOR VALUES FROM ('{opening_date.isoformat(sep=' ')}') TO ('{cutoff.isoformat(sep=' ')}');"
+                    )
+                
+                # Inserted after detaching so the rows stay in the live ledger
+                carried = [(key, balance) for key, balance in balances.items() if balance]
+                trans_ids = await connection.fetch(
+                    "SELECT nextval(pg_get_serial_sequence('stock_transactions', 'trans_id')) as trans_id FROM generate_series(1, $1);",
+                    len(carried)
+                )
+                records = []
+                layer_records = []
+                for (key, balance), trans in zip(carried, trans_ids):
+                    records.append((
+                        trans['trans_id'], key[0], 'OPENING', 'ARCHIVE', period['period_code'], key[1] or None,
+                        balance, valuations[key]['avg_cost'], balance,
+                        'Balance carried forward from archived periods', None, opening_date
+                    ))
+                    open_layers = [l for l in valuations[key]['layers'] if l['remaining_qty'] > 0]
+                    layer_records.extend(
+                        (trans['trans_id'], layer_no, key[0], key[1], l['trans_id'], l['unit_cost'], l['remaining_qty'])
+                        for layer_no, l in enumerate(open_layers, start=1)
+                    )
+                if records:
+                    await connection.copy_records_to_table(
+                        'stock_transactions', records=records, columns=['trans_id'] + STOCK_IMPORT_COLUMNS + ['trans_date']
+                    )
+                if layer_records:
+                    await connection.copy_records_to_table(
+                        'stock_opening_layer', records=layer_records,
+                        columns=['opening_trans_id', 'layer_no', 'item_id', 'warehouse_id', 'trans_id', 'unit_cost', 'remaining_qty']
+                    )
+                
+                await connection.execute("""
+                    INSERT INTO stock_ledger_archive (period_id, cutoff, partitions, opening_rows)
+                    VALUES ($1, $2, $3, $4);
+                """, period_id, cutoff, partitions, len(records))
             
             return {
-                "item_id": item_id,
-                "warehouse_id": warehouse_id,
-                "current_stock": current_stock
+                "message": "Stock ledger archived successfully",
+                "cutoff": cutoff,
+                "partitions": partitions,
+                "moved_rows": moved_rows,
+                "opening_rows": len(records)
             }
-            
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching current stock: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error archiving stock ledger: {str(e)}")
+
+# Bulk stock import
+STOCK_IMPORT_COLUMNS = [
+    'item_id', 'trans_type', 'reference_type', 'reference_id', 'warehouse_id',
+    'stock_qty', 'unit_cost', 'balance_qty', 'remarks', 'created_by'
+]
+STOCK_IMPORT_BATCH_SIZE = 5000
+STOCK_IMPORT_PROGRESS_RETENTION = timedelta(days=7)
+
+async def iter_body_lines(request: Request):
+    # Decode the request body incrementally and yield complete text lines, line
+    # endings included, so the uploaded file is never held in memory as a whole
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+async def iter_numbered_lines(request: Request):
+    line_no = 0
+    async for line in iter_body_lines(request):
+        line_no += 1
+        yield line_no, line.strip(), None
+
+def csv_quote_open(line: str, in_quotes: bool) -> bool:
+    # Whether a CSV record is still inside a quoted field at the end of line, using the
+    # csv module's default dialect: a quote opens a field only at the start of the
+    # field, and inside a quoted field a doubled quote is a literal one. A quote
+    # anywhere else (an inch mark, say) is plain text.
+    if '"' not in line:
+        return in_quotes
+    state = 'quoted' if in_quotes else 'start'
+    for ch in line:
+        if state == 'start':
+            state = 'quoted' if ch == '"' else 'start' if ch == ',' else 'field'
+        elif state == 'field':
+            if ch == ',':
+                state = 'start'
+        elif state == 'quoted':
+            if ch == '"':
+                state = 'closing'
+        else:  # closing: just after a quote inside a quoted field
+            state = 'quoted' if ch == '"' else 'start' if ch == ',' else 'field'
+    return state == 'quoted'
+
+async def iter_csv_rows(request: Request):
+    # Yield (line_no, values, error) for each CSV record of the streamed body; line_no
+    # is the record's first line. Lines are gathered until the record's quoted fields
+    # are closed, so quoted fields may contain newlines. A record csv cannot parse is
+    # yielded with values None and the error, so callers can report it and go on.
+    lines = []
+    line_no = 0
+    first_line = None
+    in_quotes = False
+    async for line in iter_body_lines(request):
+        line_no += 1
+        lines.append(line)
+        first_line = first_line or line_no
+        in_quotes = csv_quote_open(line, in_quotes)
+        if in_quotes:
+            continue
+        try:
+            values = next(csv.reader(lines), [])
+        except csv.Error as e:
+            yield first_line, None, f"Invalid CSV: {e}"
+        else:
+            yield first_line, values, None
+        lines = []
+        first_line = None
+    if lines:
+        yield first_line, None, "Invalid CSV: quoted field is not closed before the end of the file"
+
+async def save_stock_import_progress(progress):
+    # Written on its own connection so other workers see it while the import runs
+    async with pool.acquire() as connection:
+        await connection.execute("""
+            INSERT INTO stock_import_progress (import_id, status, lines_read, imported, failed)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (import_id) DO UPDATE SET
+                status = EXCLUDED.status, lines_read = EXCLUDED.lines_read,
+                imported = EXCLUDED.imported, failed = EXCLUDED.failed,
+                updated_at = CURRENT_TIMESTAMP;
+        """, progress["import_id"], progress["status"], progress["lines_read"], progress["imported"], progress["failed"])
+
+def parse_stock_import_row(values, valid_items, valid_warehouses):
+    # Returns the parsed movement, or raises ValueError with a readable reason
+    item_id = int(values['item_id'])
+    if item_id not in valid_items:
+        raise ValueError(f"Item with ID {item_id} does not exist")
+    warehouse_id = int(values['warehouse_id']) if values.get('warehouse_id') else None
+    if warehouse_id is not None and warehouse_id not in valid_warehouses:
+        raise ValueError(f"Warehouse with ID {warehouse_id} does not exist")
+    trans_type = (values.get('trans_type') or '').strip().upper()
+    if trans_type not in ('IN', 'OUT', 'ADJUSTMENT'):
+        raise ValueError(f"Invalid transaction type '{values.get('trans_type')}'")
+    if not values.get('reference_type'):
+        raise ValueError("reference_type is required")
+    return {
+        'item_id': item_id,
+        'trans_type': trans_type,
+        'reference_type': values['reference_type'],
+        'reference_id': values.get('reference_id') or None,
+        'warehouse_id': warehouse_id,
+        'stock_qty': float(values['stock_qty']),
+        'unit_cost': float(values['unit_cost']) if values.get('unit_cost') else 0,
+        'remarks': values.get('remarks') or None,
+        'created_by': values.get('created_by') or None,
+    }
+
+async def load_stock_import_batch(connection, batch, balances, valuations, rollup):
+    # Apply the batch in order and COPY it in; the caller holds the balance locks for
+    # every key in it. The batch is dated after those locks were taken, so it sorts
+    # after every posting it builds on.
+    # Ids are allocated up front so FIFO layers can point at the rows they came from
+    trans_ids = await connection.fetch(
+        "SELECT nextval(pg_get_serial_sequence('stock_transactions', 'trans_id')) as trans_id FROM generate_series(1, $1);",
+        len(batch)
+    )
+    trans_date = await connection.fetchval("SELECT clock_timestamp()::timestamp;")
+    records = []
+    for m, trans in zip(batch, trans_ids):
+        key = (m['item_id'], m['warehouse_id'] or 0)
+        apply_stock_valuation(valuations[key], m['trans_type'], m['stock_qty'], m['unit_cost'], trans['trans_id'])
+        previous_balance = balances[key]
+        if m['trans_type'] == 'IN':
+            balances[key] += m['stock_qty']
+        elif m['trans_type'] == 'OUT':
+            balances[key] -= m['stock_qty']
+        else:  # ADJUSTMENT
+            balances[key] = m['stock_qty']
+        add_to_stock_rollup(
+            rollup, trans_date.date(), key[0], key[1], m['trans_type'],
+            balances[key] - previous_balance, m['unit_cost']
+        )
+        records.append((
+            trans['trans_id'], m['item_id'], m['trans_type'], m['reference_type'], m['reference_id'],
+            m['warehouse_id'], m['stock_qty'], m['unit_cost'], balances[key], m['remarks'], m['created_by'], trans_date
+        ))
+    await connection.copy_records_to_table(
+        'stock_transactions', records=records, columns=['trans_id'] + STOCK_IMPORT_COLUMNS + ['trans_date']
+    )
+
+def write_spooled_movements(spool, movements):
+    spool.writelines(json.dumps(m) + '\n' for m in movements)
+
+def read_spooled_movements(spool, size):
+    movements = []
+    while len(movements) < size:
+        line = spool.readline()
+        if not line:
+            break
+        movements.append(json.loads(line))
+    return movements
+
+# Body is a CSV file with a header row naming the columns item_id, trans_type,
+# reference_type, reference_id, warehouse_id, stock_qty, unit_cost, remarks, created_by.
+# Invalid lines are skipped and reported; valid lines are imported in one transaction.
+# The body is parsed and spooled to a temporary file first, so no transaction or lock
+# is held while the client is still sending; the load then locks every balance key
+# once, in key order, like any other multi-key posting.
+@api_router.post("/stock-transactions/import")
+async def import_stock_transactions(request: Request, import_id: Optional[str] = None):
+    import_id = import_id or uuid.uuid4().hex
+    if len(import_id) > 64:
+        raise HTTPException(status_code=400, detail="import_id must be at most 64 characters")
+    progress = {"import_id": import_id, "status": "reading", "lines_read": 0, "imported": 0, "failed": 0}
+    errors = []
+    spool = await asyncio.to_thread(tempfile.TemporaryFile, 'w+', encoding='utf-8')
+    try:
+        async with pool.acquire() as connection:
+            await connection.execute(
+                "DELETE FROM stock_import_progress WHERE updated_at < $1;",
+                datetime.now() - STOCK_IMPORT_PROGRESS_RETENTION
+            )
+            # Preload reference ids so each line is validated without a query
+            valid_items = {r['it_id'] for r in await connection.fetch("SELECT it_id FROM item_master;")}
+            valid_warehouses = {r['whs_id'] for r in await connection.fetch("SELECT whs_id FROM whs;")}
+        await save_stock_import_progress(progress)
+        
+        keys = set()
+        batch = []
+        header = None
+        async for line_no, values, error in iter_csv_rows(request):
+            if error:
+                if header is None:
+                    raise HTTPException(status_code=400, detail=f"Line {line_no}: {error}")
+                progress["lines_read"] += 1
+                progress["failed"] += 1
+                errors.append({"line_no": line_no, "error": error})
+                continue
+            if not values:
+                continue
+            if header is None:
+                header = [h.strip().lower() for h in values]
+                missing = {'item_id', 'trans_type', 'reference_type', 'stock_qty'} - set(header)
+                if missing:
+                    raise HTTPException(status_code=400, detail=f"Missing columns: {', '.join(sorted(missing))}")
+                continue
+            
+            progress["lines_read"] += 1
+            try:
+                movement = parse_stock_import_row(dict(zip(header, values)), valid_items, valid_warehouses)
+            except (ValueError, KeyError, TypeError) as e:
+                progress["failed"] += 1
+                errors.append({"line_no": line_no, "error": str(e)})
+                continue
+            keys.add((movement['item_id'], movement['warehouse_id'] or 0))
+            batch.append(movement)
+            
+            if len(batch) >= STOCK_IMPORT_BATCH_SIZE:
+                await asyncio.to_thread(write_spooled_movements, spool, batch)
+                batch = []
+                await save_stock_import_progress(progress)
+        if batch:
+            await asyncio.to_thread(write_spooled_movements, spool, batch)
+        
+        progress["status"] = "loading"
+        await save_stock_import_progress(progress)
+        await asyncio.to_thread(spool.seek, 0)
+        
+        if keys:
+            async with pool.acquire() as connection:
+                async with connection.transaction():
+                    # Imports run one at a time, and lock all their keys up front
+                    await connection.execute("SELECT pg_advisory_xact_lock(hashtext('stock_transactions_import'));")
+                    balances = await lock_stock_balances(connection, keys)
+                    valuations = await load_stock_valuations(connection, keys)
+                    rollup = {}
+                    
+                    while True:
+                        batch = await asyncio.to_thread(read_spooled_movements, spool, STOCK_IMPORT_BATCH_SIZE)
+                        if not batch:
+                            break
+                        await load_stock_import_batch(connection, batch, balances, valuations, rollup)
+                        progress["imported"] += len(batch)
+                        await save_stock_import_progress(progress)
+                    
+                    # Carry the final balances over to stock_balance in one statement
+                    keys = list(balances)
+                    await connection.execute("""
+                        UPDATE stock_balance sb
+                        SET balance_qty = v.balance_qty,
+                            last_trans_id = (
+                                SELECT MAX(st.trans_id) FROM stock_transactions st
+                                WHERE st.item_id = sb.item_id AND COALESCE(st.warehouse_id, 0) = sb.warehouse_id
+                            ),
+                            updated_at = CURRENT_TIMESTAMP
+                        FROM unnest($1::int[], $2::int[], $3::numeric[]) AS v(item_id, warehouse_id, balance_qty)
+                        WHERE sb.item_id = v.item_id AND sb.warehouse_id = v.warehouse_id;
+                    """, [k[0] for k in keys], [k[1] for k in keys], [balances[k] for k in keys])
+                    await save_stock_valuations(connection, valuations)
+                    await save_stock_rollup(connection, rollup)
+        
+        progress["status"] = "completed"
+        await save_stock_import_progress(progress)
+        return {**progress, "errors": errors}
+    
+    except HTTPException:
+        await fail_stock_import_progress(progress)
+        raise
+    except Exception as e:
+        await fail_stock_import_progress(progress)
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error importing stock transactions: {str(e)}")
+    finally:
+        await asyncio.to_thread(spool.close)
+
+async def fail_stock_import_progress(progress):
+    # The imported rows were rolled back with the transaction
+    progress["status"] = "failed"
+    progress["imported"] = 0
+    try:
+        await save_stock_import_progress(progress)
+    except Exception as e:
+        print(f"Could not record failed stock import {progress['import_id']}: {e}")
+
+@api_router.get("/stock-transactions/import/{import_id}")
+async def get_stock_import_progress(import_id: str):
+    async with pool.acquire() as connection:
+        progress = await connection.fetchrow("""
+            SELECT import_id, status, lines_read, imported, failed, started_at, updated_at
+            FROM stock_import_progress WHERE import_id = $1;
+        """, import_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return dict(progress)
 
 # Posting Periods Endpoints
 @api_router.get("/posting-periods", response_model=List[PostingPeriodResponse])
@@ -3765,7 +7025,7 @@ async def update_posting_period_status(period_id: int, status_update: PostingPer
         async with pool.acquire() as connection:
             # Check if period exists
             existing = await connection.fetchrow(
-                "SELECT period_id FROM posting_periods WHERE period_id = $1;", 
+                "SELECT period_id, end_date FROM posting_periods WHERE period_id = $1;", 
                 period_id
             )
             if not existing:
@@ -3775,6 +7035,10 @@ async def update_posting_period_status(period_id: int, status_update: PostingPer
             if status_update.period_status not in ['Open', 'Closed', 'Future']:
                 raise HTTPException(status_code=400, detail="Invalid status. Must be 'Open', 'Closed', or 'Future'")
             
+            # The closing snapshot needs the period's last day to be over
+            if status_update.period_status == 'Closed' and existing['end_date'] >= await connection.fetchval("SELECT CURRENT_DATE;"):
+                raise HTTPException(status_code=400, detail="A posting period can only be closed after its end date")
+            
             # Update the status
             update_query = """
                 UPDATE posting_periods SET
@@ -3790,6 +7054,10 @@ async def update_posting_period_status(period_id: int, status_update: PostingPer
                 period_id
             )
             
+            # Closing a period freezes its stock position as a snapshot
+            if status_update.period_status == 'Closed':
+                await build_stock_snapshot(connection, existing['end_date'])
+            
             # Fetch the updated record
             full_query = "SELECT * FROM posting_periods WHERE period_id = $1;"
             full_record = await connection.fetchrow(full_query, result['period_id'])
@@ -3859,10 +7127,20 @@ async def get_current_posting_period():
 
 # Purchase Request Endpoints - Header-Row Structure
 @api_router.get("/purchase-requests", response_model=List[PurReqHeaderResponse])
-async def get_purchase_requests():
+async def get_purchase_requests(
+    req_status: Optional[str] = None,
+    priority: Optional[str] = None,
+    emp_dept: Optional[int] = None,
+    post_dt_from: Optional[date] = None,
+    post_dt_to: Optional[date] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    include_rows: bool = True
+):
     try:
         async with pool.acquire() as connection:
-            # Get headers
+            # Get one page of headers, keyset-paginated on req_no (newest first).
+            # Pass the req_no of the last PR on a page as `cursor` to fetch the next one.
             headers_query = """
                 SELECT 
                     h.req_id,
@@ -3881,43 +7159,89 @@ async def get_purchase_requests():
                     h.created_at,
                     h.updated_by,
                     h.updated_at,
-                    COALESCE(SUM(r.req_qty), 0) as total_qty
+                    COALESCE(t.total_qty, 0) as total_qty,
+                    COALESCE(t.item_count, 0) as item_count
                 FROM pur_req_header h
-                LEFT JOIN department_master dm ON h.emp_dept = dm.dept_id
-                LEFT JOIN pur_req_row r ON h.req_id = r.req_id
-                GROUP BY h.req_id, h.emp_dept
-                ORDER BY h.req_no DESC;
+                LEFT JOIN LATERAL (
+                    SELECT SUM(r.req_qty) as total_qty, COUNT(*) as item_count
+                    FROM pur_req_row r
+                    WHERE r.req_id = h.req_id
+                ) t ON true
+                WHERE 1=1
             """
-            headers = await connection.fetch(headers_query)
+            params = []
+            param_count = 0
+            
+            if req_status:
+                param_count += 1
+                headers_query += f" AND h.req_status = ${param_count}"
+                params.append(req_status)
+            
+            if priority:
+                param_count += 1
+                headers_query += f" AND h.priority = ${param_count}"
+                params.append(priority)
+            
+            if emp_dept:
+                param_count += 1
+                headers_query += f" AND h.emp_dept = ${param_count}"
+                params.append(emp_dept)
+            
+            if post_dt_from:
+                param_count += 1
+                headers_query += f" AND h.post_dt >= ${param_count}"
+                params.append(post_dt_from)
+            
+            if post_dt_to:
+                param_count += 1
+                headers_query += f" AND h.post_dt <= ${param_count}"
+                params.append(post_dt_to)
+            
+            if cursor:
+                param_count += 1
+                headers_query += f" AND h.req_no < ${param_count}"
+                params.append(cursor)
+            
+            headers_query += f" ORDER BY h.req_no DESC LIMIT ${param_count + 1}"
+            params.append(limit)
+            
+            headers = await connection.fetch(headers_query, *params)
             
-            # Get rows for each header
             result = []
+            rows_by_req = {}
             for header in headers:
-                rows_query = """
-                    SELECT 
-                        r.req_row_id,
-                        r.req_id,
-                        r.line_no,
-                        r.it_id,
-                        r.it_code,
-                        r.it_name,
-                        r.it_details,
-                        r.it_hsn,
-                        r.need_date,
-                        r.current_stock,
-                        r.req_qty,
-                        r.created_by,
-                        r.created_at
-                    FROM pur_req_row r
-                    WHERE r.req_id = $1
-                    ORDER BY r.line_no;
-                """
-                rows = await connection.fetch(rows_query, header['req_id'])
-                
                 header_dict = dict(header)
-                header_dict['rows'] = [dict(row) for row in rows]
+                header_dict['rows'] = []
+                rows_by_req[header['req_id']] = header_dict['rows']
                 result.append(header_dict)
             
+            if not include_rows or not result:
+                return result
+            
+            # Get rows for the visible page only, in one round trip
+            rows_query = """
+                SELECT 
+                    r.req_row_id,
+                    r.req_id,
+                    r.line_no,
+                    r.it_id,
+                    r.it_code,
+                    r.it_name,
+                    r.it_details,
+                    r.it_hsn,
+                    r.need_date,
+                    r.current_stock,
+                    r.req_qty,
+                    r.created_by,
+                    r.created_at
+                FROM pur_req_row r
+                WHERE r.req_id = ANY($1::int[])
+                ORDER BY r.req_id, r.line_no;
+            """
+            rows = await connection.fetch(rows_query, list(rows_by_req))
+            for row in rows:
+                rows_by_req[row['req_id']].append(dict(row))
+            
             return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching purchase requests: {str(e)}")
@@ -3967,7 +7291,8 @@ async def get_purchase_request(req_id: int):
                     h.created_at,
                     h.updated_by,
                     h.updated_at,
-                    COALESCE(SUM(r.req_qty), 0) as total_qty
+                    COALESCE(SUM(r.req_qty), 0) as total_qty,
+                    COUNT(r.req_row_id) as item_count
                 FROM pur_req_header h
                 LEFT JOIN department_master dm ON h.emp_dept = dm.dept_id
                 LEFT JOIN pur_req_row r ON h.req_id = r.req_id
@@ -4054,20 +7379,23 @@ async def create_purchase_request(purchase_request: PurReqHeaderCreate):
             
             req_id = header_id['req_id']
             
+            # Current stock for every line from the balance table in one query
+            stock_rows = await connection.fetch(
+                "SELECT item_id, SUM(balance_qty) as current_stock FROM stock_balance WHERE item_id = ANY($1::int[]) GROUP BY item_id;",
+                list({row.it_id for row in purchase_request.rows})
+            )
+            stock_by_item = {r['item_id']: float(r['current_stock']) for r in stock_rows}
+            items = await get_cached_items(connection, [row.it_id for row in purchase_request.rows])
+            
             # Insert rows
             for row in purchase_request.rows:
                 # Validate item exists
-                item = await connection.fetchrow(
-                    "SELECT it_id, it_code, it_name, it_hsn, it_details FROM item_master WHERE it_id = $1;", 
-                    row.it_id
-                )
+                item = items.get(row.it_id)
                 if not item:
                     raise HTTPException(status_code=400, detail=f"Item with ID {row.it_id} does not exist")
                 
                 # Get current stock
-                current_stock_query = "SELECT COALESCE(SUM(stock_qty), 0) as current_stock FROM stock_transactions WHERE item_id = $1;"
-                current_stock_result = await connection.fetchrow(current_stock_query, row.it_id)
-                current_stock = float(current_stock_result['current_stock']) if current_stock_result else 0
+                current_stock = stock_by_item.get(row.it_id, 0)
                 
                 # Insert row
                 row_query = """
@@ -4170,18 +7498,21 @@ async def update_purchase_request(req_id: int, purchase_request: PurReqHeaderCre
             # Delete existing rows and insert new ones
             await connection.execute("DELETE FROM pur_req_row WHERE req_id = $1;", req_id)
             
+            # Current stock for every line from the balance table in one query
+            stock_rows = await connection.fetch(
+                "SELECT item_id, SUM(balance_qty) as current_stock FROM stock_balance WHERE item_id = ANY($1::int[]) GROUP BY item_id;",
+                list({row.it_id for row in purchase_request.rows})
+            )
+            stock_by_item = {r['item_id']: float(r['current_stock']) for r in stock_rows}
+            items = await get_cached_items(connection, [row.it_id for row in purchase_request.rows])
+            
             # Insert updated rows
             for row in purchase_request.rows:
-                item = await connection.fetchrow(
-                    "SELECT it_id, it_code, it_name, it_hsn, it_details FROM item_master WHERE it_id = $1;", 
-                    row.it_id
-                )
+                item = items.get(row.it_id)
                 if not item:
                     raise HTTPException(status_code=400, detail=f"Item with ID {row.it_id} does not exist")
                 
-                current_stock_query = "SELECT COALESCE(SUM(stock_qty), 0) as current_stock FROM stock_transactions WHERE item_id = $1;"
-                current_stock_result = await connection.fetchrow(current_stock_query, row.it_id)
-                current_stock = float(current_stock_result['current_stock']) if current_stock_result else 0
+                current_stock = stock_by_item.get(row.it_id, 0)
                 
                 row_query = """
                     INSERT INTO pur_req_row (
@@ -4254,6 +7585,197 @@ async def delete_purchase_request(req_id: int):
         raise HTTPException(status_code=500, detail=f"Error deleting purchase request: {str(e)}")
 
 
+# Replenishment planning
+# Projected stock = on hand + unreceived open PO quantity + open PR quantity. Items at or below
+# their minimum are topped up to their maximum (or minimum when no maximum is set),
+# rounded up to the minimum order quantity. One set-based pass over all items.
+REPLENISHMENT_QUERY = """
+    WITH stock AS (
+        SELECT item_id, SUM(balance_qty) as qty FROM stock_balance GROUP BY item_id
+    ),
+    open_po AS (
+        SELECT r.it_id, SUM(GREATEST(r.req_qty - r.received_qty, 0)) as qty
+        FROM pur_ord_row r
+        JOIN pur_ord_header h ON r.po_id = h.po_id
+        WHERE h.po_status = 'Open'
+        GROUP BY r.it_id
+    ),
+    open_pr AS (
+        SELECT r.it_id, SUM(r.req_qty) as qty
+        FROM pur_req_row r
+        JOIN pur_req_header h ON r.req_id = h.req_id
+        WHERE h.req_status IN ('Pending', 'Approved')
+        GROUP BY r.it_id
+    ),
+    plan AS (
+        SELECT
+            im.it_id, im.it_code, im.it_name, im.it_details, im.it_hsn, im.it_group, im.it_whs,
+            COALESCE(im.it_min, 0) as it_min,
+            COALESCE(im.it_max, 0) as it_max,
+            COALESCE(im.it_moq, 0) as it_moq,
+            COALESCE(im.it_lead, 0) as it_lead,
+            COALESCE(s.qty, 0) as current_stock,
+            COALESCE(po.qty, 0) as open_po_qty,
+            COALESCE(pr.qty, 0) as open_pr_qty,
+            COALESCE(s.qty, 0) + COALESCE(po.qty, 0) + COALESCE(pr.qty, 0) as projected_qty
+        FROM item_master im
+        LEFT JOIN stock s ON im.it_id = s.item_id
+        LEFT JOIN open_po po ON im.it_id = po.it_id
+        LEFT JOIN open_pr pr ON im.it_id = pr.it_id
+        WHERE im.it_status = 'Active'
+          AND (im.it_min > 0 OR im.it_max > 0)
+          AND ($1::int[] IS NULL OR im.it_id = ANY($1::int[]))
+          AND ($2::int IS NULL OR im.it_group = $2)
+    ),
+    suggested AS (
+        SELECT *, GREATEST(it_max, it_min) - projected_qty as shortfall
+        FROM plan
+        WHERE projected_qty <= it_min
+    )
+    SELECT *,
+        CASE WHEN it_moq > 0 THEN CEIL(GREATEST(shortfall, it_moq) / it_moq) * it_moq
+             ELSE shortfall END as suggested_qty
+    FROM suggested
+    WHERE shortfall > 0
+    ORDER BY it_code;
+"""
+
+@api_router.get("/replenishment/suggestions")
+async def get_replenishment_suggestions(item_group: Optional[int] = None):
+    try:
+        async with pool.acquire() as connection:
+            records = await connection.fetch(REPLENISHMENT_QUERY, None, item_group)
+            return [dict(r) for r in records]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing replenishment suggestions: {str(e)}")
+
+@api_router.post("/replenishment/draft-requests", response_model=PurReqHeaderResponse, status_code=status.HTTP_201_CREATED)
+async def draft_replenishment_requests(draft: ReplenishmentDraftRequest):
+    try:
+        async with pool.acquire() as connection:
+            # Validate employee exists
+            employee = await connection.fetchrow(
+                "SELECT emp_code, emp_name, dept_id FROM employee_master WHERE emp_code = $1;", 
+                draft.emp_code
+            )
+            if not employee:
+                raise HTTPException(status_code=400, detail=f"Employee with code {draft.emp_code} does not exist")
+            
+            # Validate posting period
+            posting_period = await connection.fetchrow(
+                "SELECT period_id FROM posting_periods WHERE $1 BETWEEN start_date AND end_date AND period_status = 'Open' AND allow_posting = true;",
+                draft.post_dt
+            )
+            if not posting_period:
+                raise HTTPException(status_code=400, detail="No open posting period found for the given date")
+            
+            async with connection.transaction():
+                suggestions = await connection.fetch(REPLENISHMENT_QUERY, draft.item_ids, None)
+                if not suggestions:
+                    raise HTTPException(status_code=400, detail="No items need replenishment")
+                
+                header_id = await connection.fetchrow("""
+                    INSERT INTO pur_req_header (
+                        post_per, emp_code, emp_name, emp_dept, post_dt, valid_dt, doc_dt,
+                        priority, req_status, remarks, created_by, updated_by
+                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, 'Pending', $9, $10, $10)
+                    RETURNING req_id;
+                """,
+                    int(posting_period['period_id']),
+                    draft.emp_code,
+                    employee['emp_name'],
+                    employee['dept_id'],
+                    draft.post_dt,
+                    draft.post_dt + timedelta(days=30),
+                    draft.doc_dt,
+                    draft.priority,
+                    draft.remarks,
+                    draft.created_by
+                )
+                req_id = header_id['req_id']
+                
+                # One line per suggested item, needed after the item's lead time
+                records = [
+                    (
+                        req_id, line_no, s['it_id'], s['it_code'], s['it_name'], s['it_details'], s['it_hsn'],
+                        draft.doc_dt + timedelta(days=int(s['it_lead'])), s['current_stock'],
+                        s['suggested_qty'], draft.created_by
+                    )
+                    for line_no, s in enumerate(suggestions, start=1)
+                ]
+                await connection.copy_records_to_table(
+                    'pur_req_row', records=records,
+                    columns=['req_id', 'line_no', 'it_id', 'it_code', 'it_name', 'it_details', 'it_hsn',
+                             'need_date', 'current_stock', 'req_qty', 'created_by']
+                )
+            
+            return await get_purchase_request(req_id)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error drafting purchase requests: {str(e)}")
+
+# Purchase Order row helpers
+PO_ROW_COLUMNS = [
+    'po_id', 'line_no', 'it_id', 'it_code', 'it_name', 'it_details', 'hsn_code',
+    'uom_id', 'req_qty', 'need_date', 'unit_price', 'discount_percent',
+    'discount_amt', 'tax_code', 'tax_rate', 'tax_amt', 'line_total',
+    'whs_id', 'pr_req_id', 'pr_line_no', 'pr_no', 'created_by'
+]
+
+async def validate_po_rows(connection, rows: List[PurOrdRowCreate]):
+    # One lookup per reference table over the distinct ids instead of one per line
+    item_ids = list({row.it_id for row in rows})
+    uom_ids = list({row.uom_id for row in rows if row.uom_id})
+    whs_ids = list({row.whs_id for row in rows if row.whs_id})
+    tax_codes = list({row.tax_code for row in rows if row.tax_code})
+    
+    items = await connection.fetch(
+        "SELECT it_id FROM item_master WHERE it_id = ANY($1::int[]);", item_ids
+    )
+    valid_items = {r['it_id'] for r in items}
+    valid_uoms = set()
+    if uom_ids:
+        uoms = await connection.fetch("SELECT uom_id FROM uom WHERE uom_id = ANY($1::int[]);", uom_ids)
+        valid_uoms = {r['uom_id'] for r in uoms}
+    valid_whs = set()
+    if whs_ids:
+        warehouses = await connection.fetch("SELECT whs_id FROM whs WHERE whs_id = ANY($1::int[]);", whs_ids)
+        valid_whs = {r['whs_id'] for r in warehouses}
+    valid_taxes = set()
+    if tax_codes:
+        taxes = await connection.fetch(
+            "SELECT tax_code FROM tax_master WHERE tax_code = ANY($1::text[]) AND is_active = true;",
+            tax_codes
+        )
+        valid_taxes = {r['tax_code'] for r in taxes}
+    
+    for row in sorted(rows, key=lambda r: r.line_no):
+        if row.it_id not in valid_items:
+            raise HTTPException(status_code=400, detail=f"Line {row.line_no}: Item with ID {row.it_id} does not exist")
+        if row.uom_id and row.uom_id not in valid_uoms:
+            raise HTTPException(status_code=400, detail=f"Line {row.line_no}: UOM with ID {row.uom_id} does not exist")
+        if row.whs_id and row.whs_id not in valid_whs:
+            raise HTTPException(status_code=400, detail=f"Line {row.line_no}: Warehouse with ID {row.whs_id} does not exist")
+        if row.tax_code and row.tax_code not in valid_taxes:
+            raise HTTPException(status_code=400, detail=f"Line {row.line_no}: Tax code {row.tax_code} does not exist or is not active")
+
+async def insert_po_rows(connection, po_id: int, rows: List[PurOrdRowCreate]):
+    # Bulk load all lines with COPY in a single round trip
+    records = [
+        (
+            po_id, row.line_no, row.it_id, row.it_code, row.it_name, row.it_details, row.hsn_code,
+            row.uom_id, row.req_qty, row.need_date, row.unit_price, row.discount_percent,
+            row.discount_amt, row.tax_code, row.tax_rate, row.tax_amt, row.line_total,
+            row.whs_id, row.pr_req_id, row.pr_line_no, row.pr_no, row.created_by
+        )
+        for row in rows
+    ]
+    await connection.copy_records_to_table('pur_ord_row', records=records, columns=PO_ROW_COLUMNS)
+
 # Purchase Order Endpoints
 @api_router.get("/purchase-orders", response_model=List[PurOrdHeaderResponse])
 async def get_purchase_orders():
@@ -4270,26 +7792,33 @@ async def get_purchase_orders():
                 ORDER BY po_no DESC;
             """
             headers = await connection.fetch(headers_query)
+            if not headers:
+                return []
+            
+            # Get rows for all headers in one round trip
+            rows_query = """
+                SELECT 
+                    po_row_id, po_id, line_no, it_id, it_code, it_name, 
+                    it_details, hsn_code, uom_id, req_qty, need_date,
+                    unit_price, discount_percent, discount_amt, tax_code,
+                    tax_rate, tax_amt, line_total, whs_id, received_qty,
+                    pr_req_id, pr_line_no, pr_no, created_by, created_at
+                FROM pur_ord_row
+                WHERE po_id = ANY($1::int[])
+                ORDER BY po_id, line_no;
+            """
+            rows = await connection.fetch(rows_query, [header['po_id'] for header in headers])
             
-            # Get rows for each header
+            # Group rows under their header in a single pass
             result = []
+            rows_by_po = {}
             for header in headers:
-                rows_query = """
-                    SELECT 
-                        po_row_id, po_id, line_no, it_id, it_code, it_name, 
-                        it_details, hsn_code, uom_id, req_qty, need_date,
-                        unit_price, discount_percent, discount_amt, tax_code,
-                        tax_rate, tax_amt, line_total, whs_id,
-                        pr_req_id, pr_line_no, pr_no, created_by, created_at
-                    FROM pur_ord_row
-                    WHERE po_id = $1
-                    ORDER BY line_no;
-                """
-                rows = await connection.fetch(rows_query, header['po_id'])
-                
                 header_dict = dict(header)
-                header_dict['rows'] = [dict(row) for row in rows]
+                header_dict['rows'] = []
+                rows_by_po[header['po_id']] = header_dict['rows']
                 result.append(header_dict)
+            for row in rows:
+                rows_by_po[row['po_id']].append(dict(row))
             
             return result
     except Exception as e:
@@ -4342,131 +7871,88 @@ async def create_po_from_pr(conversion: PRToPOConversion):
             if not posting_period:
                 raise HTTPException(status_code=400, detail="No open posting period found for the given date")
             
-            # Get all PRs to convert
-            prs_data = []
-            for req_id in conversion.req_ids:
+            if not conversion.req_ids:
+                raise HTTPException(status_code=400, detail="At least one purchase request is required")
+            
+            req_ids = list(dict.fromkeys(conversion.req_ids))
+            
+            async with connection.transaction():
+                # Get all approved PR lines in one query, locking the headers so a
+                # concurrent conversion cannot pick up the same PRs
                 pr_query = """
                     SELECT h.req_id, h.req_no, h.emp_code, h.emp_name, h.emp_dept as dept_id,
                            r.req_row_id, r.line_no, r.it_id, r.it_code, r.it_name, 
-                           r.it_details, r.it_hsn as hsn_code, r.need_date, r.req_qty
+                           r.it_details, r.it_hsn as hsn_code, r.need_date, r.req_qty,
+                           im.it_uom, im.it_whs
                     FROM pur_req_header h
                     JOIN pur_req_row r ON h.req_id = r.req_id
-                    WHERE h.req_id = $1 AND h.req_status = 'Approved'
+                    LEFT JOIN item_master im ON r.it_id = im.it_id
+                    WHERE h.req_id = ANY($1::int[]) AND h.req_status = 'Approved'
+                    ORDER BY array_position($1::int[], h.req_id), r.line_no
+                    FOR UPDATE OF h;
                 """
-                pr_rows = await connection.fetch(pr_query, req_id)
+                pr_rows = await connection.fetch(pr_query, req_ids)
                 
-                if not pr_rows:
-                    raise HTTPException(status_code=400, detail=f"PR {req_id} not found or not approved")
+                found_ids = {row['req_id'] for row in pr_rows}
+                for req_id in req_ids:
+                    if req_id not in found_ids:
+                        raise HTTPException(status_code=400, detail=f"PR {req_id} not found or not approved")
                 
-                # Get first row for header info
-                first_row = pr_rows[0]
-                prs_data.append({
-                    'req_id': req_id,
-                    'req_no': first_row['req_no'],
-                    'emp_code': first_row['emp_code'],
-                    'emp_name': first_row['emp_name'],
-                    'dept_id': first_row['dept_id'],
-                    'rows': pr_rows
-                })
-            
-            # Use first PR's employee details for the PO
-            first_pr = prs_data[0]
-            
-            # Insert PO header (po_no will be auto-generated by trigger)
-            header_query = """
-                INSERT INTO pur_ord_header (
-                    post_per, post_dt, doc_dt, bpcode, bpname,
-                    emp_code, emp_name, dept_id, created_by, updated_by
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                RETURNING po_id;
-            """
-            
-            header_id = await connection.fetchrow(
-                header_query,
-                int(posting_period['period_id']),
-                conversion.post_dt,
-                conversion.doc_dt,
-                conversion.bpcode,
-                vendor_check['bpname'],
-                first_pr['emp_code'],
-                first_pr['emp_name'],
-                first_pr['dept_id'],
-                conversion.created_by,
-                conversion.created_by
-            )
-            
-            po_id = header_id['po_id']
-            
-            # Insert PO rows from all PRs
-            line_no = 1
-            subtotal = 0
-            total_discount = 0
-            total_tax = 0
-            
-            for pr in prs_data:
-                for pr_row in pr['rows']:
-                    # Get UOM from item master (default to first if multiple)
-                    uom_data = await connection.fetchrow(
-                        "SELECT uom_id FROM uom LIMIT 1;"
-                    )
-                    uom_id = uom_data['uom_id'] if uom_data else None
-                    
-                    # Get warehouse (default to first)
-                    whs_data = await connection.fetchrow(
-                        "SELECT whs_id FROM whs LIMIT 1;"
-                    )
-                    whs_id = whs_data['whs_id'] if whs_data else None
-                    
-                    # Calculate line values (defaults - will be updated by user)
-                    unit_price = 0
-                    discount_percent = 0
-                    discount_amt = 0
-                    tax_rate = 0
-                    tax_amt = 0
-                    line_total = 0
-                    
-                    row_query = """
-                        INSERT INTO pur_ord_row (
-                            po_id, line_no, it_id, it_code, it_name, it_details, hsn_code,
-                            uom_id, req_qty, need_date, unit_price, discount_percent,
-                            discount_amt, tax_code, tax_rate, tax_amt, line_total,
-                            whs_id, pr_req_id, pr_line_no, pr_no, created_by
-                        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20, $21, $22);
-                    """
-                    
-                    await connection.execute(
-                        row_query,
-                        po_id,
-                        line_no,
-                        pr_row['it_id'],
-                        pr_row['it_code'],
-                        pr_row['it_name'],
-                        pr_row['it_details'],
-                        pr_row['hsn_code'],
-                        uom_id,
-                        pr_row['req_qty'],
-                        pr_row['need_date'],
-                        unit_price,
-                        discount_percent,
-                        discount_amt,
-                        None,  # tax_code
-                        tax_rate,
-                        tax_amt,
-                        line_total,
-                        whs_id,
-                        pr_row['req_id'],
-                        pr_row['line_no'],
-                        pr['req_no'],
+                # Use first PR's employee details for the PO
+                first_pr = pr_rows[0]
+                
+                # Resolve fallback UOM/warehouse once, for items without their own defaults
+                defaults = await connection.fetchrow("""
+                    SELECT (SELECT uom_id FROM uom ORDER BY uom_id LIMIT 1) as uom_id,
+                           (SELECT whs_id FROM whs ORDER BY whs_id LIMIT 1) as whs_id;
+                """)
+                
+                # Insert PO header (po_no will be auto-generated by trigger)
+                header_query = """
+                    INSERT INTO pur_ord_header (
+                        post_per, post_dt, doc_dt, bpcode, bpname,
+                        emp_code, emp_name, dept_id, created_by, updated_by
+                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                    RETURNING po_id;
+                """
+                
+                header_id = await connection.fetchrow(
+                    header_query,
+                    int(posting_period['period_id']),
+                    conversion.post_dt,
+                    conversion.doc_dt,
+                    conversion.bpcode,
+                    vendor_check['bpname'],
+                    first_pr['emp_code'],
+                    first_pr['emp_name'],
+                    first_pr['dept_id'],
+                    conversion.created_by,
+                    conversion.created_by
+                )
+                
+                po_id = header_id['po_id']
+                
+                # Build PO rows from all PRs; prices and taxes default to zero and are
+                # filled in by the user afterwards
+                records = [
+                    (
+                        po_id, line_no, pr_row['it_id'], pr_row['it_code'], pr_row['it_name'],
+                        pr_row['it_details'], pr_row['hsn_code'],
+                        pr_row['it_uom'] or defaults['uom_id'],
+                        pr_row['req_qty'], pr_row['need_date'],
+                        0, 0, 0, None, 0, 0, 0,
+                        pr_row['it_whs'] or defaults['whs_id'],
+                        pr_row['req_id'], pr_row['line_no'], pr_row['req_no'],
                         conversion.created_by
                     )
-                    
-                    line_no += 1
-            
-            # Update PR status to 'Converted to PO'
-            for req_id in conversion.req_ids:
+                    for line_no, pr_row in enumerate(pr_rows, start=1)
+                ]
+                await connection.copy_records_to_table('pur_ord_row', records=records, columns=PO_ROW_COLUMNS)
+                
+                # Update PR status to 'Converted to PO'
                 await connection.execute(
-                    "UPDATE pur_req_header SET req_status = 'Converted to PO' WHERE req_id = $1;",
-                    req_id
+                    "UPDATE pur_req_header SET req_status = 'Converted to PO', updated_at = CURRENT_TIMESTAMP WHERE req_id = ANY($1::int[]);",
+                    req_ids
                 )
             
             return await get_purchase_order(po_id)
@@ -4516,108 +8002,43 @@ async def create_purchase_order(purchase_order: PurOrdHeaderCreate):
             tax_amt = sum(row.tax_amt for row in purchase_order.rows)
             total_amt = subtotal - discount_amt + tax_amt
             
-            # Insert header (po_no will be auto-generated by trigger)
-            header_query = """
-                INSERT INTO pur_ord_header (
-                    post_per, post_dt, doc_dt, bpcode, bpname,
-                    emp_code, emp_name, dept_id, subtotal, discount_amt,
-                    tax_amt, total_amt, po_status, created_by, updated_by
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
-                RETURNING po_id;
-            """
+            # Validate all lines up front with one query per reference table
+            await validate_po_rows(connection, purchase_order.rows)
+            
+            async with connection.transaction():
+                # Insert header (po_no will be auto-generated by trigger)
+                header_query = """
+                    INSERT INTO pur_ord_header (
+                        post_per, post_dt, doc_dt, bpcode, bpname,
+                        emp_code, emp_name, dept_id, subtotal, discount_amt,
+                        tax_amt, total_amt, po_status, created_by, updated_by
+                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
+                    RETURNING po_id;
+                """
             
-            header_id = await connection.fetchrow(
-                header_query,
-                int(posting_period['period_id']),
-                purchase_order.post_dt,
-                purchase_order.doc_dt,
-                purchase_order.bpcode,
-                vendor_check['bpname'],
-                purchase_order.emp_code,
-                purchase_order.emp_name,
-                purchase_order.dept_id,
-                subtotal,
-                discount_amt,
-                tax_amt,
-                total_amt,
-                purchase_order.po_status,
-                purchase_order.created_by,
-                purchase_order.updated_by
-            )
+                header_id = await connection.fetchrow(
+                    header_query,
+                    int(posting_period['period_id']),
+                    purchase_order.post_dt,
+                    purchase_order.doc_dt,
+                    purchase_order.bpcode,
+                    vendor_check['bpname'],
+                    purchase_order.emp_code,
+                    purchase_order.emp_name,
+                    purchase_order.dept_id,
+                    subtotal,
+                    discount_amt,
+                    tax_amt,
+                    total_amt,
+                    purchase_order.po_status,
+                    purchase_order.created_by,
+                    purchase_order.updated_by
+                )
             
-            po_id = header_id['po_id']
+                po_id = header_id['po_id']
             
-            # Insert rows
-            for row in purchase_order.rows:
-                # Validate item exists
-                item = await connection.fetchrow(
-                    "SELECT it_id, it_code, it_name FROM item_master WHERE it_id = $1;", 
-                    row.it_id
-                )
-                if not item:
-                    raise HTTPException(status_code=400, detail=f"Item with ID {row.it_id} does not exist")
-                
-                # Validate UOM if provided
-                if row.uom_id:
-                    uom_exists = await connection.fetchrow(
-                        "SELECT uom_id FROM uom WHERE uom_id = $1;",
-                        row.uom_id
-                    )
-                    if not uom_exists:
-                        raise HTTPException(status_code=400, detail=f"UOM with ID {row.uom_id} does not exist")
-                
-                # Validate warehouse if provided
-                if row.whs_id:
-                    whs_exists = await connection.fetchrow(
-                        "SELECT whs_id FROM whs WHERE whs_id = $1;",
-                        row.whs_id
-                    )
-                    if not whs_exists:
-                        raise HTTPException(status_code=400, detail=f"Warehouse with ID {row.whs_id} does not exist")
-                
-                # Validate tax code if provided
-                if row.tax_code:
-                    tax_exists = await connection.fetchrow(
-                        "SELECT tax_code FROM tax_master WHERE tax_code = $1 AND is_active = true;",
-                        row.tax_code
-                    )
-                    if not tax_exists:
-                        raise HTTPException(status_code=400, detail=f"Tax code {row.tax_code} does not exist or is not active")
-                
-                row_query = """
-                    INSERT INTO pur_ord_row (
-                        po_id, line_no, it_id, it_code, it_name, it_details, hsn_code,
-                        uom_id, req_qty, need_date, unit_price, discount_percent,
-                        discount_amt, tax_code, tax_rate, tax_amt, line_total,
-                        whs_id, pr_req_id, pr_line_no, pr_no, created_by
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20, $21, $22);
-                """
-                
-                await connection.execute(
-                    row_query,
-                    po_id,
-                    row.line_no,
-                    row.it_id,
-                    row.it_code,
-                    row.it_name,
-                    row.it_details,
-                    row.hsn_code,
-                    row.uom_id,
-                    row.req_qty,
-                    row.need_date,
-                    row.unit_price,
-                    row.discount_percent,
-                    row.discount_amt,
-                    row.tax_code,
-                    row.tax_rate,
-                    row.tax_amt,
-                    row.line_total,
-                    row.whs_id,
-                    row.pr_req_id,
-                    row.pr_line_no,
-                    row.pr_no,
-                    row.created_by
-                )
+                # Insert rows
+                await insert_po_rows(connection, po_id, purchase_order.rows)
             
             return await get_purchase_order(po_id)
             
@@ -4639,6 +8060,11 @@ async def update_purchase_order(po_id: int, purchase_order: PurOrdHeaderCreate):
             if existing['po_status'] == 'Closed':
                 raise HTTPException(status_code=400, detail="Cannot update a closed purchase order")
             
+            # Lines are replaced wholesale on update, which would lose received quantities
+            received = await connection.fetchval("SELECT 1 FROM grpo_header WHERE po_id = $1 LIMIT 1;", po_id)
+            if received:
+                raise HTTPException(status_code=400, detail="Cannot update a purchase order with goods receipts")
+            
             # Validate vendor
             vendor_check = await connection.fetchrow("""
                 SELECT bpcode, bpname FROM business_master 
@@ -4673,109 +8099,44 @@ async def update_purchase_order(po_id: int, purchase_order: PurOrdHeaderCreate):
             tax_amt = sum(row.tax_amt for row in purchase_order.rows)
             total_amt = subtotal - discount_amt + tax_amt
             
-            # Update header
-            header_query = """
-                UPDATE pur_ord_header SET
-                    post_per = $1, post_dt = $2, doc_dt = $3, bpcode = $4, bpname = $5,
-                    emp_code = $6, emp_name = $7, dept_id = $8, subtotal = $9, discount_amt = $10,
-                    tax_amt = $11, total_amt = $12, po_status = $13, updated_by = $14, updated_at = CURRENT_TIMESTAMP
-                WHERE po_id = $15;
-            """
-            
-            await connection.execute(
-                header_query,
-                int(posting_period['period_id']),
-                purchase_order.post_dt,
-                purchase_order.doc_dt,
-                purchase_order.bpcode,
-                vendor_check['bpname'],
-                purchase_order.emp_code,
-                purchase_order.emp_name,
-                purchase_order.dept_id,
-                subtotal,
-                discount_amt,
-                tax_amt,
-                total_amt,
-                purchase_order.po_status,
-                purchase_order.updated_by,
-                po_id
-            )
-            
-            # Delete existing rows and insert new ones
-            await connection.execute("DELETE FROM pur_ord_row WHERE po_id = $1;", po_id)
-            
-            # Insert updated rows
-            for row in purchase_order.rows:
-                # Validate item exists
-                item = await connection.fetchrow(
-                    "SELECT it_id, it_code, it_name FROM item_master WHERE it_id = $1;", 
-                    row.it_id
-                )
-                if not item:
-                    raise HTTPException(status_code=400, detail=f"Item with ID {row.it_id} does not exist")
-                
-                # Validate UOM if provided
-                if row.uom_id:
-                    uom_exists = await connection.fetchrow(
-                        "SELECT uom_id FROM uom WHERE uom_id = $1;",
-                        row.uom_id
-                    )
-                    if not uom_exists:
-                        raise HTTPException(status_code=400, detail=f"UOM with ID {row.uom_id} does not exist")
-                
-                # Validate warehouse if provided
-                if row.whs_id:
-                    whs_exists = await connection.fetchrow(
-                        "SELECT whs_id FROM whs WHERE whs_id = $1;",
-                        row.whs_id
-                    )
-                    if not whs_exists:
-                        raise HTTPException(status_code=400, detail=f"Warehouse with ID {row.whs_id} does not exist")
-                
-                # Validate tax code if provided
-                if row.tax_code:
-                    tax_exists = await connection.fetchrow(
-                        "SELECT tax_code FROM tax_master WHERE tax_code = $1 AND is_active = true;",
-                        row.tax_code
-                    )
-                    if not tax_exists:
-                        raise HTTPException(status_code=400, detail=f"Tax code {row.tax_code} does not exist or is not active")
-                
-                row_query = """
-                    INSERT INTO pur_ord_row (
-                        po_id, line_no, it_id, it_code, it_name, it_details, hsn_code,
-                        uom_id, req_qty, need_date, unit_price, discount_percent,
-                        discount_amt, tax_code, tax_rate, tax_amt, line_total,
-                        whs_id, pr_req_id, pr_line_no, pr_no, created_by
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20, $21, $22);
+            # Validate all lines up front with one query per reference table
+            await validate_po_rows(connection, purchase_order.rows)
+            
+            async with connection.transaction():
+                # Update header
+                header_query = """
+                    UPDATE pur_ord_header SET
+                        post_per = $1, post_dt = $2, doc_dt = $3, bpcode = $4, bpname = $5,
+                        emp_code = $6, emp_name = $7, dept_id = $8, subtotal = $9, discount_amt = $10,
+                        tax_amt = $11, total_amt = $12, po_status = $13, updated_by = $14, updated_at = CURRENT_TIMESTAMP
+                    WHERE po_id = $15;
                 """
-                
+            
                 await connection.execute(
-                    row_query,
-                    po_id,
-                    row.line_no,
-                    row.it_id,
-                    row.it_code,
-                    row.it_name,
-                    row.it_details,
-                    row.hsn_code,
-                    row.uom_id,
-                    row.req_qty,
-                    row.need_date,
-                    row.unit_price,
-                    row.discount_percent,
-                    row.discount_amt,
-                    row.tax_code,
-                    row.tax_rate,
-                    row.tax_amt,
-                    row.line_total,
-                    row.whs_id,
-                    row.pr_req_id,
-                    row.pr_line_no,
-                    row.pr_no,
-                    row.created_by
+                    header_query,
+                    int(posting_period['period_id']),
+                    purchase_order.post_dt,
+                    purchase_order.doc_dt,
+                    purchase_order.bpcode,
+                    vendor_check['bpname'],
+                    purchase_order.emp_code,
+                    purchase_order.emp_name,
+                    purchase_order.dept_id,
+                    subtotal,
+                    discount_amt,
+                    tax_amt,
+                    total_amt,
+                    purchase_order.po_status,
+                    purchase_order.updated_by,
+                    po_id
                 )
             
+                # Delete existing rows and insert new ones
+                await connection.execute("DELETE FROM pur_ord_row WHERE po_id = $1;", po_id)
+            
+                # Insert updated rows
+                await insert_po_rows(connection, po_id, purchase_order.rows)
+            
             return await get_purchase_order(po_id)
             
     except HTTPException:
@@ -4823,10 +8184,10 @@ async def delete_purchase_order(po_id: int):
             if existing['po_status'] == 'Closed':
                 raise HTTPException(status_code=400, detail="Cannot delete a closed purchase order")
             
-            # Check if there are any GRPOs linked to this PO (add this check later)
-            # grpo_check = await connection.fetchrow("SELECT grpo_id FROM grpo_header WHERE po_id = $1;", po_id)
-            # if grpo_check:
-            #     raise HTTPException(status_code=400, detail="Cannot delete purchase order with existing GRPOs")
+            # Check if there are any GRPOs linked to this PO
+            grpo_check = await connection.fetchrow("SELECT grpo_id FROM grpo_header WHERE po_id = $1 LIMIT 1;", po_id)
+            if grpo_check:
+                raise HTTPException(status_code=400, detail="Cannot delete purchase order with existing GRPOs")
             
             # Rows will be automatically deleted due to CASCADE
             await connection.execute("DELETE FROM pur_ord_header WHERE po_id = $1;", po_id)
@@ -4838,6 +8199,202 @@ async def delete_purchase_order(po_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting purchase order: {str(e)}")
 
+# Goods Receipt (GRPO) Endpoints
+# A receipt posts any number of lines of one open PO in a single transaction: the
+# touched balances are locked once, ledger ids are allocated up front and the IN
+# movements, receipt lines and PO received quantities are written set-based.
+GRPO_ROW_COLUMNS = ['grpo_id', 'line_no', 'po_row_id', 'it_id', 'whs_id', 'recv_qty', 'unit_cost', 'trans_id']
+
+async def fetch_goods_receipts(connection, where: str, params: list):
+    headers = await connection.fetch(f"""
+        SELECT g.*, h.po_no
+        FROM grpo_header g
+        JOIN pur_ord_header h ON g.po_id = h.po_id
+        {where}
+    """, *params)
+    if not headers:
+        return []
+    rows = await connection.fetch("""
+        SELECT gr.*, pr.line_no as po_line_no, im.it_code, im.it_name
+        FROM grpo_row gr
+        LEFT JOIN pur_ord_row pr ON gr.po_row_id = pr.po_row_id
+        LEFT JOIN item_master im ON gr.it_id = im.it_id
+        WHERE gr.grpo_id = ANY($1::int[])
+        ORDER BY gr.grpo_id, gr.line_no;
+    """, [h['grpo_id'] for h in headers])
+    
+    result = []
+    rows_by_grpo = {}
+    for header in headers:
+        header_dict = dict(header)
+        header_dict['rows'] = []
+        rows_by_grpo[header['grpo_id']] = header_dict['rows']
+        result.append(header_dict)
+    for row in rows:
+        rows_by_grpo[row['grpo_id']].append(dict(row))
+    return result
+
+@api_router.get("/goods-receipts", response_model=List[GoodsReceiptResponse])
+async def get_goods_receipts(po_id: Optional[int] = None, skip: int = 0, limit: int = 100):
+    try:
+        async with pool.acquire() as connection:
+            where = "WHERE ($1::int IS NULL OR g.po_id = $1) ORDER BY g.grpo_id DESC LIMIT $2 OFFSET $3"
+            return await fetch_goods_receipts(connection, where, [po_id, limit, skip])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching goods receipts: {str(e)}")
+
+@api_router.get("/goods-receipts/{grpo_id}", response_model=GoodsReceiptResponse)
+async def get_goods_receipt(grpo_id: int):
+    try:
+        async with pool.acquire() as connection:
+            receipts = await fetch_goods_receipts(connection, "WHERE g.grpo_id = $1", [grpo_id])
+            if not receipts:
+                raise HTTPException(status_code=404, detail="Goods receipt not found")
+            return receipts[0]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching goods receipt: {str(e)}")
+
+@api_router.post("/goods-receipts", response_model=GoodsReceiptResponse, status_code=status.HTTP_201_CREATED)
+async def create_goods_receipt(receipt: GoodsReceiptCreate):
+    try:
+        if not receipt.rows:
+            raise HTTPException(status_code=400, detail="Goods receipt must have at least one line")
+        po_row_ids = [row.po_row_id for row in receipt.rows]
+        if len(po_row_ids) != len(set(po_row_ids)):
+            raise HTTPException(status_code=400, detail="Each purchase order line can appear only once in a goods receipt")
+        
+        async with pool.acquire() as connection:
+            # Validate posting period
+            posting_period = await connection.fetchrow(
+                "SELECT period_id FROM posting_periods WHERE $1 BETWEEN start_date AND end_date AND period_status = 'Open' AND allow_goods_receipt = true;",
+                receipt.post_dt
+            )
+            if not posting_period:
+                raise HTTPException(status_code=400, detail="No open posting period allowing goods receipts found for the given date")
+            
+            # Validate warehouse overrides with one query
+            whs_ids = sorted({row.whs_id for row in receipt.rows if row.whs_id})
+            if whs_ids:
+                warehouses = await connection.fetch("SELECT whs_id FROM whs WHERE whs_id = ANY($1::int[]);", whs_ids)
+                missing = set(whs_ids) - {r['whs_id'] for r in warehouses}
+                if missing:
+                    raise HTTPException(status_code=400, detail=f"Warehouse with ID {min(missing)} does not exist")
+            
+            async with connection.transaction():
+                # Lock the order and its lines so concurrent receipts cannot over-receive
+                po = await connection.fetchrow(
+                    "SELECT po_id, po_no, bpcode, bpname, po_status FROM pur_ord_header WHERE po_id = $1 FOR UPDATE;",
+                    receipt.po_id
+                )
+                if not po:
+                    raise HTTPException(status_code=404, detail="Purchase order not found")
+                if po['po_status'] != 'Open':
+                    raise HTTPException(status_code=400, detail="Goods can only be received against an open purchase order")
+                
+                po_rows = await connection.fetch("""
+                    SELECT po_row_id, line_no, it_id, whs_id, req_qty, received_qty, unit_price
+                    FROM pur_ord_row
+                    WHERE po_id = $1 AND po_row_id = ANY($2::int[])
+                    ORDER BY po_row_id
+                    FOR UPDATE;
+                """, receipt.po_id, po_row_ids)
+                po_rows = {r['po_row_id']: r for r in po_rows}
+                
+                lines = []
+                for row in receipt.rows:
+                    po_row = po_rows.get(row.po_row_id)
+                    if not po_row:
+                        raise HTTPException(status_code=400, detail=f"Line {row.po_row_id} does not belong to purchase order {po['po_no']}")
+                    open_qty = float(po_row['req_qty']) - float(po_row['received_qty'])
+                    if row.recv_qty <= 0:
+                        raise HTTPException(status_code=400, detail=f"Line {po_row['line_no']}: Received quantity must be greater than zero")
+                    if row.recv_qty > open_qty:
+                        raise HTTPException(status_code=400, detail=f"Line {po_row['line_no']}: Received quantity {row.recv_qty} exceeds open quantity {open_qty}")
+                    lines.append({
+                        'po_row_id': row.po_row_id,
+                        'po_line_no': po_row['line_no'],
+                        'it_id': po_row['it_id'],
+                        'whs_id': row.whs_id or po_row['whs_id'],
+                        'recv_qty': row.recv_qty,
+                        'unit_cost': row.unit_cost if row.unit_cost is not None else float(po_row['unit_price'] or 0),
+                    })
+                
+                grpo = await connection.fetchrow("""
+                    INSERT INTO grpo_header (po_id, post_per, post_dt, doc_dt, bpcode, bpname, remarks, created_by)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    RETURNING grpo_id, grpo_no;
+                """, receipt.po_id, int(posting_period['period_id']), receipt.post_dt, receipt.doc_dt,
+                    po['bpcode'], po['bpname'], receipt.remarks, receipt.created_by)
+                
+                keys = {(line['it_id'], line['whs_id'] or 0) for line in lines}
+                balances = await lock_stock_balances(connection, keys)
+                valuations = await load_stock_valuations(connection, keys)
+                trans_ids = await connection.fetch(
+                    "SELECT nextval(pg_get_serial_sequence('stock_transactions', 'trans_id')) as trans_id FROM generate_series(1, $1);",
+                    len(lines)
+                )
+                # Dated after the balance locks are held, like every other posting
+                trans_date = await connection.fetchval("SELECT clock_timestamp()::timestamp;")
+                
+                rollup = {}
+                last_trans = {}
+                ledger_records = []
+                grpo_records = []
+                for line_no, (line, trans) in enumerate(zip(lines, trans_ids), start=1):
+                    trans_id = trans['trans_id']
+                    key = (line['it_id'], line['whs_id'] or 0)
+                    balances[key] += line['recv_qty']
+                    last_trans[key] = trans_id
+                    apply_stock_valuation(valuations[key], 'IN', line['recv_qty'], line['unit_cost'], trans_id)
+                    add_to_stock_rollup(rollup, trans_date.date(), key[0], key[1], 'IN', line['recv_qty'], line['unit_cost'])
+                    ledger_records.append((
+                        trans_id, line['it_id'], 'IN', 'GRPO', grpo['grpo_no'], line['whs_id'],
+                        line['recv_qty'], line['unit_cost'], balances[key],
+                        f"PO {po['po_no']} line {line['po_line_no']}", receipt.created_by, trans_date
+                    ))
+                    grpo_records.append((
+                        grpo['grpo_id'], line_no, line['po_row_id'], line['it_id'], line['whs_id'],
+                        line['recv_qty'], line['unit_cost'], trans_id
+                    ))
+                
+                await connection.copy_records_to_table(
+                    'stock_transactions', records=ledger_records, columns=['trans_id'] + STOCK_IMPORT_COLUMNS + ['trans_date']
+                )
+                await connection.copy_records_to_table('grpo_row', records=grpo_records, columns=GRPO_ROW_COLUMNS)
+                
+                balance_keys = list(balances)
+                await connection.execute("""
+                    UPDATE stock_balance sb
+                    SET balance_qty = v.balance_qty, last_trans_id = v.last_trans_id, updated_at = CURRENT_TIMESTAMP
+                    FROM unnest($1::int[], $2::int[], $3::numeric[], $4::int[]) AS v(item_id, warehouse_id, balance_qty, last_trans_id)
+                    WHERE sb.item_id = v.item_id AND sb.warehouse_id = v.warehouse_id;
+                """, [k[0] for k in balance_keys], [k[1] for k in balance_keys],
+                    [balances[k] for k in balance_keys], [last_trans[k] for k in balance_keys])
+                await save_stock_valuations(connection, valuations)
+                await save_stock_rollup(connection, rollup)
+                
+                await connection.execute("""
+                    UPDATE pur_ord_row r SET received_qty = r.received_qty + v.recv_qty
+                    FROM unnest($1::int[], $2::numeric[]) AS v(po_row_id, recv_qty)
+                    WHERE r.po_row_id = v.po_row_id;
+                """, [line['po_row_id'] for line in lines], [line['recv_qty'] for line in lines])
+                
+                # Close the order once every line is fully received
+                await connection.execute("""
+                    UPDATE pur_ord_header SET po_status = 'Closed', updated_at = CURRENT_TIMESTAMP
+                    WHERE po_id = $1
+                      AND NOT EXISTS (SELECT 1 FROM pur_ord_row WHERE po_id = $1 AND received_qty < req_qty);
+                """, receipt.po_id)
+            
+            return await get_goods_receipt(grpo['grpo_id'])
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating goods receipt: {str(e)}")
+
 # Additional endpoint to get approved PRs for conversion
 @api_router.get("/purchase-requests/approved")
 async def get_approved_purchase_requests():
@@ -4880,15 +8437,7 @@ async def get_vendors():
 @api_router.get("/tax-codes")
 async def get_tax_codes():
     try:
-        async with pool.acquire() as connection:
-            query = """
-                SELECT tax_id, tax_code, tax_name, tax_rate
-                FROM tax_master 
-                WHERE is_active = true
-                ORDER BY tax_rate;
-            """
-            results = await connection.fetch(query)
-            return [dict(row) for row in results]
+        return await get_master_data('tax_master')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching tax codes: {str(e)}")
 
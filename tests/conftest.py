@@ -0,0 +1,26 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    # The app module, for tests that call its helpers directly. Skips unless the
+    # app's dependencies are installed.
+    for module in ("fastapi", "asyncpg", "dotenv", "email_validator", "multipart"):
+        pytest.importorskip(module)
+    # main mounts ./static at import time
+    workdir = tmp_path_factory.mktemp("app")
+    (workdir / "static").mkdir()
+    cwd = os.getcwd()
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    try:
+        return importlib.import_module("main")
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(ROOT)
@@ -0,0 +1,62 @@
+# CSV record splitting used by the stock and item imports. Needs the app's
+# dependencies installed, since it imports main:
+#
+#   python -m pytest tests/test_csv_import.py
+import asyncio
+
+
+class StreamedBody:
+    # Stands in for a Request, delivering the body in small chunks
+    def __init__(self, text, chunk_size=3):
+        self.data = text.encode()
+        self.chunk_size = chunk_size
+
+    async def stream(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i:i + self.chunk_size]
+
+
+def read_rows(main, text):
+    async def collect():
+        return [row async for row in main.iter_csv_rows(StreamedBody(text))]
+    return asyncio.run(collect())
+
+
+def test_quoted_newlines_stay_in_one_record(main):
+    rows = read_rows(main, 'item_id,remarks\r\n1,"first\r\nsecond"\r\n2,"say ""hi""\nthere"\n3,plain\n')
+    assert rows == [
+        (1, ["item_id", "remarks"], None),
+        (2, ["1", "first\r\nsecond"], None),
+        (4, ["2", 'say "hi"\nthere'], None),
+        (6, ["3", "plain"], None),
+    ]
+
+
+def test_stray_quotes_in_unquoted_fields_are_text(main):
+    rows = read_rows(main, 'A1,1/2" valve\nA2,3" pipe\nA3,ok\n')
+    assert rows == [
+        (1, ["A1", '1/2" valve'], None),
+        (2, ["A2", '3" pipe'], None),
+        (3, ["A3", "ok"], None),
+    ]
+
+
+def test_text_after_a_closing_quote_does_not_reopen_the_field(main):
+    rows = read_rows(main, 'a,"b"x,c\nd,e\n')
+    assert rows == [(1, ["a", "bx", "c"], None), (2, ["d", "e"], None)]
+
+
+def test_unparseable_record_is_reported_at_its_line(main):
+    rows = read_rows(main, "a,b\rc\nok,1\n")
+    assert rows[0][0] == 1 and rows[0][1] is None and rows[0][2]
+    assert rows[1] == (2, ["ok", "1"], None)
+
+
+def test_unterminated_quote_is_reported_at_its_first_line(main):
+    rows = read_rows(main, 'h1,h2\n1,ab"c,"d\n2,ok\n')
+    assert rows[0] == (1, ["h1", "h2"], None)
+    assert rows[1][0] == 2 and rows[1][1] is None and "not closed" in rows[1][2]
+
+
+def test_blank_lines_yield_empty_records(main):
+    assert read_rows(main, "\nh\n") == [(1, [], None), (2, ["h"], None)]
@@ -0,0 +1,93 @@
+# Latency of the in-process item suggest index on a synthetic catalogue. The index is
+# built from generated rows, so no database is needed, but it takes a while:
+#
+#   ITEM_SUGGEST_BENCH=1 python -m pytest -s tests/test_item_suggest_benchmark.py
+#
+# ITEM_SUGGEST_BENCH_ITEMS sets the catalogue size (default 200000). The target is
+# the top 10 matches in under 5 ms at the 95th percentile for every query kind.
+import asyncio
+import os
+import random
+import time
+
+import pytest
+
+ITEMS = int(os.getenv("ITEM_SUGGEST_BENCH_ITEMS", "200000"))
+QUERIES = 500
+LIMIT = 10
+TARGET_MS = 5.0
+
+pytestmark = pytest.mark.skipif(not os.getenv("ITEM_SUGGEST_BENCH"), reason="ITEM_SUGGEST_BENCH is not set")
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+VOCABULARY = 20000  # Distinct name words, so each word is shared by a few dozen items
+PREFIXES = ["BRG", "BLT", "VLV", "PMP", "MTR", "SEA", "GSK", "FLG", "CBL", "SNS"]
+
+
+class CatalogueConnection:
+    # Answers build_item_suggest_index's single fetch with the generated rows
+    def __init__(self, records):
+        self.records = records
+
+    async def fetch(self, query, *args):
+        return self.records
+
+
+def make_catalogue(rng):
+    words = sorted({"".join(rng.choices(LETTERS, k=rng.randint(5, 9))) for _ in range(VOCABULARY)})
+    return [
+        {
+            "it_id": i,
+            "it_code": f"{rng.choice(PREFIXES)}-{i:06d}",
+            "it_name": " ".join(rng.sample(words, 3)) + f" {rng.randint(1, 200)}mm",
+            "it_details": None,
+            "it_hsn": str(rng.randint(10000000, 99999999)),
+            "it_uom": 1,
+            "it_whs": 1,
+            "it_status": "Active" if rng.random() < 0.9 else "Inactive",
+        }
+        for i in range(1, ITEMS + 1)
+    ]
+
+
+def typo(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice("aeiou") + word[i + 1:]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def test_suggest_latency(main):
+    rng = random.Random(19)
+    catalogue = make_catalogue(rng)
+    started = time.perf_counter()
+    asyncio.run(main.build_item_suggest_index(CatalogueConnection(catalogue)))
+    print(f"\nbuilt index for {ITEMS} items in {time.perf_counter() - started:.1f}s")
+
+    sample = rng.sample(catalogue, QUERIES)
+    query_kinds = {
+        "code prefix": [item["it_code"][:6].lower() for item in sample],
+        "full code": [item["it_code"] for item in sample],
+        "name words": [" ".join(item["it_name"].split()[:2]) for item in sample],
+        "hsn prefix": [item["it_hsn"][:5] for item in sample],
+        "typo (trigram)": [typo(item["it_name"].split()[0], rng) + "q" for item in sample],
+    }
+    failures = []
+    for kind, queries in query_kinds.items():
+        timings = []
+        hits = 0
+        for q in queries:
+            started = time.perf_counter()
+            hits += len(main.search_item_suggest_index(q, LIMIT, True))
+            timings.append((time.perf_counter() - started) * 1000)
+        p50, p95 = percentile(timings, 0.5), percentile(timings, 0.95)
+        print(
+            f"{kind:>15}: p50 {p50:.3f} ms  p95 {p95:.3f} ms  max {max(timings):.3f} ms"
+            f"  avg hits {hits / len(queries):.1f}"
+        )
+        if p95 > TARGET_MS:
+            failures.append(f"{kind} p95 {p95:.2f} ms")
+    assert not failures, ", ".join(failures)
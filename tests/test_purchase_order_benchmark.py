@@ -0,0 +1,124 @@
+# Round trips and latency of GET /api/purchase-orders at 1k/10k/50k orders, against
+# the per-order row fetch the endpoint used to do. Needs a disposable database with
+# the app's schema and at least one purchase order, which is cloned up to each size:
+#
+#   BENCH_DATABASE_URL=postgresql://... python -m pytest -s tests/test_purchase_order_benchmark.py
+#
+# The cloned orders are deleted again at the end.
+import asyncio
+import os
+import time
+
+import pytest
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+SIZES = (1000, 10000, 50000)
+
+pytestmark = pytest.mark.skipif(not BENCH_DATABASE_URL, reason="BENCH_DATABASE_URL is not set")
+
+# The endpoint before it was rebuilt: one header query, then one row query per order
+HEADERS_QUERY = """
+    SELECT po_id, po_no, post_per, post_dt, doc_dt, bpcode, bpname, emp_code, emp_name, dept_id,
+           subtotal, discount_amt, tax_amt, total_amt, po_status, created_by, created_at, updated_by, updated_at
+    FROM pur_ord_header
+    ORDER BY po_no DESC;
+"""
+ROWS_PER_ORDER_QUERY = """
+    SELECT po_row_id, po_id, line_no, it_id, it_code, it_name, it_details, hsn_code, uom_id, req_qty,
+           need_date, unit_price, discount_percent, discount_amt, tax_code, tax_rate, tax_amt, line_total,
+           whs_id, pr_req_id, pr_line_no, pr_no, created_by, created_at
+    FROM pur_ord_row
+    WHERE po_id = $1
+    ORDER BY line_no;
+"""
+HEADER_COPY_COLUMNS = (
+    "post_per, post_dt, doc_dt, bpcode, bpname, emp_code, emp_name, dept_id, "
+    "subtotal, discount_amt, tax_amt, total_amt, po_status"
+)
+
+
+async def fetch_per_order(pool):
+    async with pool.acquire() as connection:
+        result = []
+        for header in await connection.fetch(HEADERS_QUERY):
+            header_dict = dict(header)
+            header_dict["rows"] = [dict(r) for r in await connection.fetch(ROWS_PER_ORDER_QUERY, header["po_id"])]
+            result.append(header_dict)
+        return result
+
+
+async def clone_orders(connection, template_id, count, row_columns):
+    po_ids = [r["po_id"] for r in await connection.fetch(f"""
+        INSERT INTO pur_ord_header ({HEADER_COPY_COLUMNS}, created_by, updated_by)
+        SELECT {HEADER_COPY_COLUMNS}, 'benchmark', 'benchmark'
+        FROM pur_ord_header, generate_series(1, $2)
+        WHERE po_id = $1
+        RETURNING po_id;
+    """, template_id, count)]
+    await connection.execute(f"""
+        INSERT INTO pur_ord_row (po_id, {', '.join(row_columns)})
+        SELECT n.po_id, {', '.join('r.' + c for c in row_columns)}
+        FROM unnest($2::int[]) AS n(po_id)
+        CROSS JOIN pur_ord_row r
+        WHERE r.po_id = $1;
+    """, template_id, po_ids)
+    return po_ids
+
+
+def test_purchase_order_list_round_trips(main):
+    asyncio.run(run_purchase_order_benchmark(main))
+
+
+async def run_purchase_order_benchmark(main):
+    import asyncpg
+
+    queries = []
+
+    async def count_queries(connection):
+        connection.add_query_logger(queries.append)
+
+    pool = await asyncpg.create_pool(BENCH_DATABASE_URL, setup=count_queries)
+    app_pool, main.pool = main.pool, pool
+    created = []
+    try:
+        async with pool.acquire() as connection:
+            template_id = await connection.fetchval(
+                "SELECT po_id FROM pur_ord_header WHERE EXISTS (SELECT 1 FROM pur_ord_row r WHERE r.po_id = pur_ord_header.po_id) ORDER BY po_id LIMIT 1;"
+            )
+            if template_id is None:
+                pytest.skip("Need a purchase order with lines to clone")
+            orders = await connection.fetchval("SELECT COUNT(*) FROM pur_ord_header;")
+
+        print()
+        for size in SIZES:
+            if orders < size:
+                async with pool.acquire() as connection:
+                    async with connection.transaction():
+                        created += await clone_orders(connection, template_id, size - orders, main.PO_ROW_COLUMNS[1:])
+                orders = size
+
+            queries.clear()
+            started = time.perf_counter()
+            before = await fetch_per_order(pool)
+            before_ms, before_trips = (time.perf_counter() - started) * 1000, len(queries)
+
+            queries.clear()
+            started = time.perf_counter()
+            after = await main.get_purchase_orders()
+            after_ms, after_trips = (time.perf_counter() - started) * 1000, len(queries)
+
+            assert [h["po_id"] for h in after] == [h["po_id"] for h in before]
+            assert sum(len(h["rows"]) for h in after) == sum(len(h["rows"]) for h in before)
+            print(
+                f"{orders:>6} orders: per-order fetch {before_trips:>6} round trips {before_ms:>9.1f} ms"
+                f"  |  batched {after_trips} round trips {after_ms:>8.1f} ms"
+            )
+            assert after_trips <= 2
+    finally:
+        if created:
+            async with pool.acquire() as connection:
+                async with connection.transaction():
+                    await connection.execute("DELETE FROM pur_ord_row WHERE po_id = ANY($1::int[]);", created)
+                    await connection.execute("DELETE FROM pur_ord_header WHERE po_id = ANY($1::int[]);", created)
+        main.pool = app_pool
+        await pool.close()
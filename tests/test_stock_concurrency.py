@@ -0,0 +1,91 @@
+# Stress test for concurrent stock postings. Runs against a live server with a
+# disposable database, since it writes thousands of ledger rows:
+#
+#   STOCK_STRESS_URL=http://localhost:8000 python -m pytest tests/test_stock_concurrency.py
+#
+# STOCK_STRESS_ITEM_ID / STOCK_STRESS_WAREHOUSE_ID pick the key to post against
+# (default: the first item and warehouse). STOCK_STRESS_POSTINGS sets the volume.
+import asyncio
+import os
+import random
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+BASE_URL = os.getenv("STOCK_STRESS_URL")
+POSTINGS = int(os.getenv("STOCK_STRESS_POSTINGS", "2000"))
+CONCURRENCY = 100
+
+pytestmark = pytest.mark.skipif(not BASE_URL, reason="STOCK_STRESS_URL is not set")
+
+
+async def pick_keys(client):
+    item_id = os.getenv("STOCK_STRESS_ITEM_ID")
+    if not item_id:
+        items = (await client.get("/api/items", params={"limit": 1})).json()
+        if not items:
+            pytest.skip("No items to post against")
+        item_id = items[0]["it_id"]
+    warehouse_id = os.getenv("STOCK_STRESS_WAREHOUSE_ID")
+    if not warehouse_id:
+        warehouses = (await client.get("/api/warehouses")).json()
+        if len(warehouses) < 2:
+            pytest.skip("Need two warehouses to post against")
+        warehouse_id = warehouses[0]["whs_id"]
+        other_warehouse_id = warehouses[1]["whs_id"]
+    else:
+        other_warehouse_id = None
+    return int(item_id), int(warehouse_id), other_warehouse_id
+
+
+async def current_stock(client, item_id, warehouse_id):
+    response = await client.get(f"/api/current-stock/{item_id}", params={"warehouse_id": warehouse_id})
+    response.raise_for_status()
+    return response.json()["current_stock"]
+
+
+def test_concurrent_postings_keep_running_balance():
+    asyncio.run(run_concurrent_postings())
+
+
+async def run_concurrent_postings():
+    limits = httpx.Limits(max_connections=CONCURRENCY)
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=120, limits=limits) as client:
+        item_id, warehouse_id, other_warehouse_id = await pick_keys(client)
+        warehouse_ids = [warehouse_id] + ([other_warehouse_id] if other_warehouse_id else [])
+        opening = {w: await current_stock(client, item_id, w) for w in warehouse_ids}
+
+        # Mostly one hot key, with a second key interleaved to exercise parallel keys
+        rng = random.Random(6)
+        movements = [
+            (rng.choice(warehouse_ids) if rng.random() < 0.2 else warehouse_id,
+             rng.choice(("IN", "OUT")), rng.randint(1, 20))
+            for _ in range(POSTINGS)
+        ]
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+
+        async def post(whs_id, trans_type, qty):
+            async with semaphore:
+                response = await client.post("/api/stock-transactions", json={
+                    "item_id": item_id,
+                    "warehouse_id": whs_id,
+                    "trans_type": trans_type,
+                    "reference_type": "STRESS",
+                    "stock_qty": qty,
+                })
+                assert response.status_code == 201, response.text
+
+        await asyncio.gather(*(post(*m) for m in movements))
+
+        for w in warehouse_ids:
+            expected = opening[w] + sum(q if t == "IN" else -q for whs, t, q in movements if whs == w)
+            assert await current_stock(client, item_id, w) == pytest.approx(expected)
+
+        # Every stored running balance must match a replay of the ledger in its own order
+        verify = (await client.get("/api/stock-balance/verify", params={"limit": 10000})).json()
+        drifted = {
+            (r["item_id"], r["warehouse_id"])
+            for r in verify["ledger_drift"] + verify["balance_mismatch"]
+        }
+        assert not drifted & {(item_id, w) for w in warehouse_ids}
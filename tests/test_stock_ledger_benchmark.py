@@ -0,0 +1,117 @@
+# Page latency of GET /api/stock-transactions on a large ledger: deep OFFSET pages
+# against keyset pages (after_date/after_id) at the same depth, with and without an
+# item filter. Needs a disposable database with the app's schema, at least one item
+# and the ledger indexes built:
+#
+#   BENCH_DATABASE_URL=postgresql://... python -m pytest -s tests/test_stock_ledger_benchmark.py
+#
+# BENCH_LEDGER_ROWS sets how many ledger rows are seeded (default 3000000). They are
+# ADJUSTMENT rows spread over the last year and are deleted again at the end.
+import asyncio
+import os
+import statistics
+import time
+from datetime import timedelta
+
+import pytest
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+ROWS = int(os.getenv("BENCH_LEDGER_ROWS", "3000000"))
+SEED_CHUNK = 500000
+PAGE_SIZE = 100
+DEPTHS = (1, 100, 1000, 10000)  # Page numbers
+RUNS = 5
+
+pytestmark = pytest.mark.skipif(not BENCH_DATABASE_URL, reason="BENCH_DATABASE_URL is not set")
+
+MARKER = "ledger-benchmark"
+
+
+async def seed_ledger(connection, item_ids):
+    # Row n goes to item n % len(items), one row every few seconds back from now
+    spacing = 365 * 86400 / ROWS
+    for start in range(0, ROWS, SEED_CHUNK):
+        await connection.execute("""
+            INSERT INTO stock_transactions (
+                item_id, trans_type, reference_type, warehouse_id,
+                stock_qty, unit_cost, balance_qty, remarks, created_by, trans_date
+            )
+            SELECT ($1::int[])[1 + n % array_length($1::int[], 1)], 'ADJUSTMENT', 'BENCHMARK', NULL,
+                   1, 0, 1, NULL, $2,
+                   date_trunc('second', now())::timestamp - make_interval(secs => n * $5::float8)
+            FROM generate_series($3::int, $4::int) AS n;
+        """, item_ids, MARKER, start, min(start + SEED_CHUNK, ROWS) - 1, spacing)
+    await connection.execute("ANALYZE stock_transactions;")
+
+
+async def cursor_at(connection, depth, item_id):
+    # The last row of the page before `depth`, which is where a client paging with
+    # after_date/after_id would be by then
+    row = await connection.fetchrow("""
+        SELECT trans_date, trans_id FROM stock_transactions
+        WHERE ($2::int IS NULL OR item_id = $2)
+        ORDER BY trans_date DESC, trans_id DESC
+        OFFSET $1 LIMIT 1;
+    """, (depth - 1) * PAGE_SIZE - 1, item_id)
+    return (row["trans_date"], row["trans_id"]) if row else None
+
+
+async def median_ms(fetch):
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        page = await fetch()
+        timings.append((time.perf_counter() - started) * 1000)
+        assert len(page) == PAGE_SIZE
+    return statistics.median(timings), page
+
+
+def test_ledger_paging_latency(main):
+    asyncio.run(run_ledger_benchmark(main))
+
+
+async def run_ledger_benchmark(main):
+    import asyncpg
+
+    pool = await asyncpg.create_pool(BENCH_DATABASE_URL)
+    app_pool, main.pool = main.pool, pool
+    try:
+        async with pool.acquire() as connection:
+            item_ids = [r["it_id"] for r in await connection.fetch("SELECT it_id FROM item_master ORDER BY it_id LIMIT 50;")]
+            if not item_ids:
+                pytest.skip("Need at least one item to post ledger rows against")
+            started = time.perf_counter()
+            await seed_ledger(connection, item_ids)
+            print(f"\nseeded {ROWS} ledger rows in {time.perf_counter() - started:.1f}s")
+
+        for label, item_id in (("all items", None), (f"item {item_ids[0]}", item_ids[0])):
+            for depth in DEPTHS:
+                after_date = after_id = None
+                if depth > 1:
+                    async with pool.acquire() as connection:
+                        cursor = await cursor_at(connection, depth, item_id)
+                    if cursor is None:
+                        continue  # The filtered ledger is shorter than this
+                    after_date, after_id = cursor
+                offset_ms, offset_page = await median_ms(lambda: main.get_stock_transactions(
+                    item_id=item_id, skip=(depth - 1) * PAGE_SIZE, limit=PAGE_SIZE
+                ))
+                keyset_ms, keyset_page = await median_ms(lambda: main.get_stock_transactions(
+                    item_id=item_id, after_date=after_date, after_id=after_id, limit=PAGE_SIZE
+                ))
+                assert [r["trans_id"] for r in keyset_page] == [r["trans_id"] for r in offset_page]
+                print(f"{label:>12} page {depth:>6}: offset {offset_ms:>9.1f} ms  |  keyset {keyset_ms:>7.1f} ms")
+
+        # A one-day window near the far end of the seeded rows (the first day is partial)
+        day = (await pool.fetchval(
+            "SELECT MIN(trans_date) FROM stock_transactions WHERE created_by = $1;", MARKER
+        )).date() + timedelta(days=1)
+        window_ms, _ = await median_ms(lambda: main.get_stock_transactions(
+            start_date=day, end_date=day, limit=PAGE_SIZE
+        ))
+        print(f"  date window {day}: {window_ms:.1f} ms")
+    finally:
+        async with pool.acquire() as connection:
+            await connection.execute("DELETE FROM stock_transactions WHERE created_by = $1;", MARKER)
+        main.pool = app_pool
+        await pool.close()